@@ -1,2 +1,3 @@
 from opal._version import __version__
 
+default_app_config = 'opal.apps.OpalConfig'
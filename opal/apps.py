@@ -0,0 +1,31 @@
+"""
+OPAL Django application configuration
+"""
+from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
+
+
+class OpalConfig(AppConfig):
+    name = 'opal'
+
+    def ready(self):
+        from opal.core import lookuplists, serialization
+        from opal.core.search import index, registry
+        from opal.core.subrecords import get_subrecord_from_api_name
+
+        serialization.compile_plans()
+        registry.build_registry()
+
+        for signal in [post_save, post_delete]:
+            signal.connect(lookuplists.invalidate_cache,
+                           dispatch_uid='opal.lookuplists.invalidate_cache')
+
+        try:
+            Demographics = get_subrecord_from_api_name('demographics')
+        except ValueError:
+            pass
+        else:
+            post_save.connect(index.update_index, sender=Demographics,
+                              dispatch_uid='opal.search.index.update_index')
+            post_delete.connect(index.remove_from_index, sender=Demographics,
+                                dispatch_uid='opal.search.index.remove_from_index')
@@ -0,0 +1,239 @@
+"""
+OPAL admissions - bulk admission of episodes from upstream systems
+
+Admissions arrive as newline delimited JSON, one admission per line:
+
+    {"hospital_number": "555", "demographics": {"name": "Jane"},
+     "episode": {"date_of_admission": "2015-11-01"}, "tags": ["micro"]}
+
+Patients are matched on hospital number, and created if we have not
+seen them before. Records are written in chunks, each in a single
+transaction, using bulk inserts wherever we don't need the new ids.
+"""
+import json
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from opal.core import exceptions, glossolalia
+from opal.core.search import index
+from opal.core.subrecords import (episode_subrecords, patient_subrecords,
+                                  get_subrecord_from_api_name)
+
+CHUNK_SIZE = getattr(settings, 'OPAL_ADMIT_CHUNK_SIZE', 500)
+
+ADMISSION_KEYS = set(['hospital_number', 'demographics', 'episode', 'tags'])
+
+
+def parse_ndjson(lines):
+    """
+    Generator function yielding (line_number, admission, error) for
+    each non-blank line of LINES.
+    """
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            admission = json.loads(line)
+        except ValueError:
+            yield line_number, None, 'Invalid JSON'
+            continue
+        if not isinstance(admission, dict):
+            yield line_number, None, 'Expected a JSON object'
+        else:
+            yield line_number, admission, None
+
+
+def _chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class _Admission(object):
+    """
+    A single admission, validated and ready to be written.
+    """
+    def __init__(self, line, data, user, teams):
+        from opal.models import Episode
+
+        unknown = set(data.keys()) - ADMISSION_KEYS
+        if unknown:
+            raise exceptions.APIError(
+                'Unexpected fieldname(s): %s' % list(unknown))
+
+        self.line = line
+        self.hospital_number = data.get('hospital_number')
+        if not self.hospital_number:
+            raise exceptions.APIError('Missing field (hospital_number)')
+
+        self.tags = data.get('tags', [])
+        for tag in self.tags:
+            if tag not in teams:
+                raise exceptions.APIError('Unknown team: {0}'.format(tag))
+
+        self.demographics = data.get('demographics', None)
+        if self.demographics is not None:
+            self.demographics = dict(self.demographics)
+            self.demographics['hospital_number'] = self.hospital_number
+            # Validate now rather than half way through a chunk
+            model = get_subrecord_from_api_name('demographics')
+            model()._update_fields_from_dict(dict(self.demographics), user)
+
+        episode_data = dict(data.get('episode', {}))
+        episode_data.pop('id', None)
+        episode_data.pop('patient_id', None)
+        self.episode = Episode()
+        self.episode._update_fields_from_dict(episode_data, user)
+        self.episode.active = bool(self.tags)
+
+
+def _admit_chunk(admissions, user, teams):
+    """
+    Write a chunk of validated ADMISSIONS, returning the outcome
+    for each.
+    """
+    from opal.models import Episode, Patient, Tagging
+
+    Demographics = get_subrecord_from_api_name('demographics')
+
+    hospital_numbers = set(a.hospital_number for a in admissions)
+    patient_ids = dict(Demographics.objects.filter(
+        hospital_number__in=hospital_numbers
+    ).values_list('hospital_number', 'patient_id'))
+    existing = dict((d.patient_id, d) for d in Demographics.objects.filter(
+        patient_id__in=patient_ids.values()))
+
+    patient_singletons = [s for s in patient_subrecords()
+                          if s._is_singleton and s is not Demographics]
+    episode_singletons = [s for s in episode_subrecords() if s._is_singleton]
+    singletons = dict((s, []) for s in patient_singletons + episode_singletons)
+    singletons[Demographics] = []
+    taggings = []
+    outcomes = []
+    now = timezone.now()
+
+    for admission in admissions:
+        patient_id = patient_ids.get(admission.hospital_number)
+        patient_created = patient_id is None
+
+        if patient_created:
+            patient = Patient()
+            # Skip Patient.save() - we create the singletons in bulk below.
+            super(Patient, patient).save()
+            patient_id = patient_ids[admission.hospital_number] = patient.id
+
+            for subclass in patient_singletons:
+                singletons[subclass].append(subclass(patient_id=patient_id))
+            demographics = existing[patient_id] = Demographics(patient_id=patient_id)
+            data = admission.demographics or {
+                'hospital_number': admission.hospital_number}
+        elif admission.demographics is not None:
+            demographics = existing[patient_id]
+            data = admission.demographics
+        else:
+            demographics = None
+
+        if demographics is not None:
+            post_save = demographics._update_fields_from_dict(dict(data), user)
+            if demographics.pk is None and not post_save:
+                if demographics not in singletons[Demographics]:
+                    singletons[Demographics].append(demographics)
+            else:
+                if demographics in singletons[Demographics]:
+                    singletons[Demographics].remove(demographics)
+                demographics.save()
+                for some_func in post_save:
+                    some_func()
+
+        episode = admission.episode
+        episode.patient_id = patient_id
+        # Skip Episode.save() - we create the singletons in bulk below.
+        super(Episode, episode).save()
+
+        for subclass in episode_singletons:
+            singletons[subclass].append(subclass(episode_id=episode.id))
+
+        for tag in admission.tags:
+            team = teams[tag]
+            if team.parent and team.parent.name not in admission.tags:
+                taggings.append(Tagging(team=team.parent, episode_id=episode.id))
+            tagging = Tagging(team=team, episode_id=episode.id,
+                              created_by=user,
+                              created=now)
+            if tag == 'mine':
+                tagging.user = user
+            taggings.append(tagging)
+
+        outcomes.append({
+            'line': admission.line,
+            'status': 'created',
+            'patient_id': patient_id,
+            'patient_created': patient_created,
+            'episode_id': episode.id,
+        })
+
+    for subclass, instances in singletons.items():
+        if instances:
+            subclass.objects.bulk_create(instances)
+    Tagging.objects.bulk_create(taggings)
+    # bulk_create() doesn't send the signals that keep the index up to date
+    index.index_patients([o['patient_id'] for o in outcomes])
+    return outcomes
+
+
+def admit(admissions, user, chunk_size=None):
+    """
+    Generator function that admits ADMISSIONS - an iterable of
+    (line_number, admission, error) as from parse_ndjson() - yielding
+    an outcome for each. USER, who must be authenticated, is recorded
+    as having created the taggings.
+
+    Each chunk of CHUNK_SIZE admissions is written in one transaction;
+    if writing a chunk fails, every admission in it is reported as an
+    error.
+    """
+    from opal.models import Episode, Team
+
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    teams = dict((t.name, t) for t in Team.objects.select_related('parent'))
+
+    for chunk in _chunks(admissions, chunk_size):
+        outcomes = {}
+        valid = []
+        for line, data, error in chunk:
+            if error is None:
+                try:
+                    valid.append(_Admission(line, data, user, teams))
+                    continue
+                except (exceptions.APIError, ValueError, TypeError) as e:
+                    error = str(e)
+            outcomes[line] = {'line': line, 'status': 'error', 'error': error}
+
+        if valid:
+            try:
+                with transaction.atomic():
+                    for outcome in _admit_chunk(valid, user, teams):
+                        outcomes[outcome['line']] = outcome
+            except DatabaseError as e:
+                for admission in valid:
+                    outcomes[admission.line] = {
+                        'line': admission.line, 'status': 'error', 'error': str(e)}
+
+        if glossolalia.INTEGRATING:
+            episode_ids = [o['episode_id'] for o in outcomes.values()
+                           if o['status'] == 'created']
+            episodes = Episode.objects.filter(id__in=episode_ids)
+            for serialised in Episode.objects.serialised(user, episodes):
+                glossolalia.admit(serialised)
+
+        for line, data, error in chunk:
+            yield outcomes[line]
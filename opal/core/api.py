@@ -4,18 +4,21 @@ Public facing API views
 import collections
 
 from django.conf import settings
+from django.db import transaction
 from django.views.generic import View
 from django.contrib.contenttypes.models import ContentType
 from rest_framework import routers, status, viewsets
 from rest_framework.response import Response
+import reversion
 from opal.models import Episode, Synonym, Team, Macro
-from opal.core import application, exceptions, plugins
+from opal.core import admissions, application, exceptions, pagination, plugins
 from opal.core import glossolalia
 from opal.core.lookuplists import LookupList
 from opal.utils import stringport, camelcase_to_underscore
 from opal.core import schemas
-from opal.core.subrecords import subrecords
-from opal.core.views import _get_request_data, _build_json_response
+from opal.core.subrecords import subrecords, get_subrecord_from_api_name
+from opal.core.views import (_get_request_data, _build_json_response,
+                             _build_json_streaming_response)
 
 app = application.get_app()
 
@@ -173,15 +176,15 @@ class SubrecordViewSet(viewsets.ViewSet):
     This is the base viewset for our subrecords.
     """
 
-    def _item_to_dict(self, item, user):
+    def _item_snapshot(self, item, user):
         """
-        Given an item, serialize either the patient or episode it is a
-        subrecord of.
+        Given an item, snapshot either the patient or episode it is a
+        subrecord of for our integration upstream interface.
         """
         try:
-            return item.episode.to_dict(user)
+            return glossolalia.snapshot(item.episode, user)
         except AttributeError:
-            return item.patient.to_dict(user)
+            return glossolalia.snapshot(item.patient, user)
 
     def create(self, request):
         """
@@ -201,7 +204,7 @@ class SubrecordViewSet(viewsets.ViewSet):
             episode = Episode.objects.get(pk=request.data['episode_id'])
         except Episode.DoesNotExist:
             return Response('Nonexistant episode', status=status.HTTP_400_BAD_REQUEST)
-        pre = episode.to_dict(request.user)
+        pre = glossolalia.snapshot(episode, request.user)
 
         if isinstance(subrecord, PatientSubrecord):
             del request.data['episode_id']
@@ -213,8 +216,7 @@ class SubrecordViewSet(viewsets.ViewSet):
         except exceptions.APIError:
             return Response({'error': 'Unexpected field name'}, status=status.HTTP_400_BAD_REQUEST)
 
-        episode = Episode.objects.get(pk=episode.pk)
-        post = episode.to_dict(request.user)
+        post = glossolalia.snapshot(episode, request.user)
         glossolalia.change(pre, post)
 
         return Response(subrecord.to_dict(request.user), status=status.HTTP_201_CREATED)
@@ -225,7 +227,7 @@ class SubrecordViewSet(viewsets.ViewSet):
 
     @item_from_pk
     def update(self, request, item):
-        pre = self._item_to_dict(item, request.user)
+        pre = self._item_snapshot(item, request.user)
         try:
             item.update_from_dict(request.data, request.user)
         except exceptions.APIError:
@@ -233,17 +235,137 @@ class SubrecordViewSet(viewsets.ViewSet):
                             status=status.HTTP_400_BAD_REQUEST)
         except exceptions.ConsistencyError:
             return Response({'error': 'Item has changed'}, status=status.HTTP_409_CONFLICT)
-        glossolalia.change(pre, self._item_to_dict(item, request.user))
+        glossolalia.change(pre, self._item_snapshot(item, request.user))
         return Response(item.to_dict(request.user), status=status.HTTP_202_ACCEPTED)
 
     @item_from_pk
     def destroy(self, request, item):
-        pre = self._item_to_dict(item, request.user)
+        pre = self._item_snapshot(item, request.user)
         item.delete()
-        glossolalia.change(pre, self._item_to_dict(item, request.user))
+        glossolalia.change(pre, self._item_snapshot(item, request.user))
         return Response('deleted', status=status.HTTP_202_ACCEPTED)
 
 
+class BatchViewSet(viewsets.ViewSet):
+    """
+    Create, update and delete several subrecords of one episode at once.
+
+    Expects a payload of the form:
+
+        {
+            "episode_id": 1,
+            "items": [
+                {"action": "create", "record": "diagnosis", "data": {...}},
+                {"action": "update", "record": "diagnosis", "id": 3, "data": {...}},
+                {"action": "delete", "record": "allergies", "id": 4, "data": {...}}
+            ]
+        }
+
+    The items are applied in order in a single transaction and a single
+    revision. If any item fails, none of them are applied.
+    """
+    base_name = 'batch'
+
+    def _apply(self, episode, item, user):
+        """
+        Apply a single ITEM of a batch to EPISODE, returning a
+        (status_code, result) pair.
+        """
+        from opal.models import PatientSubrecord
+
+        try:
+            model = get_subrecord_from_api_name(item.get('record'))
+        except ValueError:
+            return status.HTTP_400_BAD_REQUEST, {'error': 'Unknown record type'}
+
+        action = item.get('action')
+        if action not in ['create', 'update', 'delete']:
+            return status.HTTP_400_BAD_REQUEST, {'error': 'Unknown action'}
+
+        data = dict(item.get('data', {}))
+        if issubclass(model, PatientSubrecord):
+            data.pop('episode_id', None)
+            owner = {'patient_id': episode.patient_id}
+        else:
+            owner = {'episode_id': episode.pk}
+        data.update(owner)
+
+        if action == 'create':
+            subrecord = model()
+            subrecord.update_from_dict(data, user)
+            return status.HTTP_201_CREATED, subrecord.to_dict(user)
+
+        try:
+            subrecord = model.objects.get(pk=item.get('id'), **owner)
+        except model.DoesNotExist:
+            return status.HTTP_404_NOT_FOUND, {'error': 'Item does not exist'}
+
+        if action == 'update':
+            data['id'] = subrecord.pk
+            subrecord.update_from_dict(data, user)
+            return status.HTTP_202_ACCEPTED, subrecord.to_dict(user)
+
+        consistency_token = data.get('consistency_token', None)
+        if consistency_token and consistency_token != subrecord.consistency_token:
+            raise exceptions.ConsistencyError
+        subrecord.delete()
+        return status.HTTP_202_ACCEPTED, 'deleted'
+
+    def create(self, request):
+        """
+        * Apply each item in the batch
+        * Ping our integration upstream interface once
+        * Render the per-item results and the episode back to the requester
+
+        If any item fails, roll back the whole batch and return the
+        status of the first failure.
+        """
+        from opal.models import Episode
+
+        try:
+            episode = Episode.objects.get(pk=request.data.get('episode_id'))
+        except Episode.DoesNotExist:
+            return Response('Nonexistant episode', status=status.HTTP_400_BAD_REQUEST)
+
+        pre = glossolalia.snapshot(episode, request.user)
+        results = []
+        failure = None
+
+        with transaction.atomic(), reversion.create_revision():
+            if request.user.is_authenticated():
+                reversion.set_user(request.user)
+
+            for item in request.data.get('items', []):
+                try:
+                    with transaction.atomic():
+                        code, result = self._apply(episode, item, request.user)
+                except exceptions.APIError:
+                    code, result = status.HTTP_400_BAD_REQUEST, {'error': 'Unexpected field name'}
+                except exceptions.ConsistencyError:
+                    code, result = status.HTTP_409_CONFLICT, {'error': 'Item has changed'}
+
+                results.append({
+                    'record': item.get('record'),
+                    'id': item.get('id', None),
+                    'status': code,
+                    'result': result
+                })
+                if code >= 400 and failure is None:
+                    failure = code
+
+            if failure is not None:
+                transaction.set_rollback(True)
+                reversion.revision_context_manager.invalidate()
+
+        if failure is not None:
+            return Response({'applied': False, 'results': results}, status=failure)
+
+        post = episode.to_dict(request.user)
+        glossolalia.change(pre, post)
+        return Response({'applied': True, 'results': results, 'episode': post},
+                        status=status.HTTP_200_OK)
+
+
 class UserProfileViewSet(viewsets.ViewSet):
     """
     Returns the user profile details for the currently logged in user
@@ -274,9 +396,9 @@ class TaggingViewSet(viewsets.ViewSet):
         if 'id' in request.data:
             del request.data['id']
         tag_names = [n for n, v in request.data.items() if v]
-        pre = episode.to_dict(request.user)
+        pre = glossolalia.snapshot(episode, request.user)
         episode.set_tag_names(tag_names, request.user)
-        post = episode.to_dict(request.user)
+        post = glossolalia.snapshot(episode, request.user)
         glossolalia.transfer(pre, post)
         return Response(episode.tagging_dict(request.user)[0], status=status.HTTP_202_ACCEPTED)
 
@@ -302,13 +424,30 @@ class EpisodeViewSet(viewsets.ViewSet):
         if tag == 'mine':
             filter_kwargs['tagging__user'] = request.user
 
+        try:
+            page_params = pagination.get_page_params(request.query_params)
+        except exceptions.APIError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         if not filter_kwargs:
-            return Response([e.to_dict(request.user) for e in Episode.objects.all()])
+            episodes = Episode.objects.all()
+        else:
+            episodes = Episode.objects.filter(active=True, **filter_kwargs)
 
-        serialised = Episode.objects.serialised_active(
-            request.user, **filter_kwargs)
+        if page_params:
+            page, next_cursor = pagination.paginate(episodes, *page_params)
+            serialised = Episode.objects.serialised(
+                request.user, page, episode_history=not filter_kwargs)
+            return Response({'results': serialised, 'next': next_cursor})
+
+        if not filter_kwargs:
+            serialised = Episode.objects.serialised_iterator(
+                request.user, episodes, episode_history=True)
+            return _build_json_streaming_response(serialised)
 
-        return Response(serialised)
+        serialised = Episode.objects.serialised_active_iterator(
+            request.user, **filter_kwargs)
+        return _build_json_streaming_response(serialised)
 
     def create(self, request):
         from opal.models import Patient
@@ -342,7 +481,19 @@ class PatientViewSet(viewsets.ViewSet):
     def list(self, request):
         from opal.models import Patient
 
-        return Response([p.to_dict(request.user) for p in Patient.objects.all()])
+        try:
+            page_params = pagination.get_page_params(request.query_params)
+        except exceptions.APIError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if page_params:
+            page, next_cursor = pagination.paginate(Patient.objects.all(), *page_params)
+            serialised = Patient.objects.serialised(request.user, page)
+            return Response({'results': serialised, 'next': next_cursor})
+
+        serialised = Patient.objects.serialised_iterator(
+            request.user, Patient.objects.all())
+        return _build_json_streaming_response(serialised)
 
     def retrieve(self, request, pk=None):
         from opal.models import Patient
@@ -360,6 +511,7 @@ router.register('extract-schema', ExtractSchemaViewSet)
 router.register('options', OptionsViewSet)
 router.register('userprofile', UserProfileViewSet)
 router.register('tagging', TaggingViewSet)
+router.register('batch', BatchViewSet)
 
 for subrecord in subrecords():
     sub_name = camelcase_to_underscore(subrecord.__name__)
@@ -376,11 +528,27 @@ for plugin in plugins.plugins():
 
 class APIAdmitEpisodeView(View):
     """
-    Admit an episode from upstream!
+    Admit episodes from upstream!
+
+    Expects newline delimited JSON, one admission per line - see
+    opal.core.admissions - and returns the outcome for each line.
+
+    Feeds must be logged in; anonymous requests get a 401 rather than
+    a redirect to the login page.
     """
     def post(self, *args, **kwargs):
-        data = _get_request_data(self.request)
-        resp = {'ok': 'Got your admission just fine - thanks!'}
+        if not self.request.user.is_authenticated():
+            return _build_json_response(
+                {'error': 'Only valid for authenticated users'}, 401)
+        admitted = admissions.admit(
+            admissions.parse_ndjson(self.request), self.request.user)
+        results = list(admitted)
+        created = len([r for r in results if r['status'] == 'created'])
+        resp = {
+            'created': created,
+            'errors': len(results) - created,
+            'results': results
+        }
         return _build_json_response(resp)
 
 
@@ -0,0 +1,202 @@
+"""
+OPAL deltas - structural diffs of serialised episodes and patients
+
+A delta describes how to get from one serialisation of an episode (or
+patient) to another. Lists of records with ids, such as subrecords and
+taggings, are compared record by record and field by field, so a delta
+for a single edit contains only the fields that changed:
+
+    {
+        'fields': {'active': False},
+        'records': {
+            'diagnosis': {
+                'created': [{'id': 7, 'condition': 'Malaria', ...}],
+                'updated': [{'id': 3,
+                             'consistency_token': '0f0c1a2b',
+                             'previous_consistency_token': '9e8d7c6b',
+                             'fields': {'condition': 'Dengue'}}],
+                'deleted': [4],
+            }
+        }
+    }
+
+Nested dictionaries (e.g. a patient's episodes) appear under 'nested',
+and keys that have gone away - from the serialisation, or from a record
+such as a tagging when a tag is removed - under 'removed'.
+"""
+
+
+class DeltaConflict(Exception):
+    """
+    Raised when a delta does not apply cleanly to the state we have.
+    """
+
+
+def _is_record_list(value):
+    if not isinstance(value, list):
+        return False
+    ids = []
+    for item in value:
+        if not isinstance(item, dict) or 'id' not in item:
+            return False
+        ids.append(item['id'])
+    return len(ids) == len(set(ids))
+
+
+def _diff_records(pre, post):
+    """
+    Return the delta between two lists of records, or None if they
+    are the same.
+    """
+    pre_by_id = dict((r['id'], r) for r in pre)
+    post_ids = set(r['id'] for r in post)
+
+    created, updated = [], []
+    for record in post:
+        previous = pre_by_id.get(record['id'])
+        if previous is None:
+            created.append(record)
+            continue
+        fields = {}
+        for name, value in record.items():
+            if name not in previous or previous[name] != value:
+                fields[name] = value
+        removed = [name for name in previous if name not in record]
+        if fields or removed:
+            update = {
+                'id': record['id'],
+                'consistency_token': record.get('consistency_token'),
+                'previous_consistency_token': previous.get('consistency_token'),
+                'fields': fields,
+            }
+            if removed:
+                update['removed'] = removed
+            updated.append(update)
+    deleted = [r['id'] for r in pre if r['id'] not in post_ids]
+
+    delta = {}
+    if created:
+        delta['created'] = created
+    if updated:
+        delta['updated'] = updated
+    if deleted:
+        delta['deleted'] = deleted
+
+    expected = [r['id'] for r in pre if r['id'] in post_ids]
+    expected += [r['id'] for r in created]
+    if expected != [r['id'] for r in post]:
+        delta['order'] = [r['id'] for r in post]
+    return delta or None
+
+
+def diff(pre, post):
+    """
+    Return the delta between two serialisations PRE and POST of the
+    same episode or patient. An empty delta means nothing changed.
+    """
+    delta = {}
+    fields, records, nested = {}, {}, {}
+
+    for name, value in post.items():
+        if name not in pre:
+            fields[name] = value
+            continue
+        previous = pre[name]
+        if previous == value:
+            continue
+        if _is_record_list(previous) and _is_record_list(value):
+            changes = _diff_records(previous, value)
+            if changes is not None:
+                records[name] = changes
+        elif isinstance(previous, dict) and isinstance(value, dict):
+            nested[name] = diff(previous, value)
+        else:
+            fields[name] = value
+
+    removed = [name for name in pre if name not in post]
+
+    if fields:
+        delta['fields'] = fields
+    if removed:
+        delta['removed'] = removed
+    if records:
+        delta['records'] = records
+    if nested:
+        delta['nested'] = nested
+    return delta
+
+
+def _apply_records(records, delta):
+    by_id = dict((r['id'], dict(r)) for r in records)
+    order = [r['id'] for r in records]
+
+    for record_id in delta.get('deleted', []):
+        if record_id not in by_id:
+            raise DeltaConflict('Record {0} does not exist'.format(record_id))
+        del by_id[record_id]
+        order.remove(record_id)
+
+    for update in delta.get('updated', []):
+        record = by_id.get(update['id'])
+        if record is None:
+            raise DeltaConflict('Record {0} does not exist'.format(update['id']))
+        if record.get('consistency_token') != update['previous_consistency_token']:
+            raise DeltaConflict('Record {0} has changed'.format(update['id']))
+        for name in update.get('removed', []):
+            record.pop(name, None)
+        record.update(update['fields'])
+
+    for record in delta.get('created', []):
+        by_id[record['id']] = dict(record)
+        order.append(record['id'])
+
+    order = delta.get('order', order)
+    return [by_id[record_id] for record_id in order]
+
+
+def apply(state, delta):
+    """
+    Return a new serialisation made by applying DELTA to STATE.
+
+    Raise DeltaConflict if DELTA was not made from STATE.
+    """
+    new = dict(state)
+    for name in delta.get('removed', []):
+        new.pop(name, None)
+    new.update(delta.get('fields', {}))
+    for name, records in delta.get('records', {}).items():
+        new[name] = _apply_records(state.get(name, []), records)
+    for name, nested in delta.get('nested', {}).items():
+        new[name] = apply(state.get(name, {}), nested)
+    return new
+
+
+class StateConsumer(object):
+    """
+    A reference consumer of Glossolalia events.
+
+    Keeps the full serialisation of every episode and patient it has
+    heard about, keyed by the 'record' of each message ('episode:1',
+    'patient:3'), rebuilding it from the deltas sent in delta mode.
+    """
+    def __init__(self):
+        self.states = {}
+
+    def receive(self, event, data):
+        """
+        Given the EVENT name and decoded DATA of a message, update and
+        return the state it refers to.
+
+        Return None if it is a delta for a record we don't have: the
+        consumer should fetch that record from the API.
+        """
+        key = data.get('record')
+        if 'delta' in data:
+            if key not in self.states:
+                return None
+            self.states[key] = apply(self.states[key], data['delta'])
+        elif 'post' in data:
+            self.states[key] = data['post']
+        elif 'episode' in data:
+            self.states[key] = data['episode']
+        return self.states.get(key)
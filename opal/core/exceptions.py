@@ -2,3 +2,5 @@ class Error(Exception): pass
 class APIError(Error): pass
 class ConsistencyError(Error): pass
 class FTWLarryError(Error): pass
+class SearchError(Error): pass
+class ExtractError(Error): pass
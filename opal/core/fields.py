@@ -1,5 +1,6 @@
 from django.db.models import ForeignKey, CharField
-from django.contrib.contenttypes.models import ContentType
+
+from opal.core import lookuplists
 
 class ForeignKeyOrFreeText(property):
     """Field-like object that stores either foreign key or free text.
@@ -29,43 +30,45 @@ class ForeignKeyOrFreeText(property):
         ft_field = CharField(max_length=255, blank=True, null=True, default='')
         ft_field.contribute_to_class(cls, self.ft_field_name)
 
+    def _resolve(self, val):
+        """
+        Return a (name, id) pair for VAL, following synonyms, where id is
+        None for free text. Uses the lookuplist cache where we can.
+        """
+        try:
+            return lookuplists.cache.resolve(self.foreign_model, val)
+        except KeyError:
+            return lookuplists.lookup(self.foreign_model, val)
+
     def __set__(self, inst, val):
         if val is None:
             return
-        # This is totally not the right place to look up synonyms...
-        vals = []
-        content_type = ContentType.objects.get_for_model(self.foreign_model)
-        for val in val.split(','):
-            val = val.strip()
-            try:
-                from opal.models import Synonym
-                synonym = Synonym.objects.get(content_type=content_type, name=val)
-                vals.append(synonym.content_object.name)
-            except Synonym.DoesNotExist:
-                vals.append(val)
+        vals = [self._resolve(v.strip()) for v in val.split(',')]
 
         if len(vals) > 1:
-            setattr(inst, self.ft_field_name, ', '.join(vals))
+            setattr(inst, self.ft_field_name, ', '.join(v[0] for v in vals))
             setattr(inst, self.fk_field_name, None)
         else:
-            val = vals[0]
-            try:
-                foreign_obj = self.foreign_model.objects.get(name=val)
+            name, pk = vals[0]
+            if pk is None:
+                setattr(inst, self.ft_field_name, name)
+                setattr(inst, self.fk_field_name, None)
+            else:
+                foreign_obj = self.foreign_model(id=pk, name=name)
                 setattr(inst, self.fk_field_name, foreign_obj)
                 setattr(inst, self.ft_field_name, '')
-            except self.foreign_model.DoesNotExist:
-                setattr(inst, self.ft_field_name, val)
-                setattr(inst, self.fk_field_name, None)
 
     def __get__(self, inst, cls):
         if inst is None:
             return self
+        fk_id = getattr(inst, self.fk_field_name + '_id', None)
+        if fk_id is None:
+            return getattr(inst, self.ft_field_name)
+        name = lookuplists.cache.name_for_id(self.foreign_model, fk_id)
+        if name is not None:
+            return name
         try:
             foreign_obj = getattr(inst, self.fk_field_name)
         except:
             return 'Unknown Lookuplist Entry'
-#        foreign_obj = getattr(inst, self.fk_field_name)
-        if foreign_obj is None:
-            return getattr(inst, self.ft_field_name)
-        else:
-            return foreign_obj.name
+        return foreign_obj.name
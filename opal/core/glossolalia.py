@@ -1,33 +1,325 @@
 """
 Glossolalia Integration for OPAL
+
+Outbound events are appended to a spool table (GlossolaliaMessage)
+within the request, and delivered upstream by a worker draining that
+spool - see the glossolalia_worker management command.
 """
+import collections
+import datetime
+import json
+import logging
+import threading
+import time
+
 from django.conf import settings
+from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
-import json
+from django.db.models import Min
+from django.utils import timezone
 import requests
+from requests.adapters import HTTPAdapter
+
+from opal.core import deltas
 
 INTEGRATING  = settings.INTEGRATING
 NAME         = getattr(settings, 'GLOSSOLALIA_NAME', '')
 ENDPOINT     = getattr(settings, 'GLOSSOLALIA_URL', '') + 'api/v0.1/accept/'
 OUR_ENDPOINT = settings.DEFAULT_DOMAIN
 
-def _send_upstream_message(event, payload):
+BATCH_SIZE   = getattr(settings, 'GLOSSOLALIA_BATCH_SIZE', 100)
+BACKOFF      = getattr(settings, 'GLOSSOLALIA_BACKOFF', 5)
+MAX_BACKOFF  = getattr(settings, 'GLOSSOLALIA_MAX_BACKOFF', 60 * 60)
+
+CONNECT_TIMEOUT   = getattr(settings, 'GLOSSOLALIA_CONNECT_TIMEOUT', 3.05)
+READ_TIMEOUT      = getattr(settings, 'GLOSSOLALIA_READ_TIMEOUT', 10)
+POOL_SIZE         = getattr(settings, 'GLOSSOLALIA_POOL_SIZE', 10)
+BREAKER_THRESHOLD = getattr(settings, 'GLOSSOLALIA_BREAKER_THRESHOLD', 5)
+BREAKER_RESET     = getattr(settings, 'GLOSSOLALIA_BREAKER_RESET', 30)
+
+DELTAS            = getattr(settings, 'GLOSSOLALIA_DELTAS', False)
+
+STATS_KEY         = 'opal.glossolalia.send_stats'
+STATS_TIMEOUT     = getattr(settings, 'GLOSSOLALIA_STATS_TIMEOUT', 5 * 60)
+
+
+class CircuitOpenError(requests.RequestException):
+    """
+    Raised instead of sending when the circuit breaker is open.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Stop talking to an upstream service that keeps failing.
+
+    After THRESHOLD consecutive failures the breaker opens and sends are
+    refused. Once RESET seconds have passed we let a single probe through
+    (half open): if it succeeds the breaker closes, otherwise it opens
+    again.
+    """
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half open'
+
+    def __init__(self, threshold, reset):
+        self.threshold = threshold
+        self.reset = reset
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return True if we may send a message now.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    logging.warning('Glossolalia circuit breaker open')
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opened_at': self.opened_at,
+        }
+
+
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET)
+
+_session = None
+_latency = collections.defaultdict(
+    lambda: {'sent': 0, 'failed': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+
+def get_session():
+    """
+    Return the keep-alive session we use to talk to our upstream service.
+    """
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session = session
+    return _session
+
+def _record_latency(event, seconds, ok):
+    stats = _latency[event]
+    stats['sent' if ok else 'failed'] += 1
+    stats['total'] += seconds
+    stats['last'] = seconds
+    stats['max'] = max(stats['max'], seconds)
+
+def _ordering_key(record):
+    """
+    Return the key we order messages about a serialised episode or
+    patient RECORD by, or '' if they need not be ordered.
+    """
+    try:
+        if 'episodes' in record:
+            return 'patient:{0}'.format(record['id'])
+        return 'episode:{0}'.format(record['id'])
+    except (TypeError, KeyError):
+        return ''
+
+def _send_upstream_message(event, payload, ordering_key=''):
+    """
+    Append a message to the spool for sending upstream
+    """
+    from opal.models import GlossolaliaMessage
+
+    GlossolaliaMessage.objects.create(
+        event=event,
+        ordering_key=ordering_key,
+        payload=json.dumps(payload)
+    )
+    return
+
+def _post_upstream_message(event, payload):
     """
-    Send a message upstream
+    Actually send a message upstream.
+
+    Raise requests.RequestException if it was not delivered, or
+    CircuitOpenError if we did not try.
     """
+    if not breaker.allow():
+        raise CircuitOpenError('Circuit breaker is open')
+    payload['servicetype'] = 'OPAL'
+    payload['event'] = event
+    payload['name'] = NAME
+    start = time.time()
     try:
-        payload['servicetype'] = 'OPAL'
-        payload['event'] = event
-        payload['name'] = NAME
-        r = requests.post(
+        r = get_session().post(
             ENDPOINT,
-            data=payload
+            data=payload,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
         )
-    except requests.ConnectionError:
-        # print 'Glossolalia Connection Error :('
-        return
+        r.raise_for_status()
+    except requests.RequestException:
+        _record_latency(event, time.time() - start, False)
+        breaker.record_failure()
+        raise
+    _record_latency(event, time.time() - start, True)
+    breaker.record_success()
     return
 
+def _backoff(attempts):
+    """
+    Return the number of seconds to wait before retrying a message
+    that has failed ATTEMPTS times.
+    """
+    return min(MAX_BACKOFF, BACKOFF * 2 ** (attempts - 1))
+
+def drain(batch_size=None):
+    """
+    Send the messages in the spool that are due, oldest first,
+    returning a (sent, failed) pair of counts.
+
+    Messages for an episode (or patient) are sent in the order they
+    were created: once a message fails, later messages for the same
+    episode wait until it has been delivered.
+
+    We stop early, without counting an attempt, if the circuit
+    breaker is open.
+    """
+    from opal.models import GlossolaliaMessage
+
+    if batch_size is None:
+        batch_size = BATCH_SIZE
+    now = timezone.now()
+    waiting = GlossolaliaMessage.objects.filter(
+        next_attempt__gt=now).exclude(ordering_key='')
+    blocked = set(waiting.values_list('ordering_key', flat=True))
+    due = GlossolaliaMessage.objects.filter(next_attempt__lte=now).exclude(
+        ordering_key__in=blocked)[:batch_size]
+
+    sent, failed = 0, 0
+    for message in due:
+        if message.ordering_key in blocked:
+            continue
+        try:
+            _post_upstream_message(message.event, json.loads(message.payload))
+        except CircuitOpenError:
+            break
+        except requests.RequestException as e:
+            message.attempts += 1
+            message.next_attempt = timezone.now() + datetime.timedelta(
+                seconds=_backoff(message.attempts))
+            message.last_error = str(e)
+            message.save()
+            logging.warning('Glossolalia message {0} failed: {1}'.format(
+                message.id, e))
+            if message.ordering_key:
+                blocked.add(message.ordering_key)
+            failed += 1
+        else:
+            message.delete()
+            sent += 1
+    return sent, failed
+
+def queue_stats():
+    """
+    Return monitoring information about the spool:
+
+    depth: the number of messages waiting to be sent
+    retrying: how many of those have failed at least once
+    lag: the age in seconds of the oldest waiting message
+    """
+    from opal.models import GlossolaliaMessage
+
+    messages = GlossolaliaMessage.objects.all()
+    oldest = messages.aggregate(oldest=Min('created'))['oldest']
+    lag = 0
+    if oldest is not None:
+        lag = (timezone.now() - oldest).total_seconds()
+    return {
+        'depth': messages.count(),
+        'retrying': messages.filter(attempts__gt=0).count(),
+        'lag': lag,
+    }
+
+def snapshot(record, user):
+    """
+    Return RECORD serialised for USER if there is anyone upstream
+    to pass changes on to, otherwise None.
+
+    Use this to take the pre and post snapshots passed to change()
+    and transfer() so that we don't serialise when not integrating.
+    """
+    if not INTEGRATING:
+        return None
+    return record.to_dict(user)
+
+def send_stats():
+    """
+    Return monitoring information about sending messages upstream:
+
+    breaker: the state of the circuit breaker
+    latency: for each event, the number sent and failed, and the total,
+    maximum and most recent time taken in seconds
+    """
+    return {
+        'breaker': breaker.to_dict(),
+        'latency': dict((k, dict(v)) for k, v in _latency.items()),
+    }
+
+def publish_send_stats():
+    """
+    Store this process's send_stats() in the cache, so that other
+    processes (e.g. glossolalia_worker --stats) can read them with
+    published_send_stats(), and return them.
+
+    They expire after GLOSSOLALIA_STATS_TIMEOUT seconds, so a worker
+    that has died stops reporting.
+    """
+    stats = send_stats()
+    stats['published'] = time.time()
+    cache.set(STATS_KEY, stats, STATS_TIMEOUT)
+    return stats
+
+def published_send_stats():
+    """
+    Return the send stats last published by the worker, or None.
+    """
+    return cache.get(STATS_KEY)
+
+def _change_data(pre, post):
+    """
+    Return the data for a change or transfer message: either both
+    snapshots or, in delta mode, the delta between them.
+    """
+    data = {
+        'endpoint': OUR_ENDPOINT,
+        'record': _ordering_key(post),
+    }
+    if DELTAS:
+        data['delta'] = deltas.diff(pre, post)
+    else:
+        data['pre'] = pre
+        data['post'] = post
+    return data
+
 def admit(episode):
     """
     We have admitted a patient - pass on the message to whatever
@@ -39,10 +331,11 @@ def admit(episode):
         'data': json.dumps(
             {
                 'episode': episode,
-                'endpoint': OUR_ENDPOINT
+                'endpoint': OUR_ENDPOINT,
+                'record': _ordering_key(episode),
         }, cls=DjangoJSONEncoder)
     }
-    _send_upstream_message('admit', payload)
+    _send_upstream_message('admit', payload, ordering_key=_ordering_key(episode))
     return
 
 def discharge(episode):
@@ -55,10 +348,11 @@ def discharge(episode):
     payload = {
         'data': json.dumps({
             'episode': episode,
-            'endpoint': OUR_ENDPOINT
+            'endpoint': OUR_ENDPOINT,
+            'record': _ordering_key(episode),
         }, cls=DjangoJSONEncoder)
     }
-    _send_upstream_message('discharge', payload)
+    _send_upstream_message('discharge', payload, ordering_key=_ordering_key(episode))
     return
 
 def transfer(pre, post):
@@ -69,13 +363,9 @@ def transfer(pre, post):
     if not INTEGRATING:
         return
     payload = {'data':
-               json.dumps({
-                   'endpoint': OUR_ENDPOINT,
-                   'pre': pre, 
-                   'post': post,
-               }, cls=DjangoJSONEncoder)
+               json.dumps(_change_data(pre, post), cls=DjangoJSONEncoder)
     }
-    _send_upstream_message('transfer', payload)
+    _send_upstream_message('transfer', payload, ordering_key=_ordering_key(post))
     return
 
 def change(pre, post):
@@ -86,11 +376,7 @@ def change(pre, post):
     if not INTEGRATING:
         return
     payload = {'data':
-               json.dumps({
-                   'endpoint': OUR_ENDPOINT,
-                   'pre': pre, 
-                   'post': post,
-               }, cls=DjangoJSONEncoder)
+               json.dumps(_change_data(pre, post), cls=DjangoJSONEncoder)
     }
-    _send_upstream_message('change', payload)
+    _send_upstream_message('change', payload, ordering_key=_ordering_key(post))
     return
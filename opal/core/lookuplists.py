@@ -1,7 +1,12 @@
 """
 OPAL Lookuplists
 """
+import threading
+import time
+
+from django.conf import settings
 from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
 # class LookupList(models.Model):
@@ -24,6 +29,156 @@ class LookupList(models.Model):
         return self.name
 
 
+class LookupListCache(object):
+    """
+    An in-process cache of the names, ids and synonyms of lookuplist
+    entries, keyed by lookuplist model.
+
+    Each lookuplist is loaded in two queries the first time it is needed
+    and then kept until it is invalidated (saving or deleting an entry or
+    one of its synonyms does this via signals) or it expires.
+
+    Lookuplists with more than OPAL_LOOKUPLIST_CACHE_MAX_SIZE names and
+    synonyms are not cached - callers get None and should go to the
+    database. We remember that they are too large, under the same expiry
+    and invalidation rules, so that we don't try to load them every time.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'OPAL_LOOKUPLIST_CACHE_MAX_SIZE', 10000)
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'OPAL_LOOKUPLIST_CACHE_TIMEOUT', 300)
+
+    def _too_large(self):
+        return {'expires': time.time() + self.timeout, 'too_large': True}
+
+    def _load(self, model):
+        from opal.models import Synonym
+
+        entries = model.objects.values_list('id', 'name')[:self.max_size + 1]
+        names = dict(entries)
+        if len(names) > self.max_size:
+            return self._too_large()
+        content_type = ContentType.objects.get_for_model(model)
+        synonyms = {}
+        remaining = self.max_size - len(names) + 1
+        for name, object_id in Synonym.objects.filter(
+                content_type=content_type).values_list(
+                    'name', 'object_id')[:remaining]:
+            if object_id in names:
+                synonyms[name] = names[object_id]
+        if len(names) + len(synonyms) > self.max_size:
+            return self._too_large()
+        return {
+            'expires': time.time() + self.timeout,
+            'names': names,
+            'ids': dict((name, pk) for pk, name in names.items()),
+            'synonyms': synonyms,
+        }
+
+    def get(self, model):
+        """
+        Return the cached entry for MODEL, loading it if required, or
+        None if MODEL is too large to cache.
+        """
+        entry = self._entries.get(model)
+        if entry is None or entry['expires'] <= time.time():
+            entry = self._load(model)
+            with self._lock:
+                self._entries[model] = entry
+        if entry.get('too_large'):
+            return None
+        return entry
+
+    def name_for_id(self, model, pk):
+        """
+        Return the name of the MODEL entry with PK, or None if we don't know.
+        """
+        entry = self.get(model)
+        if entry is None:
+            return None
+        return entry['names'].get(pk)
+
+    def resolve(self, model, name):
+        """
+        Given a NAME that may be a synonym, return a (name, id) pair for
+        the MODEL entry it refers to. The id is None when NAME is free
+        text.
+
+        Names we don't know are looked up in the database, as they may
+        have been added by another process, and if found the cached
+        entry is reloaded.
+
+        Raises KeyError if MODEL is not cached.
+        """
+        entry = self.get(model)
+        if entry is None:
+            raise KeyError(model)
+        resolved = entry['synonyms'].get(name, name)
+        pk = entry['ids'].get(resolved)
+        if pk is not None:
+            return resolved, pk
+        resolved, pk = lookup(model, name)
+        if pk is not None:
+            self.invalidate(model)
+            self.get(model)
+        return resolved, pk
+
+    def invalidate(self, model=None):
+        """
+        Forget MODEL, or everything if MODEL is None.
+        """
+        with self._lock:
+            if model is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(model, None)
+
+
+cache = LookupListCache()
+
+
+def lookup(model, name):
+    """
+    Given a NAME that may be a synonym, return a (name, id) pair for
+    the MODEL entry it refers to from the database. The id is None when
+    NAME is free text.
+    """
+    from opal.models import Synonym
+
+    content_type = ContentType.objects.get_for_model(model)
+    try:
+        synonym = Synonym.objects.get(content_type=content_type, name=name)
+        name = synonym.content_object.name
+    except Synonym.DoesNotExist:
+        pass
+    try:
+        return name, model.objects.get(name=name).id
+    except model.DoesNotExist:
+        return name, None
+
+
+def invalidate_cache(sender, instance, **kwargs):
+    """
+    Signal receiver dropping the cached entries for a lookuplist
+    when one of its entries or synonyms changes.
+    """
+    from opal.models import Synonym
+
+    if issubclass(sender, LookupList):
+        cache.invalidate(sender)
+    elif issubclass(sender, Synonym):
+        model = ContentType.objects.get_for_id(
+            instance.content_type_id).model_class()
+        cache.invalidate(model)
+
+
 # def lookup_list(name, module=__name__):
 #     """
 #     Given the name of a lookup list, return the tuple of class_name, bases, attrs
@@ -0,0 +1,79 @@
+"""
+Keyset (cursor) pagination for OPAL list endpoints
+
+Pages are walked in primary key order, and the cursor records the last
+primary key we returned. Fetching a page is therefore an indexed range
+scan, and page 1000 costs the same as page 1.
+"""
+import base64
+import json
+
+from opal.core import exceptions
+
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(pk):
+    """
+    Return an opaque cursor pointing after PK.
+    """
+    return base64.urlsafe_b64encode(json.dumps({'pk': pk}))
+
+
+def decode_cursor(cursor):
+    """
+    Return the primary key that CURSOR points after.
+
+    Raise APIError if this isn't a cursor we issued.
+    """
+    try:
+        pk = json.loads(base64.urlsafe_b64decode(str(cursor)))['pk']
+    except (TypeError, ValueError, KeyError):
+        raise exceptions.APIError('Invalid cursor')
+    if not isinstance(pk, (int, long)):
+        raise exceptions.APIError('Invalid cursor')
+    return pk
+
+
+def get_page_params(params):
+    """
+    Given the query PARAMS of a request, return a (page_size, cursor)
+    tuple, or None if the client didn't ask for pagination.
+
+    Raise APIError for invalid page sizes or cursors.
+    """
+    if 'page_size' not in params and 'cursor' not in params:
+        return None
+
+    try:
+        page_size = int(params.get('page_size', MAX_PAGE_SIZE))
+    except ValueError:
+        raise exceptions.APIError('Invalid page_size')
+    if page_size < 1:
+        raise exceptions.APIError('Invalid page_size')
+    page_size = min(page_size, MAX_PAGE_SIZE)
+
+    cursor = params.get('cursor', None)
+    if cursor:
+        cursor = decode_cursor(cursor)
+    else:
+        cursor = None
+    return page_size, cursor
+
+
+def paginate(queryset, page_size, cursor=None):
+    """
+    Return a tuple of (page, next_cursor) for QUERYSET, where PAGE is
+    a list of at most PAGE_SIZE instances after the primary key CURSOR,
+    and NEXT_CURSOR is None when there are no more pages.
+    """
+    queryset = queryset.order_by('pk')
+    if cursor is not None:
+        queryset = queryset.filter(pk__gt=cursor)
+
+    page = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = encode_cursor(page[-1].pk)
+    return page, next_cursor
@@ -1,52 +1,359 @@
 """
 Utilities for extracting data from OPAL
+
+Extracts are zip archives of CSV files. The CSV rows are generated from
+database iterators and compressed into the archive as they are
+produced, so an extract can be streamed to the client (or written to a
+single file) without temporary files or holding it in memory.
 """
+from collections import defaultdict
 import datetime
 import csv
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import shutil
+import struct
 import tempfile
-import zipfile
-import functools
+import time
+import zlib
+
+from django.conf import settings
+from django.db import connection, connections
+from django.db.models import Max
+from django.db.models.query import QuerySet
 
+from opal.core.exceptions import SearchError
 from opal.models import Episode
-from opal.core.subrecords import episode_subrecords, patient_subrecords
+from opal.core.subrecords import (episode_subrecords, patient_subrecords,
+                                  get_subrecord_from_api_name)
 
+# How many rows we read from the database at once
+CHUNK_SIZE = getattr(settings, 'OPAL_EXTRACT_CHUNK_SIZE', 1000)
 
-def subrecord_csv(episodes, subrecord, file_name):
+# How many CSVs we build at once, and whether in threads or processes
+EXTRACT_WORKERS = getattr(settings, 'OPAL_EXTRACT_WORKERS', 1)
+EXTRACT_POOL    = getattr(settings, 'OPAL_EXTRACT_POOL', 'thread')
+
+
+class _Echo(object):
     """
-    Given an iterable of EPISODES, the SUBRECORD we want to serialise,
-    write a csv file for the data in this subrecord for these episodes.
+    A file-like object for csv.writer that hands back each line
+    rather than storing it.
+    """
+    def write(self, value):
+        return value
+
+
+def _csv_lines(rows):
+    """
+    Generator function that yields each of ROWS as a line of CSV.
     """
+    writer = csv.writer(_Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _write_csv(file_name, rows):
     with open(file_name, "w") as csv_file:
         writer = csv.writer(csv_file)
-        field_names = subrecord._get_fieldnames_to_extract()
+        for row in rows:
+            writer.writerow(row)
+
+
+def _deflate(chunks, sizes):
+    """
+    Generator function that yields the byte strings CHUNKS compressed as
+    a raw deflate stream. Once it is exhausted, the crc, size and
+    compressed_size of the content are stored in the dict SIZES.
+    """
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc, size, compressed_size = 0, 0, 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        data = compressor.compress(chunk)
+        if data:
+            compressed_size += len(data)
+            yield data
+    data = compressor.flush()
+    compressed_size += len(data)
+    yield data
+    sizes.update(
+        crc=crc & 0xffffffff, size=size, compressed_size=compressed_size)
+
+
+class ZipStream(object):
+    """
+    Write a zip archive as a sequence of byte strings.
+
+    Each member is deflated as its content is produced, and its CRC and
+    sizes are written after the data (in a data descriptor), so we never
+    need to seek back or hold a whole member in memory.
+
+    We don't write Zip64 records, so members and the archive must be
+    smaller than 4GB.
+    """
+    LOCAL_HEADER      = struct.Struct('<IHHHHHIIIHH')
+    DATA_DESCRIPTOR   = struct.Struct('<IIII')
+    CENTRAL_DIRECTORY = struct.Struct('<IHHHHHHIIIHHHHHII')
+    END_OF_DIRECTORY  = struct.Struct('<IHHHHIIH')
+
+    FLAGS = 0x08 | 0x800  # data descriptor, UTF-8 names
+
+    def __init__(self):
+        self.offset = 0
+        self.members = []
+
+    def _dos_timestamp(self):
+        t = time.localtime()
+        dos_date = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+        dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+        return dos_time, dos_date
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def member(self, name, chunks):
+        """
+        Generator function that yields a member of the archive called NAME
+        whose content is the byte strings CHUNKS.
+        """
+        sizes = {}
+        return self.deflated_member(name, _deflate(chunks, sizes), sizes)
+
+    def deflated_member(self, name, data, sizes):
+        """
+        Generator function that yields a member of the archive called NAME
+        whose content has already been compressed by _deflate() into the
+        byte strings DATA, filling in SIZES.
+        """
+        if isinstance(name, unicode):
+            name = name.encode('UTF-8')
+        dos_time, dos_date = self._dos_timestamp()
+        header_offset = self.offset
+        yield self._emit(self.LOCAL_HEADER.pack(
+            0x04034b50, 20, self.FLAGS, zlib.DEFLATED, dos_time, dos_date,
+            0, 0, 0, len(name), 0) + name)
+
+        for chunk in data:
+            yield self._emit(chunk)
+        crc, size, compressed_size = (
+            sizes['crc'], sizes['size'], sizes['compressed_size'])
+        yield self._emit(self.DATA_DESCRIPTOR.pack(
+            0x08074b50, crc, compressed_size, size))
+
+        self.members.append((name, dos_time, dos_date, crc, compressed_size,
+                             size, header_offset))
+
+    def close(self):
+        """
+        Return the central directory that ends the archive.
+        """
+        start = self.offset
+        directory = []
+        for name, dos_time, dos_date, crc, compressed_size, size, offset in self.members:
+            directory.append(self.CENTRAL_DIRECTORY.pack(
+                0x02014b50, 20, 20, self.FLAGS, zlib.DEFLATED, dos_time,
+                dos_date, crc, compressed_size, size, len(name), 0, 0, 0, 0,
+                0o644 << 16, offset) + name)
+        directory = ''.join(directory)
+        return self._emit(directory + self.END_OF_DIRECTORY.pack(
+            0x06054b50, 0, 0, len(self.members), len(self.members),
+            len(directory), start, 0))
+
+
+def _episode_ids(episodes):
+    """
+    Return something we can filter on with episode_id__in: a subquery
+    for a queryset of EPISODES, or a list of ids for other iterables.
+    """
+    if isinstance(episodes, QuerySet):
+        return episodes.values('id')
+    return [e.id for e in episodes]
+
+
+def _encode(value):
+    return unicode(value).encode('UTF-8')
+
+
+def _value_chunks(model, queryset, field_names, extra=()):
+    """
+    Generator function that yields lists of at most CHUNK_SIZE rows of
+    QUERYSET, in primary key order, as (values, fields) pairs. VALUES is
+    the dict of the id and EXTRA lookups, and FIELDS a dict of the
+    extract value for each of FIELD_NAMES.
+
+    Foreign Key or Free Text names are resolved with a join, and many to
+    many fields with one query per chunk, so the cost of each row is
+    constant.
+    """
+    plan = model._get_serialization_plan()
+    lookups = ['id'] + list(extra)
+    many_to_many = []
+    for name in field_names:
+        if name in plan.fkft:
+            lookups += [name + '_fk__name', name + '_ft']
+        elif name in plan.many_to_many:
+            many_to_many.append(name)
+        else:
+            lookups.append(name)
+
+    queryset = queryset.order_by('id')
+    last_id = None
+    while True:
+        chunk = queryset
+        if last_id is not None:
+            chunk = chunk.filter(id__gt=last_id)
+        chunk = list(chunk.values(*lookups)[:CHUNK_SIZE])
+        if not chunk:
+            return
+        ids = [values['id'] for values in chunk]
+
+        related = defaultdict(lambda: defaultdict(list))
+        for name in many_to_many:
+            for pk, related_name in model.objects.filter(id__in=ids).exclude(
+                    **{name: None}).values_list('id', name + '__name'):
+                related[name][pk].append(related_name)
+
+        rows = []
+        for values in chunk:
+            fields = {}
+            for name in field_names:
+                if name in plan.fkft:
+                    fk_name = values[name + '_fk__name']
+                    fields[name] = values[name + '_ft'] if fk_name is None else fk_name
+                elif name in many_to_many:
+                    fields[name] = ';'.join(sorted(related[name][values['id']]))
+                else:
+                    fields[name] = values[name]
+            rows.append((values, fields))
+        yield rows
+        last_id = ids[-1]
+
+
+def _selected(field_names, fields, keep):
+    """
+    Return those of FIELD_NAMES that are in FIELDS or KEEP, or all of
+    them if FIELDS is None.
+    """
+    if fields is None:
+        return field_names
+    return [f for f in field_names if f in fields or f in keep]
+
+
+def subrecord_rows(episodes, subrecord, fields=None):
+    """
+    Generator function yielding the CSV header and then rows for the
+    SUBRECORD data of these EPISODES.
+
+    If FIELDS is a list, only those fields (and the episode id) are
+    extracted.
+    """
+    field_names = list(subrecord._get_serialization_plan().extract_fieldnames)
+
+    for fname in ['consistency_token', 'id']:
+        if fname in field_names:
+            field_names.remove(fname)
+    field_names = _selected(field_names, fields, ['episode_id'])
+
+    yield field_names
+    subrecords = subrecord.objects.filter(episode_id__in=_episode_ids(episodes))
+    for chunk in _value_chunks(subrecord, subrecords, field_names):
+        for values, fields in chunk:
+            yield [_encode(fields[f]) for f in field_names]
+
+
+def episode_rows(episodes, user, tagging=True):
+    """
+    Generator function yielding the CSV header and then rows of Episode
+    details for these EPISODES.
+
+    TAGGING may be False to leave out the tagging column, or a list of
+    the only team names to include in it.
+    """
+    from opal.models import Tagging
+
+    fieldnames = list(Episode._get_serialization_plan().fieldnames)
+    fieldnames.remove('consistency_token')
+    if tagging is False:
+        yield fieldnames
+    else:
+        yield fieldnames + ["tagging"]
+
+    user_id = getattr(user, 'id', None)
+    queryset = Episode.objects.filter(id__in=_episode_ids(episodes))
+
+    for chunk in _value_chunks(Episode, queryset, fieldnames):
+        if tagging is False:
+            for values, fields in chunk:
+                yield [_encode(fields[h]) for h in fieldnames]
+            continue
+
+        ids = [values['id'] for values, fields in chunk]
+        tags = Tagging.historic_tags_for_episodes(ids)
+        for episode_id, tag_name, tag_user_id in Tagging.objects.filter(
+                episode_id__in=ids, team__isnull=False
+        ).values_list('episode_id', 'team__name', 'user_id'):
+            if tag_user_id in (None, user_id):
+                tags[episode_id][tag_name] = True
+        for values, fields in chunk:
+            row = [_encode(fields[h]) for h in fieldnames]
+            names = tags[values['id']]
+            if tagging is not True:
+                names = [n for n in names if n in tagging]
+            row.append(';'.join(sorted(names)))
+            yield row
+
+
+def patient_subrecord_rows(episodes, subrecord, fields=None):
+    """
+    Generator function yielding the CSV header and then rows for the
+    patient SUBRECORD data of these EPISODES.
+
+    Each row is labelled with the patient's most recent episode among
+    EPISODES. If FIELDS is a list, only those fields are extracted.
+    """
+    field_names = list(subrecord._get_serialization_plan().extract_fieldnames)
 
-        for fname in ['consistency_token', 'id']:
-            if fname in field_names:
-                field_names.remove(fname)
+    for fname in ['consistency_token', 'patient_id', 'id']:
+        if fname in field_names:
+            field_names.remove(fname)
+    field_names = _selected(field_names, fields, [])
 
-        writer.writerow(field_names)
-        subrecords = subrecord.objects.filter(episode__in=episodes)
-        for sub in subrecords:
-            writer.writerow([unicode(getattr(sub, f)).encode('UTF-8') for f in field_names])
+    yield ["episode_id"] + field_names
+
+    episodes = Episode.objects.filter(id__in=_episode_ids(episodes))
+    subs = subrecord.objects.filter(patient_id__in=episodes.values('patient_id'))
+
+    for chunk in _value_chunks(subrecord, subs, field_names, extra=['patient_id']):
+        patient_ids = set(values['patient_id'] for values, fields in chunk)
+        patient_to_episode = dict(episodes.filter(
+            patient_id__in=patient_ids
+        ).order_by().values('patient_id').annotate(
+            episode_id=Max('id')).values_list('patient_id', 'episode_id'))
+        for values, fields in chunk:
+            row = [patient_to_episode[values['patient_id']]]
+            row.extend(_encode(fields[f]) for f in field_names)
+            yield row
+
+
+def subrecord_csv(episodes, subrecord, file_name):
+    """
+    Given an iterable of EPISODES, the SUBRECORD we want to serialise,
+    write a csv file for the data in this subrecord for these episodes.
+    """
+    _write_csv(file_name, subrecord_rows(episodes, subrecord))
 
 
 def episode_csv(episodes, user, file_name):
     """
     Given an iterable of EPISODES, create a CSV file containing Episode details.
     """
-    with open(file_name, "w") as csv_file:
-        fieldnames = Episode._get_fieldnames_to_serialize()
-        fieldnames.remove('consistency_token')
-        headers = list(fieldnames)
-        headers.append("tagging")
-        writer = csv.DictWriter(csv_file, fieldnames=headers)
-        writer.writeheader()
-
-        for episode in episodes:
-            row = {h: unicode(getattr(episode, h)).encode('UTF-8') for h in fieldnames}
-            row["tagging"] = ';'.join(episode.get_tag_names(user, historic=True))
-            writer.writerow(row)
+    _write_csv(file_name, episode_rows(episodes, user))
 
 
 def patient_subrecord_csv(episodes, subrecord, file_name):
@@ -54,70 +361,308 @@ def patient_subrecord_csv(episodes, subrecord, file_name):
     Given an iterable of EPISODES, and the patient SUBRECORD we want to
     create a CSV file for the data in this subrecord for these episodes.
     """
-    with open(file_name, "w") as csv_file:
-        field_names = subrecord._get_fieldnames_to_extract()
-        writer = csv.writer(csv_file)
+    _write_csv(file_name, patient_subrecord_rows(episodes, subrecord))
 
-        for fname in ['consistency_token', 'patient_id', 'id']:
-            if fname in field_names:
-                field_names.remove(fname)
 
-        patient_to_episode = {e.patient_id: e.id for e in episodes}
-        subs = subrecord.objects.filter(patient__in=patient_to_episode.keys())
+def validate_projection(projection):
+    """
+    Check that PROJECTION, a dict of column names from the extract
+    schema to lists of their field names (or None for every field),
+    only names things in the schema, returning it. Raise SearchError if
+    it doesn't.
 
-        headers = list(field_names)
-        headers.insert(0, "episode_id")
-        writer.writerow(headers)
+    Fields that are never extracted, such as PID, may be named but are
+    left out of the extract.
+    """
+    from opal.core import schemas
 
-        for sub in subs:
-            row = [patient_to_episode[sub.patient_id]]
-            row.extend(unicode(getattr(sub, f)).encode('UTF-8') for f in field_names)
-            writer.writerow(row)
+    if not isinstance(projection, dict):
+        raise SearchError('An extract projection should be an object')
+
+    available = dict(
+        (column['name'], set(f['name'] for f in column['fields']))
+        for column in schemas.extract_schema()
+    )
+
+    for name, fields in projection.items():
+        if name not in available:
+            raise SearchError('Unknown extract column: {0}'.format(name))
+        if fields is None:
+            continue
+        if not isinstance(fields, list):
+            raise SearchError(
+                'Extract fields for {0} should be a list'.format(name))
+        unknown = set(fields) - available[name]
+        if unknown:
+            raise SearchError('Unknown extract fields for {0}: {1}'.format(
+                name, ', '.join(sorted(unknown))))
+    return projection
 
 
-def zip_archive(episodes, description, user):
+def _selected_subrecords(subrecords, projection):
+    for subrecord in subrecords:
+        if projection is None or subrecord.get_api_name() in projection:
+            yield subrecord
+
+
+def _parts(projection=None):
     """
-    Given an iterable of EPISODES, the DESCRIPTION of this set of episodes,
-    and the USER for which we are extracting, create a zip archive suitable
-    for download with all of these episodes as CSVs.
+    Return the parts of an extract, as (file name, kind, subrecord api
+    name, fields) tuples.
+
+    If PROJECTION is a dict from validate_projection(), only the
+    subrecords (and fields) it names are included. Episodes are always
+    included, with the tagging column only if it names tagging.
+    """
+    if projection is None:
+        tagging = True
+    elif 'tagging' in projection:
+        tagging = projection['tagging']
+        if tagging is None:
+            tagging = True
+    else:
+        tagging = False
+    parts = [('episodes.csv', 'episode', None, tagging)]
+
+    for kind, subrecords in [('subrecord', episode_subrecords()),
+                             ('patient_subrecord', patient_subrecords())]:
+        for subrecord in _selected_subrecords(subrecords, projection):
+            api_name = subrecord.get_api_name()
+            fields = None
+            if projection is not None:
+                fields = projection[api_name]
+            parts.append(('{0}.csv'.format(api_name), kind, api_name, fields))
+    return parts
+
+
+def _rows(episodes, user, kind, api_name, fields):
+    if kind == 'episode':
+        return episode_rows(episodes, user, fields)
+    subrecord = get_subrecord_from_api_name(api_name)
+    if kind == 'subrecord':
+        return subrecord_rows(episodes, subrecord, fields)
+    return patient_subrecord_rows(episodes, subrecord, fields)
+
+
+def _counted(rows, progress):
+    """
+    Generator function that yields ROWS, calling PROGRESS with the
+    number of rows (not counting the header) produced every CHUNK_SIZE
+    rows and at the end.
     """
-    target_dir = tempfile.mkdtemp()
-    target = os.path.join(target_dir, 'extract.zip')
+    count = -1
+    for row in rows:
+        yield row
+        count += 1
+        if progress is not None and count and count % CHUNK_SIZE == 0:
+            progress(CHUNK_SIZE)
+    if progress is not None and count % CHUNK_SIZE:
+        progress(count % CHUNK_SIZE)
 
-    with zipfile.ZipFile(target, mode='w') as z:
-        zipfolder = '{0}.{1}'.format(user.username, datetime.date.today())
-        os.mkdir(os.path.join(target_dir, zipfolder))
-        make_file_path = functools.partial(os.path.join, target_dir, zipfolder)
-        zip_relative_file_path = functools.partial(os.path.join, zipfolder)
 
-        file_name = "episodes.csv"
-        full_file_name = make_file_path(file_name)
-        episode_csv(episodes, user, full_file_name)
-        z.write(full_file_name, zip_relative_file_path(file_name))
+def _timed(file_name, chunks, timings):
+    """
+    Generator function that yields CHUNKS, recording how long it took to
+    produce them against FILE_NAME.
+    """
+    started = time.time()
+    for chunk in chunks:
+        yield chunk
+    _record_timing(file_name, time.time() - started, timings)
 
-        for subrecord in episode_subrecords():
-            file_name = '{0}.csv'.format(subrecord.get_api_name())
-            full_file_name = make_file_path(file_name)
-            subrecord_csv(episodes, subrecord, full_file_name)
-            z.write(full_file_name, zip_relative_file_path(file_name))
 
-        for subrecord in patient_subrecords():
-            file_name = '{0}.csv'.format(subrecord.get_api_name())
-            full_file_name = make_file_path(file_name)
-            patient_subrecord_csv(episodes, subrecord, full_file_name)
-            z.write(full_file_name, zip_relative_file_path(file_name))
+def _record_timing(file_name, seconds, timings):
+    logging.info('Extracted {0} in {1:.2f}s'.format(file_name, seconds))
+    if timings is not None:
+        timings.append((file_name, seconds))
 
-        file_name = 'filter.txt'
-        full_file_name = make_file_path(file_name)
-        with open(full_file_name, 'w') as description_file:
-            description_file.write(description)
-        z.write(full_file_name, zip_relative_file_path(file_name))
 
-    return target
+def _build_part(part):
+    """
+    Pool worker that writes one part of an extract to a temporary file
+    in the extract's working directory as a raw deflate stream,
+    returning the file name, the temporary file's path, its sizes, the
+    number of rows and how long it took.
+
+    Each worker uses its own database connection, which we close when
+    we are done, as pool threads outlive the extract.
+    """
+    file_name, kind, api_name, fields, query, user, workdir = part
+    started = time.time()
+    counts = []
+    try:
+        episodes = Episode.objects.all()
+        episodes.query = query
+        sizes = {}
+        target = tempfile.NamedTemporaryFile(
+            prefix='extract', suffix='.part', dir=workdir, delete=False)
+        try:
+            with target:
+                rows = _rows(episodes, user, kind, api_name, fields)
+                rows = _counted(rows, counts.append)
+                for data in _deflate(_csv_lines(rows), sizes):
+                    target.write(data)
+        except:
+            os.remove(target.name)
+            raise
+    finally:
+        connection.close()
+    return file_name, target.name, sizes, sum(counts), time.time() - started
+
+
+def _forget_connections():
+    """
+    Pool process initializer. A forked process must not use (or close)
+    the database connections it inherited from its parent, so drop them
+    and let Django open new ones.
+    """
+    for conn in connections.all():
+        conn.connection = None
+
+
+def _get_pool(workers):
+    """
+    Return a pool of WORKERS of the kind set by OPAL_EXTRACT_POOL.
+
+    Daemonic processes - the workers of a multiprocessing pool, such as
+    our extract jobs or Celery's - may not start processes of their own,
+    so within one we always use threads.
+    """
+    if EXTRACT_POOL not in ('thread', 'process'):
+        raise ValueError(
+            'OPAL_EXTRACT_POOL should be "thread" or "process", not {0}'.format(
+                EXTRACT_POOL))
+    if EXTRACT_POOL == 'process' and not multiprocessing.current_process().daemon:
+        return multiprocessing.Pool(workers, initializer=_forget_connections)
+    return ThreadPool(workers)
+
+
+def _file_chunks(path, size=64 * 1024):
+    with open(path, 'rb') as part:
+        for chunk in iter(lambda: part.read(size), ''):
+            yield chunk
+
+
+def _parallel_members(archive, episodes, user, path, timings, progress,
+                      projection):
+    """
+    Generator function that builds the CSV parts of an extract in a pool
+    of EXTRACT_WORKERS, yielding each as a member of ARCHIVE as soon as
+    it is complete.
+
+    Parts are written to a working directory of their own, which we
+    remove when we stop, so that parts which fail, or which finish after
+    we have given up on them, are not left behind.
+    """
+    if not isinstance(episodes, QuerySet):
+        episodes = Episode.objects.filter(id__in=_episode_ids(episodes))
+    workdir = tempfile.mkdtemp(prefix='extract')
+    parts = [
+        (file_name, kind, api_name, fields, episodes.query, user, workdir)
+        for file_name, kind, api_name, fields in _parts(projection)
+    ]
+    pool = _get_pool(EXTRACT_WORKERS)
+    try:
+        for file_name, part_path, sizes, rows, seconds in pool.imap_unordered(
+                _build_part, parts):
+            try:
+                for data in archive.deflated_member(
+                        path(file_name), _file_chunks(part_path), sizes):
+                    yield data
+            finally:
+                os.remove(part_path)
+            _record_timing(file_name, seconds, timings)
+            if progress is not None and rows:
+                progress(rows)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def zip_archive_stream(episodes, description, user, timings=None,
+                       progress=None, projection=None):
+    """
+    Generator function that yields, as byte strings, a zip archive of
+    CSVs for EPISODES, the DESCRIPTION of this set of episodes and the
+    USER for which we are extracting.
+
+    If OPAL_EXTRACT_WORKERS is more than 1, the CSVs are built in
+    parallel and the archive members are in the order they complete.
+
+    If TIMINGS is a list, we append (file name, seconds) for each CSV.
+    If PROGRESS is a callable, we call it with the number of rows
+    written as we go. If PROJECTION is a dict from validate_projection(),
+    only the subrecords and fields it names are extracted.
+    """
+    archive = ZipStream()
+    zipfolder = '{0}.{1}'.format(user.username, datetime.date.today())
+    zip_relative_file_path = lambda name: '{0}/{1}'.format(zipfolder, name)
+
+    if EXTRACT_WORKERS > 1:
+        for data in _parallel_members(
+                archive, episodes, user, zip_relative_file_path, timings,
+                progress, projection):
+            yield data
+    else:
+        for file_name, kind, api_name, fields in _parts(projection):
+            rows = _rows(episodes, user, kind, api_name, fields)
+            rows = _timed(file_name, _counted(rows, progress), timings)
+            for data in archive.member(zip_relative_file_path(file_name), _csv_lines(rows)):
+                yield data
+
+    if isinstance(description, unicode):
+        description = description.encode('UTF-8')
+    for data in archive.member(zip_relative_file_path('filter.txt'), [description]):
+        yield data
+
+    yield archive.close()
+
+
+def zip_archive(episodes, description, user, timings=None, progress=None,
+                projection=None):
+    """
+    Given an iterable of EPISODES, the DESCRIPTION of this set of episodes,
+    and the USER for which we are extracting, create a zip archive suitable
+    for download with all of these episodes as CSVs, returning its path.
+
+    If anything goes wrong (including PROGRESS raising to stop us), the
+    partial archive is removed.
+    """
+    target = tempfile.NamedTemporaryFile(
+        prefix='extract', suffix='.zip', delete=False)
+    try:
+        with target:
+            for data in zip_archive_stream(
+                    episodes, description, user, timings, progress,
+                    projection):
+                target.write(data)
+    except:
+        os.remove(target.name)
+        raise
+    return target.name
+
+
+def estimate_rows(episodes, projection=None):
+    """
+    Return the number of rows an extract of EPISODES (with PROJECTION)
+    will contain, with one query for each CSV.
+    """
+    episodes = Episode.objects.filter(id__in=_episode_ids(episodes))
+    total = episodes.count()
+    for subrecord in _selected_subrecords(episode_subrecords(), projection):
+        total += subrecord.objects.filter(
+            episode_id__in=episodes.values('id')).count()
+    for subrecord in _selected_subrecords(patient_subrecords(), projection):
+        total += subrecord.objects.filter(
+            patient_id__in=episodes.values('patient_id')).count()
+    return total
 
-def async_extract(user, criteria):
+def async_extract(user, criteria, projection=None):
     """
-    Given the user and the criteria, let's run an async extract.
+    Given the user, the criteria and optionally a projection, start an
+    extract job in the background, returning its id.
     """
-    from opal.core.search import queries, tasks
-    return tasks.extract.delay(user, criteria).id
+    from opal.core.search import jobs
+    return jobs.start(user, criteria, projection).id
@@ -0,0 +1,281 @@
+"""
+OPAL search index - fast substring search over patient identifiers and names
+
+Searching demographics with __icontains means a full table scan. Instead
+we keep a copy of each patient's identifiers and name in a table with a
+trigram index:
+
+ * on SQLite, an FTS5 virtual table using the trigram tokenizer
+ * on PostgreSQL, a plain table with pg_trgm GIN indexes
+
+The index is created and filled by the rebuild_search_index management
+command, and kept up to date by Demographics save and delete signals.
+Until it has been built, or on other databases, searches use the ORM.
+
+Whether the index exists is looked up once and cached. If it is dropped
+by another process, the next statement that uses it fails, and we notice
+then - see dropped().
+"""
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+
+from opal.core.subrecords import get_subrecord_from_api_name
+
+ENABLED = getattr(settings, 'OPAL_SEARCH_INDEX', True)
+TABLE   = 'opal_patient_search'
+FIELDS  = ('hospital_number', 'nhs_number', 'name')
+
+_available = None
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class SqliteIndex(object):
+    """
+    An FTS5 trigram index, where the rowid is the patient id.
+
+    We search with MATCH and a quoted string, as FTS5 can't use the
+    trigram index for LIKE with an ESCAPE clause. Trigrams need at least
+    three characters, so shorter queries are left to the ORM.
+    """
+    id_column = 'rowid'
+
+    def condition(self, field, query, exact):
+        if len(query) < 3:
+            return None
+        phrase = '"{0}"'.format(query.replace('"', '""'))
+        if exact:
+            return ('{0} MATCH %s AND {0} = %s COLLATE NOCASE'.format(field),
+                    [phrase, query])
+        return '{0} MATCH %s'.format(field), [phrase]
+
+    def exists(self, cursor):
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+            [TABLE])
+        return cursor.fetchone() is not None
+
+    def create(self, cursor):
+        cursor.execute(
+            "CREATE VIRTUAL TABLE {0} USING fts5({1}, tokenize='trigram')".format(
+                TABLE, ', '.join(FIELDS)))
+
+    def drop(self, cursor):
+        cursor.execute('DROP TABLE IF EXISTS {0}'.format(TABLE))
+
+    def upsert(self, cursor, patient_id, values):
+        cursor.execute(
+            'DELETE FROM {0} WHERE rowid = %s'.format(TABLE), [patient_id])
+        cursor.execute(
+            'INSERT INTO {0} (rowid, {1}) VALUES (%s, {2})'.format(
+                TABLE, ', '.join(FIELDS), ', '.join(['%s'] * len(FIELDS))),
+            [patient_id] + values)
+
+    def delete(self, cursor, patient_id):
+        cursor.execute(
+            'DELETE FROM {0} WHERE rowid = %s'.format(TABLE), [patient_id])
+
+
+class PostgresIndex(object):
+    """
+    A table of patient identifiers and names with pg_trgm GIN indexes.
+    """
+    id_column = 'patient_id'
+
+    def condition(self, field, query, exact):
+        pattern = _escape_like(query)
+        if not exact:
+            pattern = '%{0}%'.format(pattern)
+        return "{0} ILIKE %s ESCAPE '\\'".format(field), [pattern]
+
+    def exists(self, cursor):
+        cursor.execute(
+            'SELECT 1 FROM information_schema.tables '
+            'WHERE table_schema = current_schema() AND table_name = %s',
+            [TABLE])
+        return cursor.fetchone() is not None
+
+    def create(self, cursor):
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        cursor.execute(
+            'CREATE TABLE {0} (patient_id integer PRIMARY KEY, {1})'.format(
+                TABLE, ', '.join('{0} text'.format(f) for f in FIELDS)))
+        for field in FIELDS:
+            cursor.execute(
+                'CREATE INDEX {0}_{1}_trgm ON {0} USING gin ({1} gin_trgm_ops)'.format(
+                    TABLE, field))
+
+    def drop(self, cursor):
+        cursor.execute('DROP TABLE IF EXISTS {0}'.format(TABLE))
+
+    def upsert(self, cursor, patient_id, values):
+        self.delete(cursor, patient_id)
+        cursor.execute(
+            'INSERT INTO {0} (patient_id, {1}) VALUES (%s, {2})'.format(
+                TABLE, ', '.join(FIELDS), ', '.join(['%s'] * len(FIELDS))),
+            [patient_id] + values)
+
+    def delete(self, cursor, patient_id):
+        cursor.execute(
+            'DELETE FROM {0} WHERE patient_id = %s'.format(TABLE), [patient_id])
+
+
+BACKENDS = {
+    'sqlite': SqliteIndex,
+    'postgresql': PostgresIndex,
+}
+
+
+def get_backend():
+    """
+    Return the index backend for our database, or None if we can't
+    index on this database.
+    """
+    backend = BACKENDS.get(connection.vendor)
+    if backend is None:
+        return None
+    return backend()
+
+
+def available():
+    """
+    Return True if the search index has been built and may be used.
+    """
+    global _available
+    if not ENABLED or get_backend() is None:
+        return False
+    if _available is None:
+        _available = TABLE in connection.introspection.table_names()
+    return _available
+
+
+def dropped():
+    """
+    Call when a statement using the search index has failed, outside
+    the transaction (or savepoint) it failed in.
+
+    Return True if that is because the index has been dropped (perhaps
+    by another process), in which case we stop using it.
+    """
+    global _available
+    if get_backend().exists(connection.cursor()):
+        return False
+    _available = False
+    return True
+
+
+def _write(operation, *args):
+    """
+    Run OPERATION(cursor, *ARGS) against the index in a savepoint,
+    doing nothing if the index turns out to have been dropped.
+    """
+    try:
+        with transaction.atomic():
+            operation(connection.cursor(), *args)
+    except DatabaseError:
+        if not dropped():
+            raise
+
+
+def _values(demographics):
+    return [getattr(demographics, f, None) or '' for f in FIELDS]
+
+
+def rebuild():
+    """
+    Create the search index from scratch, returning the number of
+    patients indexed.
+
+    Raise ValueError if we can't index on this database.
+    """
+    global _available
+    backend = get_backend()
+    if backend is None:
+        raise ValueError(
+            'No search index for {0} databases'.format(connection.vendor))
+
+    Demographics = get_subrecord_from_api_name('demographics')
+    count = 0
+    cursor = connection.cursor()
+    backend.drop(cursor)
+    backend.create(cursor)
+    for demographics in Demographics.objects.order_by('id').iterator():
+        backend.upsert(cursor, demographics.patient_id, _values(demographics))
+        count += 1
+    _available = True
+    return count
+
+
+def drop():
+    """
+    Remove the search index, so that searches use the ORM.
+    """
+    global _available
+    backend = get_backend()
+    if backend is not None:
+        backend.drop(connection.cursor())
+    _available = None
+
+
+def index_patients(patient_ids):
+    """
+    Bring the index up to date for PATIENT_IDS, for use after changes
+    that don't send signals, such as bulk_create().
+    """
+    if not available():
+        return
+    Demographics = get_subrecord_from_api_name('demographics')
+    backend = get_backend()
+
+    def upsert(cursor):
+        for demographics in Demographics.objects.filter(
+                patient_id__in=patient_ids):
+            backend.upsert(cursor, demographics.patient_id, _values(demographics))
+
+    _write(upsert)
+
+
+def update_index(sender, instance, **kwargs):
+    """
+    Signal receiver to index a Demographics instance when it is saved.
+    """
+    if not available():
+        return
+    _write(get_backend().upsert, instance.patient_id, _values(instance))
+
+
+def remove_from_index(sender, instance, **kwargs):
+    """
+    Signal receiver to remove a Demographics instance from the index
+    when it is deleted.
+    """
+    if not available():
+        return
+    _write(get_backend().delete, instance.patient_id)
+
+
+def patient_ids(field, query, exact=False):
+    """
+    Return a queryset of the ids of patients whose FIELD contains
+    QUERY, or is QUERY if EXACT, ignoring case.
+
+    Return None if the index can't answer this. The queryset fails
+    when evaluated if the index has since been dropped - callers should
+    then check dropped() and search again.
+    """
+    from opal.models import Patient
+
+    backend = get_backend()
+    if field not in FIELDS or backend is None:
+        return None
+    condition = backend.condition(field, query, exact)
+    if condition is None or not available():
+        return None
+    sql, params = condition
+    # Deliberately unqualified: this ends up in a subquery where the
+    # patient table has an alias.
+    where = 'id IN (SELECT {0} FROM {1} WHERE {2})'.format(
+        backend.id_column, TABLE, sql)
+    return Patient.objects.extra(where=[where], params=params).values('id')
@@ -0,0 +1,185 @@
+"""
+OPAL extract jobs - build extracts in the background
+
+An ExtractJob records an extract a user has asked for. When a Celery
+broker is configured (BROKER_URL), jobs are run by the
+opal.core.search.tasks.extract task. Otherwise they are run in a pool of
+local processes, so async extracts work without any extra services.
+
+Either way the job row tracks its state, progress and the path of the
+finished archive, which we remove once the job expires.
+"""
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+
+from opal.core import exceptions
+from opal.models import ExtractJob
+
+WORKERS       = getattr(settings, 'OPAL_EXTRACT_JOB_WORKERS', 2)
+USER_LIMIT    = getattr(settings, 'OPAL_EXTRACT_JOBS_PER_USER', 2)
+EXPIRY_HOURS  = getattr(settings, 'OPAL_EXTRACT_JOB_EXPIRY_HOURS', 24)
+
+_pool = None
+
+
+class Cancelled(Exception):
+    """
+    Raised from within a running job when it has been cancelled.
+    """
+
+
+def use_celery():
+    """
+    Return True if we should hand jobs to Celery rather than our own
+    pool.
+    """
+    return bool(getattr(settings, 'BROKER_URL', None))
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        from opal.core.search.extract import _forget_connections
+        _pool = multiprocessing.Pool(WORKERS, initializer=_forget_connections)
+    return _pool
+
+
+def start(user, criteria, projection=None):
+    """
+    Create and submit an extract job for USER of the episodes matching
+    CRITERIA, returning the job. PROJECTION is an optional dict of the
+    subrecords and fields to extract, as for extract.zip_archive().
+
+    Raise ExtractError if USER already has as many jobs running as they
+    are allowed.
+    """
+    cleanup()
+    running = ExtractJob.objects.filter(
+        user=user, state__in=ExtractJob.RUNNING).count()
+    if running >= USER_LIMIT:
+        raise exceptions.ExtractError(
+            'You already have {0} extracts running'.format(running))
+
+    job = ExtractJob.objects.create(
+        user=user, criteria=json.dumps(criteria),
+        projection='' if projection is None else json.dumps(projection))
+    if use_celery():
+        from opal.core.search import tasks
+        tasks.extract.delay(job.id)
+    else:
+        _get_pool().apply_async(run, (job.id,))
+    return job
+
+
+def _progress(job_id):
+    """
+    Return a progress callback for the extract functions that records
+    the rows written for JOB_ID, and raises Cancelled if the job has
+    been cancelled.
+    """
+    def progress(rows):
+        ExtractJob.objects.filter(id=job_id).update(
+            rows_written=F('rows_written') + rows)
+        state = ExtractJob.objects.filter(
+            id=job_id).values_list('state', flat=True)[0]
+        if state == ExtractJob.CANCELLED:
+            raise Cancelled()
+    return progress
+
+
+def run(job_id):
+    """
+    Build the archive for the job JOB_ID, unless it has already been
+    cancelled.
+    """
+    from opal.core.search import extract, queries
+
+    try:
+        started = ExtractJob.objects.filter(
+            id=job_id, state=ExtractJob.PENDING
+        ).update(state=ExtractJob.STARTED)
+        if not started:
+            return
+        job = ExtractJob.objects.select_related('user').get(id=job_id)
+        try:
+            query = queries.SearchBackend(job.user, json.loads(job.criteria))
+            projection = None
+            if job.projection:
+                projection = json.loads(job.projection)
+            episodes = query.get_episode_queryset()
+            job.rows_total = extract.estimate_rows(episodes, projection)
+            job.save(update_fields=['rows_total'])
+            path = extract.zip_archive(
+                episodes, query.description(), job.user,
+                progress=_progress(job_id), projection=projection)
+        except Cancelled:
+            return
+        except Exception as e:
+            logging.exception('Extract job {0} failed'.format(job_id))
+            _finish(job_id, ExtractJob.FAILURE, error=str(e))
+            return
+        if not _finish(job_id, ExtractJob.SUCCESS, file_path=path):
+            # Cancelled after we wrote the last row
+            os.remove(path)
+    finally:
+        connection.close()
+
+
+def _finish(job_id, state, **kwargs):
+    """
+    Mark the job JOB_ID as finished in STATE if it is still running,
+    returning True if it was.
+    """
+    now = timezone.now()
+    return ExtractJob.objects.filter(
+        id=job_id, state=ExtractJob.STARTED
+    ).update(
+        state=state, finished=now,
+        expires=now + datetime.timedelta(hours=EXPIRY_HOURS),
+        **kwargs
+    )
+
+
+def cancel(job):
+    """
+    Cancel JOB if it is still running, returning True if it was.
+
+    A job that has started stops when it next reports progress.
+    """
+    return ExtractJob.objects.filter(
+        id=job.id, state__in=ExtractJob.RUNNING
+    ).update(state=ExtractJob.CANCELLED, finished=timezone.now())
+
+
+def cleanup():
+    """
+    Expire finished jobs that have passed their expiry time, removing
+    their archives, and fail running jobs older than the expiry period,
+    whose worker must have died. Return the number of jobs expired.
+    """
+    now = timezone.now()
+    ExtractJob.objects.filter(
+        state__in=ExtractJob.RUNNING,
+        created__lt=now - datetime.timedelta(hours=EXPIRY_HOURS)
+    ).update(state=ExtractJob.FAILURE, finished=now,
+             error='The extract did not finish in time')
+
+    expired = ExtractJob.objects.filter(expires__lt=now).exclude(
+        state=ExtractJob.EXPIRED)
+    count = 0
+    for job in expired:
+        if job.file_path and os.path.exists(job.file_path):
+            os.remove(job.file_path)
+        job.state = ExtractJob.EXPIRED
+        job.file_path = ''
+        job.save(update_fields=['state', 'file_path'])
+        count += 1
+    return count
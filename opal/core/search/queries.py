@@ -1,67 +1,31 @@
 """
 Allow us to make search queries
 """
+from collections import defaultdict
 import datetime
+import functools
 
-from django.contrib.contenttypes.models import ContentType
+from django.db import DatabaseError, transaction
 from django.db import models as djangomodels
+from django.db.models import Count, Max, Min
+from django.db.models.functions import Coalesce
 
 
 from opal import models
-from opal.core import fields
+from opal.core import exceptions, lookuplists
+from opal.core.search import index, registry
+from opal.core.subrecords import get_subrecord_from_api_name
 
 
 def get_model_name_from_column_name(column_name):
-    return column_name.replace(' ', '').replace('_', '').lower()
+    return registry.normalise_column_name(column_name)
 
 
 def get_model_from_column_name(column_name):
-    Mod = None
-    model_name = get_model_name_from_column_name(column_name)
-
-    for m in djangomodels.get_models():
-        if m.__name__.lower() == model_name:
-            if not Mod:
-                Mod = m
-            elif (issubclass(m, models.EpisodeSubrecord) or
-                  issubclass(m, models.PatientSubrecord)):
-                Mod = m
-
-    return Mod
-
-
-class PatientSummary(object):
-    def __init__(self, episode):
-        self.start_date = episode.start_date
-        self.end_date = episode.end_date
-        self.episode_ids = set([episode.id])
-        self.episode_id = episode.id
-        self.categories = set([episode.category])
-        self.id = episode.patient.demographics_set.get().id
-
-    def update(self, episode):
-        if not self.start_date:
-            self.start_date = episode.start_date
-        elif episode.start_date:
-            if self.start_date > episode.start_date:
-                self.start_date = episode.start_date
-
-        if not self.end_date:
-            self.end_date = episode.end_date
-        elif episode.end_date:
-            if self.end_date < episode.end_date:
-                self.end_date = episode.end_date
-
-        self.episode_ids.add(episode.id)
-        self.categories.add(episode.category)
-
-    def to_dict(self):
-        result = {k: getattr(self, k) for k in [
-            "episode_id", "start_date", "end_date", "id"
-        ]}
-        result["categories"] = sorted(self.categories)
-        result["count"] = len(self.episode_ids)
-        return result
+    try:
+        return registry.get_column(column_name).model
+    except exceptions.SearchError:
+        return None
 
 
 def episodes_for_user(episodes, user):
@@ -69,25 +33,34 @@ def episodes_for_user(episodes, user):
     Given an iterable of EPISODES and a USER, return a filtered
     list of episodes that this user has the permissions to know
     about.
+
+    Where you have a queryset, use Episode.objects.visible_to() instead,
+    which doesn't load the episodes.
+    """
+    if not isinstance(episodes, djangomodels.QuerySet):
+        ids = [e.id for e in episodes]
+        episodes = models.Episode.objects.filter(id__in=ids)
+    return list(episodes.visible_to(user))
+
+
+def _falls_back_without_index(method):
     """
-    teams = models.Team.restricted_teams(user)
-    allowed_episodes = []
-    for e in episodes:
-        allowed = False
-        if e.tagging_set.count() == 0:
-            allowed_episodes.append(e)
-            continue
-        for tagging in e.tagging_set.all():
-            if not tagging.team.restricted:
-                allowed = True
-                break
-            elif tagging.team in teams:
-                allowed = True
-                break
-
-        if allowed:
-            allowed_episodes.append(e)
-    return allowed_episodes
+    Decorator for DatabaseQuery methods that run the search: if that
+    fails because the search index has been dropped, search again
+    without it.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not index.available():
+            return method(self, *args, **kwargs)
+        try:
+            with transaction.atomic():
+                return method(self, *args, **kwargs)
+        except DatabaseError:
+            if not index.dropped():
+                raise
+        return method(self, *args, **kwargs)
+    return wrapper
 
 
 class QueryBackend(object):
@@ -101,18 +74,24 @@ class QueryBackend(object):
     def get_episodes(self):
         raise NotImplementedError()
 
+    def get_episode_queryset(self):
+        raise NotImplementedError()
+
     def description(self):
         raise NotImplementedError()
 
     def get_patients(self):
         raise NotImplementedError()
 
-    def get_patient_summaries(self):
+    def get_patient_summaries(self, limit=None, offset=0):
+        raise NotImplementedError()
+
+    def count_patients(self):
         raise NotImplementedError()
 
     def patients_as_json(self):
         patients = self.get_patients()
-        return [p.to_dict(self.user) for p in patients]
+        return models.Patient.objects.serialised(self.user, patients)
 
 
 class DatabaseQuery(QueryBackend):
@@ -120,21 +99,47 @@ class DatabaseQuery(QueryBackend):
     The default built in query backend for OPAL allows advanced search
     criteria building.
 
-    We broadly map reduce all criteria then the set of combined and/or
-    criteria together, then only unique episodes.
+    We compile each criterion into a subquery for matching episode ids,
+    and combine those with and/or/not into a single query that the
+    database evaluates.
+
+    Finally we filter based on team restrictions, again in the database.
+
+    Searches on patient identifiers and names use the search index
+    when it has been built.
 
-    Finally we filter based on team restrictions.
+    Criteria are resolved against the search registry when we are
+    created, so that unknown columns or fields raise SearchError before
+    we go anywhere near the database.
     """
+    def __init__(self, user, query):
+        super(DatabaseQuery, self).__init__(user, query)
+        try:
+            self._demographics = get_subrecord_from_api_name('demographics')
+        except ValueError:
+            self._demographics = None
+        for criteria in self.query:
+            registry.get_field(criteria['column'], criteria['field'])
+
+    def _query_for_subrecord(self, Mod, *args, **kwargs):
+        """
+        Return a Q object matching episodes whose subrecord of type MOD
+        matches the filter ARGS and KWARGS.
 
-    def _episodes_for_boolean_fields(self, query, field, contains):
-        model = get_model_name_from_column_name(query['column'])
+        Patient subrecords match every episode of the patient.
+        """
+        subrecords = Mod.objects.filter(*args, **kwargs)
+        if Mod == models.Episode:
+            return djangomodels.Q(id__in=subrecords.values('id'))
+        if issubclass(Mod, models.PatientSubrecord):
+            return djangomodels.Q(patient_id__in=subrecords.values('patient_id'))
+        return djangomodels.Q(id__in=subrecords.values('episode_id'))
+
+    def _query_for_boolean_fields(self, query, field, contains, Mod):
         val = query['query'] == 'true'
-        kw = {'{0}__{1}'.format(model.replace('_', ''), field): val}
-        eps = models.Episode.objects.filter(**kw)
-        return eps
+        return self._query_for_subrecord(Mod, **{field: val})
 
-    def _episodes_for_date_fields(self, query, field, contains):
-        model = get_model_name_from_column_name(query['column'])
+    def _query_for_date_fields(self, query, field, contains, Mod):
         qtype = ''
         val = datetime.datetime.strptime(query['query'], "%d/%m/%Y")
         if query['queryType'] == 'Before':
@@ -142,52 +147,41 @@ class DatabaseQuery(QueryBackend):
         elif query['queryType'] == 'After':
             qtype = '__gte'
 
-        kw = {'{0}__{1}{2}'.format(model, field, qtype): val}
-        eps = models.Episode.objects.filter(**kw)
-        return eps
+        kw = {'{0}{1}'.format(field, qtype): val}
+        return self._query_for_subrecord(Mod, **kw)
 
-    def _episodes_for_many_to_many_fields(self, query, field_obj):
-        model = get_model_name_from_column_name(query['column'])
+    def _query_for_many_to_many_fields(self, query, field_obj, Mod):
         related_field = query["field"].lower()
-        key = "%s__%s__name" % (model, related_field)
-        kwargs = {key: query["query"]}
-        return models.Episode.objects.filter(**kwargs)
-
-    def _episodes_for_fkorft_fields(self, query, field, contains, Mod):
-        model = get_model_name_from_column_name(query['column'])
+        key = "%s__name" % related_field
+        return self._query_for_subrecord(Mod, **{key: query["query"]})
 
+    def _query_for_fkorft_fields(self, query, field, contains, Mod):
         # Look up to see if there is a synonym.
-        content_type = ContentType.objects.get_for_model(
-            getattr(Mod, field).foreign_model)
+        search_field = registry.get_field(query['column'], field)
         name = query['query']
         try:
-            from opal.models import Synonym
-            synonym = Synonym.objects.get(content_type=content_type, name=name)
-            name = synonym.content_object.name
-        except Synonym.DoesNotExist: # maybe this is pointless exception bouncing?
-            pass # That's fine.
-
-        kw_fk = {'{0}__{1}_fk__name{2}'.format(model.replace('_', ''), field, contains): name}
-        kw_ft = {'{0}__{1}_ft{2}'.format(model.replace('_', ''), field, contains): query['query']}
-
-        if issubclass(Mod, models.EpisodeSubrecord):
-
-            qs_fk = models.Episode.objects.filter(**kw_fk)
-            qs_ft = models.Episode.objects.filter(**kw_ft)
-            eps = set(list(qs_fk) + list(qs_ft))
-
-        elif issubclass(Mod, models.PatientSubrecord):
-            qs_fk = models.Patient.objects.filter(**kw_fk)
-            qs_ft = models.Patient.objects.filter(**kw_ft)
-            pats = set(list(qs_fk) + list(qs_ft))
-            eps = []
-            for p in pats:
-                eps += list(p.episode_set.all())
-        return eps
-
-    def episodes_for_criteria(self, criteria):
+            name, _ = lookuplists.cache.resolve(search_field.lookup_model, name)
+        except KeyError:
+            try:
+                from opal.models import Synonym
+                synonym = Synonym.objects.get(
+                    content_type=search_field.content_type, name=name)
+                name = synonym.content_object.name
+            except Synonym.DoesNotExist: # maybe this is pointless exception bouncing?
+                pass # That's fine.
+
+        kw_fk = {'{0}_fk__name{1}'.format(field, contains): name}
+        kw_ft = {'{0}_ft{1}'.format(field, contains): query['query']}
+        return self._query_for_subrecord(
+            Mod, djangomodels.Q(**kw_fk) | djangomodels.Q(**kw_ft))
+
+    def query_for_criteria(self, criteria):
         """
-        Given one set of criteria, return episodes that match it.
+        Given one set of criteria, return a Q object matching the
+        episodes that match it.
+
+        Raise SearchError if the criteria refer to a column or field
+        we don't know about.
         """
         query = criteria
         querytype = query['queryType']
@@ -195,112 +189,121 @@ class DatabaseQuery(QueryBackend):
         if querytype == 'Contains':
             contains = '__icontains'
 
-        column_name = query['column']
-
-        field = query['field'].replace(' ', '_').lower()
-        Mod = get_model_from_column_name(column_name)
-
-        if column_name.lower() == 'tags':
-            Mod = models.Tagging
-
-        named_fields = [f for f in Mod._meta.fields if f.name == field]
-
-        if len(named_fields) == 1 and isinstance(named_fields[0],djangomodels.BooleanField):
-            eps = self._episodes_for_boolean_fields(query, field, contains)
+        search_field = registry.get_field(query['column'], query['field'])
+        Mod = search_field.model
+        field = search_field.name
+
+        if search_field.kind == registry.BOOLEAN:
+            return self._query_for_boolean_fields(query, field, contains, Mod)
+        elif search_field.kind == registry.DATE:
+            return self._query_for_date_fields(query, field, contains, Mod)
+        elif search_field.kind == registry.FKORFT:
+            return self._query_for_fkorft_fields(query, field, contains, Mod)
+        elif search_field.kind == registry.MANY_TO_MANY:
+            return self._query_for_many_to_many_fields(
+                query, Mod._meta.get_field(field), Mod)
+        elif search_field.kind == registry.TAG:
+            eps = models.Episode.objects.ever_tagged(field)
+            return djangomodels.Q(id__in=eps.values('id'))
+        else:
+            if Mod is self._demographics:
+                patient_ids = index.patient_ids(
+                    field, query['query'], exact=contains == '__iexact')
+                if patient_ids is not None:
+                    return djangomodels.Q(patient_id__in=patient_ids)
 
-        elif len(named_fields) == 1 and isinstance(named_fields[0], djangomodels.DateField):
-            eps = self._episodes_for_date_fields(query, field, contains)
+            kw = {'{0}{1}'.format(field, contains): query['query']}
+            return self._query_for_subrecord(Mod, **kw)
 
-        elif hasattr(Mod, field) and isinstance(getattr(Mod, field), fields.ForeignKeyOrFreeText):
-            eps = self._episodes_for_fkorft_fields(query, field, contains, Mod)
-        elif hasattr(Mod, field) and isinstance(Mod._meta.get_field(field), djangomodels.ManyToManyField):
-            eps = self._episodes_for_many_to_many_fields(query, Mod._meta.get_field(field))
-        else:
-            model_name = get_model_name_from_column_name(query['column'])
-            kw = {'{0}__{1}{2}'.format(model_name, field, contains): query['query']}
-
-            if Mod == models.Tagging:
-                eps = models.Episode.objects.ever_tagged(query['field'])
-
-            elif issubclass(Mod, models.EpisodeSubrecord):
-                eps = models.Episode.objects.filter(**kw)
-            elif issubclass(Mod, models.PatientSubrecord):
-                pats = models.Patient.objects.filter(**kw)
-                eps = []
-                for p in pats:
-                    eps += list(p.episode_set.all())
-        return eps
+    def episodes_for_criteria(self, criteria):
+        """
+        Given one set of criteria, return episodes that match it.
+        """
+        return models.Episode.objects.filter(self.query_for_criteria(criteria))
 
     def _get_aggregate_patients_from_episodes(self, episodes):
-        # at the moment we use date_of_admission/discharge only if
-        # date_of_episode is null, because of this we can't do this
-        # in a vanilla orm query
-        patient_summaries = {}
-
-        for episode in episodes:
-            patient_id = episode.patient_id
-            if patient_id in patient_summaries:
-                patient_summaries[patient_id].update(episode)
-            else:
-                patient_summaries[patient_id] = PatientSummary(episode)
+        """
+        Given a queryset of EPISODES, return a summary of each of their
+        patients, aggregated in the database.
 
-        patients = models.Patient.objects.filter(
-            id__in=patient_summaries.keys()
-        )
-        patients = patients.prefetch_related("demographics_set")
+        An episode starts on its date_of_episode, falling back to
+        date_of_admission, and ends on its date_of_episode, falling back
+        to discharge_date.
+        """
+        summaries = episodes.order_by().values('patient_id').annotate(
+            start_date=Min(Coalesce('date_of_episode', 'date_of_admission')),
+            end_date=Max(Coalesce('date_of_episode', 'discharge_date')),
+            episode_id=Min('id'),
+            count=Count('id'),
+        ).order_by('patient_id')
+
+        categories = defaultdict(set)
+        for patient_id, category in episodes.order_by().values_list(
+                'patient_id', 'category').distinct():
+            categories[patient_id].add(category)
+
+        Demographics = get_subrecord_from_api_name('demographics')
+        demographics = {}
+        for demographic in Demographics.objects.filter(
+                patient_id__in=episodes.values('patient_id')
+        ).values('patient_id', 'name', 'hospital_number', 'date_of_birth'):
+            demographics[demographic.pop('patient_id')] = demographic
 
         results = []
-
-        for patient_id, patient_summary in patient_summaries.iteritems():
-            patient = next(p for p in patients if p.id == patient_id)
-            demographic = patient.demographics_set.get()
-
-            result = {k: getattr(demographic, k) for k in [
-                "name", "hospital_number", "date_of_birth"
-                ]}
-
-            result.update(patient_summary.to_dict())
+        for summary in summaries:
+            patient_id = summary.pop('patient_id')
+            result = dict(demographics.get(patient_id, {}))
+            result.update(summary)
+            result['id'] = patient_id
+            result['categories'] = sorted(categories[patient_id])
             results.append(result)
 
         return results
 
     def _filter_for_restricted_only(self, episodes):
         """
-        Given an iterable of EPISODES, return those for which our
+        Given a queryset of EPISODES, return those for which our
         current restricted only user is allowed to know about.
         """
-        teams = models.Team.restricted_teams(self.user)
-        allowed_episodes = []
-        for e in episodes:
-            for tagging in e.tagging_set.all():
-                if tagging.team in teams:
-                    allowed_episodes.append(e)
-                    break
-
-        return allowed_episodes
+        return episodes.restricted_to(self.user)
 
     def _filter_restricted_teams(self, episodes):
         """
-        Given an iterable of EPISODES, return only those which
+        Given a queryset of EPISODES, return only those which
         are not only members of restricted teams that our user is not
         allowed to know about.
         """
-        return episodes_for_user(episodes, self.user)
+        return episodes.visible_to(self.user)
 
-    def _episodes_without_restrictions(self):
-        all_matches = [(q['combine'], self.episodes_for_criteria(q))
-                       for q in self.query]
-        if not all_matches:
-            return []
+    def _episode_ids_without_restrictions(self):
+        """
+        Return a query for the ids of the episodes matching all of
+        our criteria, evaluated entirely in the database.
+
+        Criteria are combined in order with the episodes matched so far:
+        'and' is their intersection, 'or' their union, and 'not' the
+        episodes matching the criterion that are not in the working set.
+        """
+        if not self.query:
+            return models.Episode.objects.none().values_list('id', flat=True)
 
-        working = set(all_matches[0][1])
-        rest = all_matches[1:]
+        working = self.query_for_criteria(self.query[0])
 
-        for combine, episodes in rest:
-            methods = {'and': 'intersection', 'or': 'union', 'not': 'difference'}
-            working = getattr(set(episodes), methods[combine])(working)
+        for criteria in self.query[1:]:
+            query = self.query_for_criteria(criteria)
+            combine = criteria['combine']
+            if combine == 'and':
+                working = query & working
+            elif combine == 'or':
+                working = query | working
+            elif combine == 'not':
+                working = query & ~working
 
-        return working
+        return models.Episode.objects.filter(working).values_list('id', flat=True)
+
+    def _episodes_without_restrictions(self):
+        return models.Episode.objects.filter(
+            id__in=self._episode_ids_without_restrictions())
 
     def _filter_restricted_episodes(self, eps):
         if self.user.profile.restricted_only:
@@ -310,25 +313,61 @@ class DatabaseQuery(QueryBackend):
 
         return eps
 
-    def get_episodes(self):
+    def get_episode_queryset(self):
+        """
+        Return a queryset of the episodes matching our criteria that
+        our user may know about.
+        """
         eps = self._episodes_without_restrictions()
         return self._filter_restricted_episodes(eps)
 
-    def get_patient_summaries(self):
-        eps = self._episodes_without_restrictions()
-        episode_ids = [e.id for e in eps]
+    @_falls_back_without_index
+    def get_episodes(self):
+        return list(self.get_episode_queryset())
 
-        # get all episodes of patients, that have episodes that
-        # match the criteria
-        all_eps = models.Episode.objects.filter(
-            patient__episode__in=episode_ids
-        )
-        filtered_eps = self._filter_restricted_episodes(all_eps)
-        return self._get_aggregate_patients_from_episodes(filtered_eps)
+    def _patient_summary_episodes(self):
+        """
+        Return a queryset of all the episodes of patients that have
+        episodes matching our criteria, that our user may know about.
+        """
+        episode_ids = self._episode_ids_without_restrictions()
+        patient_ids = models.Episode.objects.filter(
+            id__in=episode_ids).values('patient_id')
+        all_eps = models.Episode.objects.filter(patient_id__in=patient_ids)
+        return self._filter_restricted_episodes(all_eps)
+
+    @_falls_back_without_index
+    def get_patient_summaries(self, limit=None, offset=0):
+        """
+        Return summaries of the patients matching our criteria, in
+        patient id order.
+
+        If LIMIT is given, return at most LIMIT summaries starting at
+        OFFSET; only those patients are summarised.
+        """
+        eps = self._patient_summary_episodes()
+        if limit is not None or offset:
+            patient_ids = eps.order_by('patient_id').values_list(
+                'patient_id', flat=True).distinct()
+            if limit is None:
+                patient_ids = patient_ids[offset:]
+            else:
+                patient_ids = patient_ids[offset:offset + limit]
+            eps = eps.filter(patient_id__in=list(patient_ids))
+        return self._get_aggregate_patients_from_episodes(eps)
+
+    @_falls_back_without_index
+    def count_patients(self):
+        """
+        Return the number of patients get_patient_summaries() would
+        summarise.
+        """
+        eps = self._patient_summary_episodes()
+        return eps.order_by().values('patient_id').distinct().count()
 
     def get_patients(self):
-        patients = set(e.patient for e in self.get_episodes())
-        return list(patients)
+        patient_ids = set(e.patient_id for e in self.get_episodes())
+        return list(models.Patient.objects.filter(id__in=patient_ids))
 
     def description(self):
         """
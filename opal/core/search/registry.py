@@ -0,0 +1,161 @@
+"""
+OPAL search registry - what each advanced search criterion refers to
+
+Search criteria name a column (e.g. 'demographics') and a field
+(e.g. 'Date of birth'). Working out which model and what kind of field
+that is means walking the app registry and the model metadata, so we do
+that once at startup and keep a SearchColumn for each model, with a
+SearchField for each of its fields.
+"""
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db import models as djangomodels
+
+from opal.core import exceptions
+from opal.core.fields import ForeignKeyOrFreeText
+
+BOOLEAN      = 'boolean'
+DATE         = 'date'
+FKORFT       = 'fkorft'
+MANY_TO_MANY = 'many_to_many'
+TAG          = 'tag'
+TEXT         = 'text'
+
+_COLUMNS = {}
+
+
+def normalise_column_name(column_name):
+    return column_name.replace(' ', '').replace('_', '').lower()
+
+
+def normalise_field_name(field_name):
+    return field_name.replace(' ', '_').lower()
+
+
+class SearchField(object):
+    """
+    A field we can search on: its NAME, the MODEL it belongs to, its
+    KIND and, for lookup list backed fields, the LOOKUP_MODEL.
+    """
+    def __init__(self, model, name, kind, lookup_model=None):
+        self.model = model
+        self.name = name
+        self.kind = kind
+        self.lookup_model = lookup_model
+
+    def __repr__(self):
+        return '<SearchField {0}.{1} ({2})>'.format(
+            self.model.__name__, self.name, self.kind)
+
+    @property
+    def content_type(self):
+        """
+        The content type of our lookup list, if we have one.
+        """
+        if self.lookup_model is None:
+            return None
+        return ContentType.objects.get_for_model(self.lookup_model)
+
+
+def _classify(field):
+    if isinstance(field, djangomodels.BooleanField):
+        return BOOLEAN
+    if isinstance(field, djangomodels.DateField):
+        return DATE
+    if isinstance(field, djangomodels.ManyToManyField):
+        return MANY_TO_MANY
+    return TEXT
+
+
+class SearchColumn(object):
+    """
+    A model we can search on, and its fields by name.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.fields = {}
+
+        for field in model._meta.fields + model._meta.many_to_many:
+            self.fields[field.name] = SearchField(
+                model, field.name, _classify(field))
+
+        for klass in reversed(model.__mro__):
+            for name, value in vars(klass).items():
+                if isinstance(value, ForeignKeyOrFreeText):
+                    self.fields[name] = SearchField(
+                        model, name, FKORFT, lookup_model=value.foreign_model)
+
+    def __repr__(self):
+        return '<SearchColumn {0}>'.format(self.model.__name__)
+
+    def get_field(self, field_name):
+        """
+        Return the SearchField for FIELD_NAME as it appears in a criterion.
+
+        Raise SearchError if we don't have that field.
+        """
+        name = normalise_field_name(field_name)
+        try:
+            return self.fields[name]
+        except KeyError:
+            raise exceptions.SearchError(
+                'Unknown search field: {0} {1}'.format(
+                    self.model.__name__, field_name))
+
+
+class TagColumn(SearchColumn):
+    """
+    The tags column: every field is the name of a team.
+    """
+    def __init__(self):
+        from opal.models import Tagging
+
+        self.model = Tagging
+        self.fields = {}
+
+    def get_field(self, field_name):
+        return SearchField(self.model, field_name, TAG)
+
+
+def build_registry():
+    """
+    Compile the search columns for every installed model.
+
+    Called once the app registry is ready.
+    """
+    from opal.models import EpisodeSubrecord, PatientSubrecord
+
+    _COLUMNS.clear()
+    for model in apps.get_models():
+        name = model.__name__.lower()
+        # Where two models share a name, subrecords win.
+        if name in _COLUMNS and not issubclass(
+                model, (EpisodeSubrecord, PatientSubrecord)):
+            continue
+        _COLUMNS[name] = SearchColumn(model)
+    _COLUMNS['tags'] = TagColumn()
+
+
+def get_column(column_name):
+    """
+    Return the SearchColumn for COLUMN_NAME as it appears in a criterion.
+
+    Raise SearchError if there is no such column.
+    """
+    if not _COLUMNS:
+        build_registry()
+    try:
+        return _COLUMNS[normalise_column_name(column_name)]
+    except KeyError:
+        raise exceptions.SearchError(
+            'Unknown search column: {0}'.format(column_name))
+
+
+def get_field(column_name, field_name):
+    """
+    Return the SearchField a criterion for COLUMN_NAME and FIELD_NAME
+    refers to.
+
+    Raise SearchError if there is no such column or field.
+    """
+    return get_column(column_name).get_field(field_name)
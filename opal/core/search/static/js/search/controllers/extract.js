@@ -37,6 +37,26 @@ angular.module('opal.controllers').controller(
 
         $scope.criteria = [_.clone($scope.model)];
 
+        // The subrecords and fields to download - if none are chosen
+        // we download everything.
+        $scope.extractColumns = schema.columns;
+        $scope.projection = {};
+
+        $scope.completeProjection = function(){
+            var projection = {};
+            _.each($scope.projection, function(choice, name){
+                if(!choice.selected){ return; }
+                var fields = _.filter(_.keys(choice.fields), function(f){
+                    return choice.fields[f];
+                });
+                projection[name] = fields.length ? fields : null;
+            });
+            if(_.isEmpty(projection)){
+                return null;
+            }
+            return projection;
+        };
+
         $scope.completeCriteria =  function(){
             return _.filter($scope.criteria, function(c){
                 // Teams are a special case - they are essentially boolean
@@ -187,9 +207,9 @@ angular.module('opal.controllers').controller(
 
             var ping_until_success = function(){
                 $http.get('/search/extract/result/'+ $scope.extract_id).then(function(result){
-                    console.log(result);
-                    if(result.data.state == 'FAILURE'){
-                        alert('FAILURE')
+                    $scope.async_progress = result.data.progress;
+                    if(_.contains(['FAILURE', 'CANCELLED', 'EXPIRED'], result.data.state)){
+                        alert(result.data.error || result.data.state)
                         $scope.async_waiting = false;
                         return
                     }
@@ -206,11 +226,17 @@ angular.module('opal.controllers').controller(
             $scope.async_waiting = true;
             $http.post(
                 '/search/extract/download',
-                {criteria: JSON.stringify($scope.criteria)}
+                {
+                    criteria: JSON.stringify($scope.criteria),
+                    projection: JSON.stringify($scope.completeProjection())
+                }
             ).then(function(result){
-                console.log(result.data);
                 $scope.extract_id = result.data.extract_id;
+                $scope.async_progress = 0;
                 ping_until_success();
+            }, function(result){
+                alert(result.data.error);
+                $scope.async_waiting = false;
             });
         }
 
@@ -3,18 +3,21 @@ OPAL Search views
 """
 import datetime
 import json
+import math
 
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseNotFound
+from django.http import (FileResponse, HttpResponseNotFound,
+                         StreamingHttpResponse)
 from django.views.decorators.http import require_http_methods
 from django.views.generic import View, TemplateView
-from django.core.paginator import Paginator
 
 from opal import models
 from opal.core.views import (LoginRequiredMixin, _build_json_response,
                              _get_request_data, with_no_caching)
-from opal.core.search import queries
-from opal.core.search.extract import zip_archive, async_extract
+from opal.core.exceptions import ExtractError, SearchError
+from opal.core.search import jobs, queries
+from opal.core.search.extract import (zip_archive_stream, async_extract,
+                                      validate_projection)
 
 PAGINATION_AMOUNT = 10
 
@@ -31,13 +34,23 @@ class ExtractTemplateView(TemplateView):
     template_name = 'extract.html'
 
 
-def _add_pagination(eps, page_number):
-    paginator = Paginator(eps, PAGINATION_AMOUNT)
+def _add_pagination(query, page_number):
+    """
+    Return page PAGE_NUMBER of the patient summaries for QUERY.
+
+    Only the patients on this page are summarised, and the total is
+    counted in the database.
+    """
+    page_number = max(int(page_number), 1)
+    total_count = query.count_patients()
+    total_pages = max(1, int(math.ceil(total_count / float(PAGINATION_AMOUNT))))
+    offset = (page_number - 1) * PAGINATION_AMOUNT
     results = {
-        "object_list": paginator.page(page_number).object_list,
+        "object_list": query.get_patient_summaries(
+            limit=PAGINATION_AMOUNT, offset=offset),
         "page_number": page_number,
-        "total_pages": paginator.num_pages,
-        "total_count": len(eps),
+        "total_pages": total_pages,
+        "total_count": total_count,
     }
     return results
 
@@ -87,7 +100,10 @@ def patient_search_view(request):
         'column': u'demographics',
     }]
 
-    query = queries.SearchBackend(request.user, criteria)
+    try:
+        query = queries.SearchBackend(request.user, criteria)
+    except SearchError as e:
+        return _build_json_response({'error': str(e)}, 400)
     return _build_json_response(query.patients_as_json())
 
 
@@ -100,9 +116,11 @@ def simple_search_view(request):
     if not all_criteria:
         return _build_json_response({'error': "No search terms"}, 400)
 
-    query = queries.SearchBackend(request.user, all_criteria)
-    eps = query.get_patient_summaries()
-    return _build_json_response(_add_pagination(eps, page_number))
+    try:
+        query = queries.SearchBackend(request.user, all_criteria)
+    except SearchError as e:
+        return _build_json_response({'error': str(e)}, 400)
+    return _build_json_response(_add_pagination(query, page_number))
 
 
 class ExtractSearchView(View):
@@ -113,32 +131,68 @@ class ExtractSearchView(View):
         if "page_number" in request_data[0]:
             page_number = request_data[0].pop("page_number", 1)
 
-        query = queries.SearchBackend(
-            self.request.user,
-            request_data,
-        )
-        eps = query.get_patient_summaries()
-
-        return _build_json_response(_add_pagination(eps, page_number))
+        try:
+            query = queries.SearchBackend(
+                self.request.user,
+                request_data,
+            )
+        except SearchError as e:
+            return _build_json_response({'error': str(e)}, 400)
+        return _build_json_response(_add_pagination(query, page_number))
+
+
+def _get_projection(data):
+    """
+    Return the validated extract projection posted as JSON in DATA, or
+    None if we should extract everything.
+
+    Raise SearchError if it isn't a valid projection.
+    """
+    projection = data.get('projection', None)
+    if not projection:
+        return None
+    try:
+        projection = json.loads(projection)
+    except ValueError:
+        raise SearchError('The extract projection is not valid JSON')
+    if projection is None:
+        return None
+    return validate_projection(projection)
 
 
 class DownloadSearchView(View):
 
     def post(self, *args, **kwargs):
         if getattr(settings, 'EXTRACT_ASYNC', None):
-            criteria = _get_request_data(self.request)['criteria']
-            extract_id = async_extract(
-                self.request.user,
-                json.loads(criteria)
-            )
+            request_data = _get_request_data(self.request)
+            criteria = request_data['criteria']
+            try:
+                queries.SearchBackend(self.request.user, json.loads(criteria))
+                projection = _get_projection(request_data)
+            except SearchError as e:
+                return _build_json_response({'error': str(e)}, 400)
+            try:
+                extract_id = async_extract(
+                    self.request.user,
+                    json.loads(criteria),
+                    projection
+                )
+            except ExtractError as e:
+                return _build_json_response({'error': str(e)}, 429)
             return _build_json_response({'extract_id': extract_id})
 
-        query = queries.SearchBackend(
-            self.request.user, json.loads(self.request.POST['criteria'])
-        )
-        episodes = query.get_episodes()
-        fname = zip_archive(episodes, query.description(), self.request.user)
-        resp = HttpResponse(open(fname, 'rb').read())
+        try:
+            query = queries.SearchBackend(
+                self.request.user, json.loads(self.request.POST['criteria'])
+            )
+            projection = _get_projection(self.request.POST)
+        except SearchError as e:
+            return _build_json_response({'error': str(e)}, 400)
+        episodes = query.get_episode_queryset()
+        resp = StreamingHttpResponse(
+            zip_archive_stream(episodes, query.description(), self.request.user,
+                               projection=projection),
+            content_type='application/zip')
         disp = 'attachment; filename="{0}extract{1}.zip"'.format(
             settings.OPAL_BRAND_NAME, datetime.datetime.now().isoformat())
         resp['Content-Disposition'] = disp
@@ -178,33 +232,44 @@ class FilterDetailView(LoginRequiredMixin, View):
         return _build_json_response('')
 
 
-class ExtractResultView(View):
-                
+class ExtractJobMixin(object):
+    """
+    Look up the extract job in the url, which must belong to this user.
+    """
+    def dispatch(self, *args, **kwargs):
+        try:
+            self.job = models.ExtractJob.objects.get(
+                pk=kwargs['task_id'], user=self.request.user)
+        except (models.ExtractJob.DoesNotExist, ValueError):
+            return HttpResponseNotFound()
+        return super(ExtractJobMixin, self).dispatch(*args, **kwargs)
+
+
+class ExtractResultView(LoginRequiredMixin, ExtractJobMixin, View):
+
     def get(self, *args, **kwargs):
         """
         Tell the client about the state of the extract
         """
-        from celery.result import AsyncResult
-        import taskrunner
-        task_id = kwargs['task_id']
-        result = AsyncResult(id=task_id, app=taskrunner.celery.app)
-        print result.state 
-        
-        return _build_json_response({'state': result.state})
-                
-
-class ExtractFileView(View):
+        return _build_json_response(self.job.to_dict())
+
+
+class ExtractCancelView(LoginRequiredMixin, ExtractJobMixin, View):
+
+    def post(self, *args, **kwargs):
+        jobs.cancel(self.job)
+        self.job.refresh_from_db()
+        return _build_json_response(self.job.to_dict())
+
+
+class ExtractFileView(LoginRequiredMixin, ExtractJobMixin, View):
     def get(self, *args, **kwargs):
-        from celery.result import AsyncResult
-        import taskrunner
-        task_id = kwargs['task_id']
-        result = AsyncResult(id=task_id, app=taskrunner.celery.app)
-        if result.state != 'SUCCESS':
-            raise ValueError('Wrong Task Larry!')
-        print result.state
-        fname = result.get() 
-        resp = HttpResponse(open(fname, 'rb').read())
+        if self.job.state != models.ExtractJob.SUCCESS:
+            return _build_json_response(
+                {'error': 'This extract is {0}'.format(self.job.state)}, 400)
+        resp = FileResponse(
+            open(self.job.file_path, 'rb'), content_type='application/zip')
         disp = 'attachment; filename="{0}extract{1}.zip"'.format(
             settings.OPAL_BRAND_NAME, datetime.datetime.now().isoformat())
         resp['Content-Disposition'] = disp
-        return resp        
+        return resp
@@ -0,0 +1,179 @@
+"""
+OPAL serialization plans - per-class metadata for (de)serializing records
+
+Working out which fields a model serializes, and what kind of field each
+one is, means walking Django's model metadata. We do that once per class
+and keep the result as a SerializationPlan so that to_dict(),
+update_from_dict(), build_field_schema() and the extract writers don't
+repeat it for every row.
+"""
+from django.db import models
+
+from opal.core.fields import ForeignKeyOrFreeText
+from opal.utils import camelcase_to_underscore
+
+_PLANS = {}
+
+
+def _is_foreign_key_attname(cls, name):
+    """
+    Return True if NAME is the column name (e.g. episode_id) of a
+    foreign key on CLS.
+    """
+    return any(isinstance(field, models.ForeignKey) and field.attname == name
+               for field in cls._meta.fields)
+
+
+def resolve_field_type(cls, name):
+    """
+    Given a model CLS and a field NAME, return the type of field NAME is.
+
+    This is the slow path - walking the model metadata - that we compile
+    into a SerializationPlan.
+    """
+    try:
+        return type(cls._meta.get_field_by_name(name)[0])
+    except models.FieldDoesNotExist:
+        pass
+
+    if _is_foreign_key_attname(cls, name):
+        return models.ForeignKey
+
+    try:
+        value = getattr(cls, name)
+        if isinstance(value, ForeignKeyOrFreeText):
+            return ForeignKeyOrFreeText
+
+    except (KeyError, AttributeError):
+        pass
+
+    raise Exception('Unexpected fieldname: %s' % name)
+
+
+class SerializationPlan(object):
+    """
+    The compiled serialization and deserialization metadata for a model
+    class that uses the UpdatesFromDictMixin.
+    """
+    def __init__(self, model):
+        self.model = model
+
+        # Ordered field names, exactly as _get_fieldnames_to_serialize()
+        self.fieldnames = tuple(model._get_fieldnames_to_serialize())
+        self.fieldname_set = frozenset(self.fieldnames)
+        self.extract_fieldnames = tuple(model._get_fieldnames_to_extract())
+
+        self.field_types = {}
+        for name in self.fieldnames:
+            self.field_types[name] = resolve_field_type(model, name)
+
+        # Bound method names for custom getters and setters
+        self.getters = {}
+        self.setters = {}
+        for name in self.fieldnames:
+            if getattr(model, 'get_' + name, None) is not None:
+                self.getters[name] = 'get_' + name
+            if getattr(model, 'set_' + name, None) is not None:
+                self.setters[name] = 'set_' + name
+
+        # Foreign Key or Free Text fields and their underlying pairs
+        self.fkft = {}
+        for name in self.fieldnames:
+            if self.field_types[name] == ForeignKeyOrFreeText:
+                descriptor = getattr(model, name)
+                self.fkft[name] = descriptor
+
+        self.many_to_many = tuple(
+            name for name in self.fieldnames
+            if self.field_types[name] == models.fields.related.ManyToManyField
+        )
+
+        # The fields update_from_dict() sets - the halves of FKorFT pairs
+        # are set via the FKorFT descriptor, and the consistency token is
+        # handled separately.
+        update_fieldnames = []
+        for name in self.fieldnames:
+            if name.endswith('_fk_id') and name[:-6] in self.fieldname_set:
+                continue
+            if name.endswith('_ft') and name[:-3] in self.fieldname_set:
+                continue
+            if name == 'consistency_token':
+                continue
+            update_fieldnames.append(name)
+        self.update_fieldnames = tuple(update_fieldnames)
+
+        self.field_schema = self._compile_field_schema()
+
+    def __repr__(self):
+        return '<SerializationPlan for {0}>'.format(self.model.__name__)
+
+    @property
+    def fk_fields(self):
+        """
+        Return the names of the ForeignKey halves of our FKorFT fields
+        """
+        return [d.fk_field_name for d in self.fkft.values()]
+
+    def _compile_field_schema(self):
+        model = self.model
+        field_schema = []
+        for fieldname in self.fieldnames:
+            if fieldname in ['id', 'patient_id', 'episode_id']:
+                continue
+            elif fieldname.endswith('_fk_id'):
+                continue
+            elif fieldname.endswith('_ft'):
+                continue
+
+            field = self.field_types[fieldname]
+            getter = getattr(model, 'get_field_type_for_' + fieldname, None)
+            if getter is None:
+                if field in [models.CharField, ForeignKeyOrFreeText]:
+                    field_type = 'string'
+                else:
+                    field_type = camelcase_to_underscore(field.__name__[:-5])
+            else:
+                field_type = getter()
+            lookup_list = None
+            if field == ForeignKeyOrFreeText:
+                lookup_list = camelcase_to_underscore(
+                    self.fkft[fieldname].foreign_model.__name__)
+            title = fieldname.replace('_', ' ').title()
+            field_schema.append({'name': fieldname,
+                                 'title': title,
+                                 'type': field_type,
+                                 'lookup_list': lookup_list})
+        return field_schema
+
+
+def get_plan(model):
+    """
+    Return the SerializationPlan for MODEL, compiling it if we
+    haven't seen this class before.
+    """
+    plan = _PLANS.get(model)
+    if plan is None:
+        plan = SerializationPlan(model)
+        _PLANS[model] = plan
+    return plan
+
+
+def compile_plans():
+    """
+    Compile the serialization plans for Episodes and all subrecords.
+
+    Called once the app registry is ready.
+    """
+    from opal.models import Episode
+    from opal.core.subrecords import subrecords
+
+    get_plan(Episode)
+    for subrecord in subrecords():
+        get_plan(subrecord)
+
+
+def reset_plans():
+    """
+    Throw away all compiled plans.
+    """
+    _PLANS.clear()
@@ -31,3 +31,16 @@ def subrecords():
         yield m
     for m in episode_subrecords():
         yield m
+
+def get_subrecord_from_api_name(api_name):
+    """
+    Given the API_NAME of a subrecord (e.g. 'past_medical_history'),
+    return the subrecord class.
+
+    Raise ValueError if no such subrecord exists.
+    """
+    from opal.utils import camelcase_to_underscore
+    for subrecord in subrecords():
+        if camelcase_to_underscore(subrecord.__name__) == api_name:
+            return subrecord
+    raise ValueError('No subrecord named {0}'.format(api_name))
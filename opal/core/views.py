@@ -4,7 +4,7 @@ Re-usable view components
 import functools
 import json
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.core.serializers.json import DjangoJSONEncoder
@@ -27,6 +27,28 @@ def _build_json_response(data, status_code=200):
     response.status_code = status_code
     return response
 
+def _stream_json_list(items):
+    """
+    Generator function that writes ITEMS as a JSON list, serialising
+    each item only as it is consumed.
+    """
+    yield '['
+    for i, item in enumerate(items):
+        if i > 0:
+            yield ','
+        yield json.dumps(item, cls=DjangoJSONEncoder)
+    yield ']'
+
+def _build_json_streaming_response(items, status_code=200):
+    """
+    Return a response that streams the iterable ITEMS to the client
+    as a JSON list, so that we never hold the whole payload in memory.
+    """
+    response = StreamingHttpResponse(_stream_json_list(items))
+    response['Content-Type'] = 'application/json'
+    response.status_code = status_code
+    return response
+
 def with_no_caching(view):
 
     @functools.wraps(view)
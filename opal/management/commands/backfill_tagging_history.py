@@ -0,0 +1,48 @@
+"""
+Load the taggings removed before we kept TaggingHistory from the
+deleted Tagging versions recorded by reversion.
+"""
+import json
+
+from django.core.management.base import BaseCommand
+import reversion
+
+from opal.models import Episode, Tagging, TaggingHistory, Team
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **options):
+        teams_by_name = dict(Team.objects.values_list('name', 'id'))
+        teams = set(teams_by_name.values())
+        episodes = set(Episode.objects.values_list('id', flat=True))
+        existing = set(TaggingHistory.objects.values_list('episode_id', 'team_id'))
+
+        history = []
+        skipped = 0
+        for version in reversion.get_deleted(Tagging).select_related('revision'):
+            data = json.loads(version.serialized_data)[0]['fields']
+            if 'team' in data:
+                team_id = data['team'] if data['team'] in teams else None
+            else:
+                # Taggings from before we had teams
+                team_id = teams_by_name.get(data.get('tag_name'))
+
+            key = (data['episode'], team_id)
+            if team_id is None or data['episode'] not in episodes:
+                skipped += 1
+                continue
+            if key in existing:
+                continue
+            existing.add(key)
+            history.append(TaggingHistory(
+                episode_id=data['episode'],
+                team_id=team_id,
+                removed=version.revision.date_created,
+                removed_by_id=version.revision.user_id
+            ))
+
+        TaggingHistory.objects.bulk_create(history, batch_size=500)
+        print "Created {0} tagging histories".format(len(history))
+        if skipped:
+            print "Skipped {0} for deleted teams or episodes".format(skipped)
+        return
@@ -0,0 +1,12 @@
+"""
+Remove the archives of expired extract jobs.
+"""
+from django.core.management.base import BaseCommand
+
+from opal.core.search import jobs
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **options):
+        count = jobs.cleanup()
+        print "Expired {0} extracts".format(count)
@@ -0,0 +1,74 @@
+"""
+Deliver the spooled Glossolalia messages upstream.
+"""
+from optparse import make_option
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from opal.core import glossolalia
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "--once",
+            action = "store_true",
+            dest = "once",
+            default = False,
+            help = "drain the spool once and exit"
+        ),
+        make_option(
+            "--interval",
+            dest = "interval",
+            type = "float",
+            default = 5,
+            help = "seconds to sleep when there is nothing to send"
+        ),
+        make_option(
+            "--stats",
+            action = "store_true",
+            dest = "stats",
+            default = False,
+            help = "print queue depth and lag, and the worker's send stats, and exit"
+        ),
+        make_option(
+            "--stats-interval",
+            dest = "stats_interval",
+            type = "float",
+            default = 60,
+            help = "seconds between logging and publishing send stats"
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            stats = glossolalia.queue_stats()
+            print "depth: {depth} retrying: {retrying} lag: {lag:.0f}s".format(**stats)
+            sent = glossolalia.published_send_stats()
+            if sent is None:
+                print "No send stats published - is the worker running?"
+                return
+            print "circuit breaker: {state} failures: {failures}".format(
+                **sent['breaker'])
+            for event, latency in sorted(sent['latency'].items()):
+                mean = latency['total'] / max(latency['sent'] + latency['failed'], 1)
+                print "{0}: sent: {1} failed: {2} mean: {3:.3f}s max: {4:.3f}s".format(
+                    event, latency['sent'], latency['failed'], mean, latency['max'])
+            return
+
+        published = None
+        while True:
+            if published is None or time.time() - published >= options['stats_interval']:
+                logging.info('Glossolalia send stats: {0}'.format(
+                    glossolalia.publish_send_stats()))
+                published = time.time()
+            sent, failed = glossolalia.drain()
+            if sent or failed:
+                print "Sent {0} messages, {1} failed (circuit breaker {2})".format(
+                    sent, failed, glossolalia.breaker.state)
+            if options['once']:
+                glossolalia.publish_send_stats()
+                return
+            if not sent:
+                time.sleep(options['interval'])
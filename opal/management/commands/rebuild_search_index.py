@@ -0,0 +1,38 @@
+"""
+Build the search index of patient identifiers and names from scratch.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, transaction
+
+from opal.core.search import index
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "--drop",
+            action = "store_true",
+            dest = "drop",
+            default = False,
+            help = "remove the search index and search with the ORM"
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['drop']:
+            index.drop()
+            print "Dropped search index"
+            return
+        try:
+            with transaction.atomic():
+                count = index.rebuild()
+        except ValueError as e:
+            raise CommandError(str(e))
+        except DatabaseError as e:
+            raise CommandError(
+                'Could not build the search index - this needs FTS5 with the '
+                'trigram tokenizer on SQLite, or the pg_trgm extension (or '
+                'permission to create it) on PostgreSQL: {0}'.format(e))
+        print "Indexed {0} patients".format(count)
+        return
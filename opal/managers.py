@@ -8,8 +8,97 @@ from django.db import models, connection, reset_queries
 
 from opal.core.subrecords import episode_subrecords, patient_subrecords
 
+# How many rows we serialise at once when streaming large result sets
+CHUNK_SIZE = 200
 
-class EpisodeManager(models.Manager):
+
+def chunked(queryset, chunk_size=None):
+    """
+    Generator function that yields lists of at most CHUNK_SIZE
+    instances from QUERYSET, walking it in primary key order so that
+    only one chunk is ever held in memory.
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def subrecords_for(model, **filters):
+    """
+    Return a queryset of MODEL subrecords matching FILTERS that will
+    serialise without further per-row queries.
+    """
+    plan = model._get_serialization_plan()
+    subrecords = model.objects.filter(**filters)
+    if plan.fk_fields:
+        subrecords = subrecords.select_related(*plan.fk_fields)
+    if plan.many_to_many:
+        subrecords = subrecords.prefetch_related(*plan.many_to_many)
+    return subrecords
+
+
+class EpisodeQueryset(models.QuerySet):
+
+    def visible_to(self, user):
+        """
+        Return the episodes in this queryset that USER is allowed to know
+        about: those that are untagged, tagged to an unrestricted team, or
+        tagged to one of the restricted teams USER has access to.
+
+        This is a filter with subqueries, so nothing is loaded until the
+        queryset is evaluated.
+        """
+        from opal.models import Tagging, Team
+
+        teams = [t.id for t in Team.restricted_teams(user)]
+        tagged = Tagging.objects.values('episode_id')
+        allowed = Tagging.objects.filter(
+            models.Q(team__restricted=False) | models.Q(team__in=teams)
+        ).values('episode_id')
+        return self.filter(~models.Q(id__in=tagged) | models.Q(id__in=allowed))
+
+    def restricted_to(self, user):
+        """
+        Return the episodes in this queryset that are tagged to one of the
+        restricted teams USER has access to - what a restricted only user
+        is allowed to know about.
+        """
+        from opal.models import Tagging, Team
+
+        teams = [t.id for t in Team.restricted_teams(user)]
+        allowed = Tagging.objects.filter(team__in=teams).values('episode_id')
+        return self.filter(id__in=allowed)
+
+    def ever_tagged(self, team):
+        """
+        Return the episodes in this queryset that are, or have ever been,
+        tagged to TEAM.
+
+        Current taggings and TaggingHistory are both matched by subquery
+        on their (team, episode) indexes, so each episode appears once.
+        """
+        from opal.models import Tagging, TaggingHistory
+
+        team_name = team.lower().replace(' ', '_')
+        current = Tagging.objects.filter(team__name=team_name)
+        historic = TaggingHistory.objects.filter(team__name=team_name)
+        return self.filter(
+            models.Q(id__in=current.values('episode_id')) |
+            models.Q(id__in=historic.values('episode_id'))
+        )
+
+
+class EpisodeManager(models.Manager.from_queryset(EpisodeQueryset)):
 
     def serialised_episode_subrecords(self, episodes, user):
         """
@@ -21,68 +110,113 @@ class EpisodeManager(models.Manager):
 
         for model in episode_subrecords():
             name = model.get_api_name()
-            subrecords = model.objects.filter(episode__in=episodes)
-
-            for related in model._meta.many_to_many:
-                subrecords = subrecords.prefetch_related(related.attname)
+            subrecords = subrecords_for(model, episode__in=episodes)
 
             for sub in subrecords:
                 episode_subs[sub.episode_id][name].append(sub.to_dict(user))
         return episode_subs
 
-    def serialised(self, user, episodes, historic_tags=False, episode_history=False):
+    def serialised_patient_subrecords(self, patient_ids, user):
         """
-        Return a set of serialised EPISODES.
-
-        If HISTORIC_TAGS is Truthy, return deleted tags as well.
-        If EPISODE_HISTORY is Truthy return historic episodes as well.
+        Return all serialised patient subrecords for this set of
+        PATIENT_IDS in a nested hashtable where the outer key is the
+        patient id, the inner key the subrecord API name.
         """
-        patient_ids = [e.patient_id for e in episodes]
         patient_subs = defaultdict(lambda: defaultdict(list))
 
-        episode_subs = self.serialised_episode_subrecords(episodes, user)
         for model in patient_subrecords():
             name = model.get_api_name()
-            subrecords = model.objects.filter(patient__in=patient_ids)
+            subrecords = subrecords_for(model, patient__in=patient_ids)
 
             for sub in subrecords:
                 patient_subs[sub.patient_id][name].append(sub.to_dict(user))
+        return patient_subs
 
+    def serialised_taggings(self, episodes, user):
+        """
+        Return the current tagging for this set of EPISODES as a
+        hashtable keyed by episode id, in the same shape as
+        Episode.tagging_dict().
+        """
         # We do this here because it's an order of magnitude quicker than hitting
         # episode.tagging_dict() for each episode in a loop.
-        taggings = defaultdict(dict)
         from opal.models import Tagging
-        for tag in Tagging.objects.filter(episode__in=episodes).select_related('team'):
-            if tag.team.name == 'mine' and tag.user != user:
+
+        user_id = getattr(user, 'id', None)
+        taggings = defaultdict(dict)
+        tags = Tagging.objects.filter(
+            episode__in=episodes, team__isnull=False).select_related('team')
+        for tag in tags:
+            if tag.team.name == 'mine' and tag.user_id != user_id:
                 continue
             taggings[tag.episode_id][tag.team.name] = True
+        return taggings
+
+    def serialised_episode_history(self, patient_ids, user):
+        """
+        Return the shallow serialised episode history for this set of
+        PATIENT_IDS as a hashtable keyed by patient id.
+        """
+        order = 'date_of_episode', 'date_of_admission', 'discharge_date'
+        history = self.filter(patient__in=patient_ids).visible_to(user)
+        history = history.order_by(*order)
+
+        episode_history = defaultdict(list)
+        for episode in history:
+            episode_history[episode.patient_id].append(
+                episode.to_dict(user, shallow=True))
+        return episode_history
+
+    def _serialised_episode(self, episode, user, episode_subs, patient_subs, taggings):
+        """
+        Assemble the serialisation of a single EPISODE from batch loaded
+        subrecords and taggings.
+        """
+        d = episode.to_dict(user, shallow=True)
+
+        for model in episode_subrecords():
+            name = model.get_api_name()
+            d[name] = episode_subs[episode.id][name]
+        for model in patient_subrecords():
+            name = model.get_api_name()
+            d[name] = patient_subs[episode.patient_id][name]
+
+        tagging = taggings[episode.id]
+        tagging['id'] = episode.id
+        d['tagging'] = [tagging]
+        return d
+
+    def serialised(self, user, episodes, historic_tags=False, episode_history=False):
+        """
+        Return a set of serialised EPISODES.
+
+        If HISTORIC_TAGS is Truthy, return deleted tags as well.
+        If EPISODE_HISTORY is Truthy return historic episodes as well.
+
+        The number of queries this makes depends on the number of
+        subrecord types, not the number of episodes or subrecords.
+        """
+        episodes = list(episodes)
+        patient_ids = set(e.patient_id for e in episodes)
+
+        episode_subs = self.serialised_episode_subrecords(episodes, user)
+        patient_subs = self.serialised_patient_subrecords(patient_ids, user)
+        taggings = self.serialised_taggings(episodes, user)
+        if episode_history:
+            history = self.serialised_episode_history(patient_ids, user)
 
         serialised = []
         for e in episodes:
-            d = {
-                'id'               : e.id,
-                'category'         : e.category,
-                'active'           : e.active,
-                'date_of_admission': e.date_of_admission,
-                'date_of_episode'  : e.date_of_episode,
-                'discharge_date'   : e.discharge_date,
-                'consistency_token': e.consistency_token
-                }
-
-            for key, value in episode_subs[e.id].items():
-                d[key] = value
-            for key, value in patient_subs[e.patient_id].items():
-                d[key] = value
-
-            d['tagging'] = [taggings[e.id]]
-            serialised.append(d)
+            d = self._serialised_episode(
+                e, user, episode_subs, patient_subs, taggings)
 
             if episode_history:
-                d['episode_history'] = e._episode_history_to_dict(user)
+                d['episode_history'] = history[e.patient_id]
 
+            serialised.append(d)
 
         if historic_tags:
-            print 'Historic Tags'
+            from opal.models import Tagging
             historic = Tagging.historic_tags_for_episodes(episodes)
             for episode in serialised:
                 if episode['id'] in historic:
@@ -90,9 +224,19 @@ class EpisodeManager(models.Manager):
                     for t in historic_tags.keys():
                         episode['tagging'][0][t] = True
 
-
         return serialised
 
+    def serialised_iterator(self, user, episodes, chunk_size=None, **kw):
+        """
+        Generator function that yields serialised EPISODES one at a time,
+        loading and serialising them CHUNK_SIZE at a time.
+
+        KWARGS will be passed to serialised().
+        """
+        for chunk in chunked(episodes, chunk_size):
+            for serialised in self.serialised(user, chunk, **kw):
+                yield serialised
+
     def serialised_active(self, user, **kw):
         """
         Return a set of serialised active episodes.
@@ -105,13 +249,70 @@ class EpisodeManager(models.Manager):
         as_dict = self.serialised(user, episodes)
         return as_dict
 
-    def ever_tagged(self, team):
+    def serialised_active_iterator(self, user, **kw):
         """
-        Return a list of episodes that were ever tagged to TEAM
+        Generator function that yields serialised active episodes.
+
+        KWARGS will be passed to the episode filter.
         """
-        from opal.models import Tagging
+        filters = kw.copy()
+        filters['active'] = True
+        episodes = self.filter(**filters)
+        return self.serialised_iterator(user, episodes)
 
-        team_name = team.lower().replace(' ', '_')
-        current = self.filter(tagging__team__name=team_name)
-        historic = Tagging.historic_episodes_for_tag(team_name)
-        return list(historic) + list(current)
+
+class PatientManager(models.Manager):
+
+    def serialised(self, user, patients):
+        """
+        Return a set of serialised PATIENTS, including all of their
+        episodes.
+
+        Subrecords, taggings and episode history are loaded for the whole
+        set of patients at once, and each is serialised exactly once.
+        """
+        from opal.models import Episode
+
+        patients = list(patients)
+        patient_ids = [p.id for p in patients]
+        episodes = list(Episode.objects.filter(patient__in=patient_ids))
+
+        episode_subs = Episode.objects.serialised_episode_subrecords(episodes, user)
+        patient_subs = Episode.objects.serialised_patient_subrecords(patient_ids, user)
+        taggings = Episode.objects.serialised_taggings(episodes, user)
+        history = Episode.objects.serialised_episode_history(patient_ids, user)
+
+        patient_episodes = defaultdict(dict)
+        active_episode_ids = {}
+        for e in episodes:
+            d = Episode.objects._serialised_episode(
+                e, user, episode_subs, patient_subs, taggings)
+            d['episode_history'] = history[e.patient_id]
+            patient_episodes[e.patient_id][e.id] = d
+
+            if e.active:
+                active_episode_ids[e.patient_id] = max(
+                    e.id, active_episode_ids.get(e.patient_id, e.id))
+
+        serialised = []
+        for patient in patients:
+            d = {
+                'id': patient.id,
+                'episodes': patient_episodes[patient.id],
+                'active_episode_id': active_episode_ids.get(patient.id, None),
+            }
+            for model in patient_subrecords():
+                name = model.get_api_name()
+                d[name] = patient_subs[patient.id][name]
+            serialised.append(d)
+
+        return serialised
+
+    def serialised_iterator(self, user, patients, chunk_size=None):
+        """
+        Generator function that yields serialised PATIENTS one at a time,
+        loading and serialising them CHUNK_SIZE at a time.
+        """
+        for chunk in chunked(patients, chunk_size):
+            for serialised in self.serialised(user, chunk):
+                yield serialised
\ No newline at end of file
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opal', '0006_auto_20151109_1232'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GlossolaliaMessage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('event', models.CharField(max_length=50)),
+                ('ordering_key', models.CharField(default=b'', max_length=50, db_index=True, blank=True)),
+                ('payload', models.TextField()),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, db_index=True)),
+                ('last_error', models.TextField(default=b'', blank=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('opal', '0007_glossolaliamessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaggingHistory',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('removed', models.DateTimeField(default=django.utils.timezone.now)),
+                ('episode', models.ForeignKey(to='opal.Episode')),
+                ('removed_by', models.ForeignKey(blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+                ('team', models.ForeignKey(to='opal.Team')),
+            ],
+            options={
+                'verbose_name_plural': 'Tagging histories',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='tagginghistory',
+            index_together=set([('team', 'episode')]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opal', '0008_tagginghistory'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='tagging',
+            index_together=set([('team', 'episode')]),
+        ),
+    ]
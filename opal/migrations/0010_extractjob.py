@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('opal', '0009_tagging_index_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('criteria', models.TextField()),
+                ('state', models.CharField(default=b'PENDING', max_length=10, choices=[(b'PENDING', b'PENDING'), (b'STARTED', b'STARTED'), (b'SUCCESS', b'SUCCESS'), (b'FAILURE', b'FAILURE'), (b'CANCELLED', b'CANCELLED'), (b'EXPIRED', b'EXPIRED')])),
+                ('rows_written', models.PositiveIntegerField(default=0)),
+                ('rows_total', models.PositiveIntegerField(default=0)),
+                ('file_path', models.CharField(default=b'', max_length=255, blank=True)),
+                ('error', models.TextField(default=b'', blank=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished', models.DateTimeField(null=True, blank=True)),
+                ('expires', models.DateTimeField(db_index=True, null=True, blank=True)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='extractjob',
+            index_together=set([('user', 'state')]),
+        ),
+    ]
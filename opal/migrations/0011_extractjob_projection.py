@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opal', '0010_extractjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extractjob',
+            name='projection',
+            field=models.TextField(default=b'', blank=True),
+        ),
+    ]
@@ -18,9 +18,8 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.template import TemplateDoesNotExist
 from django.template.loader import select_template
 from django.utils import dateparse
-import reversion
 
-from opal.core import application, exceptions, lookuplists, plugins
+from opal.core import application, exceptions, lookuplists, plugins, serialization
 from opal import managers
 from opal.utils import camelcase_to_underscore
 from opal.core.fields import ForeignKeyOrFreeText
@@ -73,25 +72,18 @@ class UpdatesFromDictMixin(object):
         return fieldnames
 
     @classmethod
-    def _get_field_type(cls, name):
-        try:
-            return type(cls._meta.get_field_by_name(name)[0])
-        except models.FieldDoesNotExist:
-            pass
-
-        # TODO: Make this dynamic
-        if name in ['patient_id', 'episode_id', 'gp_id', 'nurse_id']:
-            return models.ForeignKey
-
-        try:
-            value = getattr(cls, name)
-            if isinstance(value, ForeignKeyOrFreeText):
-                return ForeignKeyOrFreeText
-
-        except KeyError:
-            pass
+    def _get_serialization_plan(cls):
+        """
+        Return the compiled SerializationPlan for this class.
+        """
+        return serialization.get_plan(cls)
 
-        raise Exception('Unexpected fieldname: %s' % name)
+    @classmethod
+    def _get_field_type(cls, name):
+        field_types = cls._get_serialization_plan().field_types
+        if name in field_types:
+            return field_types[name]
+        return serialization.resolve_field_type(cls, name)
 
     @classmethod
     def get_field_type_for_consistency_token(cls):
@@ -160,34 +152,36 @@ class UpdatesFromDictMixin(object):
             if consistency_token != self.consistency_token:
                 raise exceptions.ConsistencyError
 
-        fields = set(self._get_fieldnames_to_serialize())
+        post_save = self._update_fields_from_dict(data, user)
+        self.save()
+
+        for some_func in post_save:
+            some_func()
+
+    def _update_fields_from_dict(self, data, user):
+        """
+        Set our fields from DATA without saving, returning the
+        functions that must be called once we have been saved.
+        """
+        plan = self._get_serialization_plan()
 
         post_save = []
 
-        unknown_fields = set(data.keys()) - fields
+        unknown_fields = set(data.keys()) - plan.fieldname_set
 
         if unknown_fields:
             raise exceptions.APIError(
                 'Unexpected fieldname(s): %s' % list(unknown_fields))
 
-        for name in fields:
+        for name in plan.update_fieldnames:
             value = data.get(name, None)
 
-            if name.endswith('_fk_id'):
-                if name[:-6] in fields:
-                    continue
-            if name.endswith('_ft'):
-                if name[:-3] in fields:
-                    continue
-
-            if name == 'consistency_token':
-                continue # shouldn't be needed - Javascripts bug?
-            setter = getattr(self, 'set_' + name, None)
+            setter = plan.setters.get(name, None)
             if setter is not None:
-                setter(value, user, data)
+                getattr(self, setter)(value, user, data)
             else:
                 if name in data:
-                    field_type = self._get_field_type(name)
+                    field_type = plan.field_types[name]
 
                     if field_type == models.fields.related.ManyToManyField:
                         post_save.append(functools.partial(self.save_many_to_many, name, value, field_type))
@@ -200,10 +194,7 @@ class UpdatesFromDictMixin(object):
                         setattr(self, name, value)
 
         self.set_consistency_token()
-        self.save()
-
-        for some_func in post_save:
-            some_func()
+        return post_save
 
 
 class Filter(models.Model):
@@ -356,6 +347,8 @@ class Macro(models.Model):
 
 
 class Patient(models.Model):
+    objects = managers.PatientManager()
+
     def __unicode__(self):
         try:
             demographics = self.demographics_set.get()
@@ -376,17 +369,7 @@ class Patient(models.Model):
         return None
 
     def to_dict(self, user):
-        active_episode = self.get_active_episode()
-        d = {
-            'id': self.id,
-            'episodes': {episode.id: episode.to_dict(user) for episode in self.episode_set.all()},
-            'active_episode_id': active_episode.id if active_episode else None,
-            }
-
-        for model in patient_subrecords():
-            subrecords = model.objects.filter(patient_id=self.id)
-            d[model.get_api_name()] = [subrecord.to_dict(user) for subrecord in subrecords]
-        return d
+        return Patient.objects.serialised(user, [self])[0]
 
     def update_from_demographics_dict(self, demographics_data, user):
         demographics = self.demographics_set.get()
@@ -521,6 +504,11 @@ class Episode(UpdatesFromDictMixin, TrackedModel):
                     params['user'] = user
                 tag = self.tagging_set.get(**params)
                 tag.delete()
+                removed_by = None
+                if user is not None and user.is_authenticated():
+                    removed_by = user
+                TaggingHistory.objects.create(
+                    episode=self, team_id=tag.team_id, removed_by=removed_by)
 
         for tag_name in tag_names:
             if tag_name not in original_tag_names:
@@ -570,12 +558,9 @@ class Episode(UpdatesFromDictMixin, TrackedModel):
         """
         Return a serialised version of this patient's episode history
         """
-        from opal.core.search.queries import episodes_for_user
-
-        order = 'date_of_episode', 'date_of_admission', 'discharge_date'
-        episode_history = self.patient.episode_set.order_by(*order)
-        episode_history = episodes_for_user(episode_history, user)
-        return [e.to_dict(user, shallow=True) for e in episode_history]
+        history = Episode.objects.serialised_episode_history(
+            [self.patient_id], user)
+        return history[self.patient_id]
 
     def to_dict(self, user, shallow=False):
         """
@@ -593,19 +578,7 @@ class Episode(UpdatesFromDictMixin, TrackedModel):
         if shallow:
             return d
 
-        for model in patient_subrecords():
-            subrecords = model.objects.filter(patient_id=self.patient.id)
-            d[model.get_api_name()] = [subrecord.to_dict(user)
-                                       for subrecord in subrecords]
-        for model in episode_subrecords():
-            subrecords = model.objects.filter(episode_id=self.id)
-            d[model.get_api_name()] = [subrecord.to_dict(user)
-                                       for subrecord in subrecords]
-
-        d['tagging'] = self.tagging_dict(user)
-
-        d['episode_history'] = self._episode_history_to_dict(user)
-        return d
+        return Episode.objects.serialised(user, [self], episode_history=True)[0]
 
 
 class Subrecord(UpdatesFromDictMixin, TrackedModel, models.Model):
@@ -637,34 +610,7 @@ class Subrecord(UpdatesFromDictMixin, TrackedModel, models.Model):
 
     @classmethod
     def build_field_schema(cls):
-        field_schema = []
-        for fieldname in cls._get_fieldnames_to_serialize():
-            if fieldname in ['id', 'patient_id', 'episode_id']:
-                continue
-            elif fieldname.endswith('_fk_id'):
-                continue
-            elif fieldname.endswith('_ft'):
-                continue
-
-            getter = getattr(cls, 'get_field_type_for_' + fieldname, None)
-            if getter is None:
-                field = cls._get_field_type(fieldname)
-                if field in [models.CharField, ForeignKeyOrFreeText]:
-                    field_type = 'string'
-                else:
-                    field_type = camelcase_to_underscore(field.__name__[:-5])
-            else:
-                field_type = getter()
-            lookup_list = None
-            if cls._get_field_type(fieldname) == ForeignKeyOrFreeText:
-                fld = getattr(cls, fieldname)
-                lookup_list = camelcase_to_underscore(fld.foreign_model.__name__)
-            title = fieldname.replace('_', ' ').title()
-            field_schema.append({'name': fieldname,
-                                 'title': title,
-                                 'type': field_type,
-                                 'lookup_list': lookup_list})
-        return field_schema
+        return [dict(f) for f in cls._get_serialization_plan().field_schema]
 
     @classmethod
     def get_display_template(cls, team=None, subteam=None):
@@ -724,14 +670,14 @@ class Subrecord(UpdatesFromDictMixin, TrackedModel, models.Model):
         Allow a subset of FIELDNAMES
         """
 
+        plan = self._get_serialization_plan()
         d = {}
         for name in fieldnames:
-            getter = getattr(self, 'get_' + name, None)
+            getter = plan.getters.get(name, None)
             if getter is not None:
-                value = getter(user)
+                value = getattr(self, getter)(user)
             else:
-                field_type = self._get_field_type(name)
-                if field_type == models.fields.related.ManyToManyField:
+                if name in plan.many_to_many:
                     qs = getattr(self, name).all()
                     value = [i.to_dict(user) for i in qs]
                 else:
@@ -741,7 +687,7 @@ class Subrecord(UpdatesFromDictMixin, TrackedModel, models.Model):
         return d
 
     def to_dict(self, user):
-        return self._to_dict(user, self._get_fieldnames_to_serialize())
+        return self._to_dict(user, self._get_serialization_plan().fieldnames)
 
 
 class PatientSubrecord(Subrecord):
@@ -767,6 +713,9 @@ class Tagging(TrackedModel, models.Model):
     user = models.ForeignKey(User, null=True, blank=True)
     episode = models.ForeignKey(Episode, null=False)
 
+    class Meta:
+        index_together = [('team', 'episode')]
+
     def __unicode__(self):
         if self.user is not None:
             return 'User: %s - %s' % (self.user.username, self.team.name)
@@ -800,28 +749,11 @@ class Tagging(TrackedModel, models.Model):
         Given a list of episodes, return a dict indexed by episode id
         that contains historic tags for those episodes.
         """
-        episode_ids = [e.id for e in episodes]
-        teams = {t.id: t.name for t in Team.objects.all()}
-        deleted = reversion.get_deleted(cls)
+        removed = TaggingHistory.objects.filter(episode__in=episodes)
+        removed = removed.values_list('episode_id', 'team__name').distinct()
         historic = collections.defaultdict(dict)
-        for d in deleted:
-            data = json.loads(d.serialized_data)[0]['fields']
-            if data['episode'] in episode_ids:
-                if 'team' in data:
-                    if data['team'] in teams:
-                        tag_name = teams[data['team']]
-                    else:
-                        print 'Team has been deleted since it was serialised.'
-                        print 'We ignore these for now.'
-                        continue
-                else:
-                    try:
-                        tag_name = data['tag_name']
-                    except KeyError:
-                        print json.dumps(data, indent=2)
-                        raise exceptions.FTWLarryError("Can't find the team in this data :(")
-
-                historic[data['episode']][tag_name] = True
+        for episode_id, tag_name in removed:
+            historic[episode_id][tag_name] = True
         return historic
 
     @classmethod
@@ -830,30 +762,114 @@ class Tagging(TrackedModel, models.Model):
         Given a TAG return a list of episodes that have historically been
         tagged with it.
         """
-        teams = {t.id: t.name for t in Team.objects.all()}
-        deleted = reversion.get_deleted(cls)
-        eids = set()
-        for d in deleted:
-            data = json.loads(d.serialized_data)[0]['fields']
-            try:
-                team_index = data['team']
-                if team_index not in teams:
-                    print "Can't find deleted team by index - we think the team has been deleted? "
-                    print "DATA:"
-                    print json.dumps(data, indent=2)
-                    print "TEAMS:"
-                    print json.dumps(teams, indent=2)
-                    continue
-                tag_name = teams[team_index]
+        removed = TaggingHistory.objects.filter(team__name=tag)
+        return Episode.objects.filter(id__in=removed.values('episode_id'))
 
-            except KeyError:
-                tag_name = data['tag_name']
 
-            if tag_name == tag:
-                eids.add(data['episode'])
+class TaggingHistory(models.Model):
+    """
+    A tagging that has been removed from an episode.
 
-        historic = Episode.objects.filter(id__in=eids)
-        return historic
+    Written by Episode.set_tag_names() so that we can find the teams an
+    episode has ever been tagged to without walking reversion's deleted
+    versions. Existing history can be loaded with the
+    backfill_tagging_history management command.
+    """
+    episode    = models.ForeignKey(Episode)
+    team       = models.ForeignKey(Team)
+    removed    = models.DateTimeField(default=timezone.now)
+    removed_by = models.ForeignKey(User, blank=True, null=True)
+
+    class Meta:
+        index_together = [('team', 'episode')]
+        verbose_name_plural = 'Tagging histories'
+
+    def __unicode__(self):
+        return u'{0} {1}'.format(self.episode_id, self.team_id)
+
+
+class GlossolaliaMessage(models.Model):
+    """
+    An event waiting to be sent to our upstream integration service.
+
+    Messages are appended by opal.core.glossolalia and deleted once
+    they have been delivered.
+    """
+    created      = models.DateTimeField(default=timezone.now)
+    event        = models.CharField(max_length=50)
+    ordering_key = models.CharField(max_length=50, blank=True, default='',
+                                    db_index=True)
+    payload      = models.TextField()
+    attempts     = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error   = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return u'{0} {1}'.format(self.event, self.ordering_key)
+
+
+class ExtractJob(models.Model):
+    """
+    A data extract being built in the background for a user.
+
+    Jobs are created and run by opal.core.search.jobs. States use the
+    same names as Celery so that clients can treat them alike.
+    """
+    PENDING   = 'PENDING'
+    STARTED   = 'STARTED'
+    SUCCESS   = 'SUCCESS'
+    FAILURE   = 'FAILURE'
+    CANCELLED = 'CANCELLED'
+    EXPIRED   = 'EXPIRED'
+
+    STATES = (PENDING, STARTED, SUCCESS, FAILURE, CANCELLED, EXPIRED)
+    RUNNING = (PENDING, STARTED)
+
+    user         = models.ForeignKey(User)
+    criteria     = models.TextField()
+    projection   = models.TextField(blank=True, default='')
+    state        = models.CharField(max_length=10, default=PENDING,
+                                    choices=[(s, s) for s in STATES])
+    rows_written = models.PositiveIntegerField(default=0)
+    rows_total   = models.PositiveIntegerField(default=0)
+    file_path    = models.CharField(max_length=255, blank=True, default='')
+    error        = models.TextField(blank=True, default='')
+    created      = models.DateTimeField(default=timezone.now)
+    finished     = models.DateTimeField(blank=True, null=True)
+    expires      = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    class Meta:
+        index_together = [('user', 'state')]
+
+    def __unicode__(self):
+        return u'{0} {1}'.format(self.user_id, self.state)
+
+    @property
+    def progress(self):
+        """
+        Percentage of the estimated rows we have written.
+        """
+        if self.state == self.SUCCESS:
+            return 100
+        if not self.rows_total:
+            return 0
+        return min(99, int(100 * self.rows_written / self.rows_total))
+
+    def to_dict(self):
+        return dict(
+            id=self.pk,
+            state=self.state,
+            progress=self.progress,
+            rows_written=self.rows_written,
+            rows_total=self.rows_total,
+            error=self.error,
+            created=self.created,
+            finished=self.finished,
+            expires=self.expires,
+        )
 
 
 """
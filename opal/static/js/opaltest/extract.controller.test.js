@@ -129,6 +129,30 @@ describe('ExtractCtrl', function(){
         });
     });
 
+    describe('Choosing what to extract', function(){
+        it('should extract everything by default', function(){
+            expect($scope.completeProjection()).toBe(null);
+        });
+
+        it('should list the chosen fields of chosen columns', function(){
+            $scope.projection = {
+                demographics: {selected: true, fields: {name: true, gender: false}},
+                diagnosis: {selected: true},
+                colour: {selected: false, fields: {name: true}}
+            };
+            expect($scope.completeProjection()).toEqual({
+                demographics: ['name'],
+                diagnosis: null
+            });
+        });
+
+        it('should keep the choice when criteria are cleared', function(){
+            $scope.projection = {diagnosis: {selected: true}};
+            $scope.removeCriteria();
+            expect($scope.completeProjection()).toEqual({diagnosis: null});
+        });
+    });
+
     describe('Getting searchable columns', function(){
         it('should only get the columns that are advanced searchable', function(){
             expect($scope.columns).toEqual([columnsData[1]])
@@ -1,12 +1,14 @@
 """
 Tests for the OPAL API
 """
+import json
 from datetime import date, timedelta
 from django.utils import timezone
 
 from django.contrib.auth.models import User
 from django.test import TestCase
 from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
 from mock import patch, MagicMock
 
 from opal import models
@@ -186,6 +188,39 @@ class SubrecordTestCase(TestCase):
         self.assertEqual(202, response.status_code)
         self.assertEqual(1, change.call_count)
 
+    def test_update_does_not_snapshot_when_not_integrating(self):
+        colour = Colour.objects.create(name='blue', episode=self.episode)
+        mock_request = MagicMock(name='mock request')
+        mock_request.data = {
+            'name'             : 'green',
+            'episode_id'       : self.episode.pk,
+            'id'               : colour.pk,
+            'consistency_token': colour.consistency_token
+        }
+        mock_request.user = self.user
+        with patch.object(models.Episode, 'to_dict') as to_dict:
+            with patch('opal.core.glossolalia.INTEGRATING', new=False):
+                response = self.viewset().update(mock_request, pk=colour.pk)
+        self.assertEqual(202, response.status_code)
+        self.assertFalse(to_dict.called)
+
+    @patch('opal.core.api.glossolalia.change')
+    def test_update_snapshots_when_integrating(self, change):
+        colour = Colour.objects.create(name='blue', episode=self.episode)
+        mock_request = MagicMock(name='mock request')
+        mock_request.data = {
+            'name'             : 'green',
+            'episode_id'       : self.episode.pk,
+            'id'               : colour.pk,
+            'consistency_token': colour.consistency_token
+        }
+        mock_request.user = self.user
+        with patch('opal.core.glossolalia.INTEGRATING', new=True):
+            self.viewset().update(mock_request, pk=colour.pk)
+        pre, post = change.call_args[0]
+        self.assertEqual('blue', pre['colour'][0]['name'])
+        self.assertEqual('green', post['colour'][0]['name'])
+
     def test_update_item_changed(self):
         created = timezone.now() - timedelta(1)
 
@@ -253,6 +288,102 @@ class SubrecordTestCase(TestCase):
         self.assertEqual(1, change.call_count)
 
 
+class BatchTestCase(TestCase):
+
+    def setUp(self):
+        self.patient = models.Patient.objects.create()
+        self.episode = models.Episode.objects.create(patient=self.patient)
+        self.user = User.objects.create(username='testuser')
+        self.mock_request = MagicMock(name='request')
+        self.mock_request.user = self.user
+
+    def _post(self, items):
+        self.mock_request.data = {'episode_id': self.episode.pk, 'items': items}
+        return api.BatchViewSet().create(self.mock_request)
+
+    def test_create_update_and_delete(self):
+        green = Colour.objects.create(name='green', episode=self.episode)
+        red = Colour.objects.create(name='red', episode=self.episode)
+        response = self._post([
+            {'action': 'create', 'record': 'colour', 'data': {'name': 'blue'}},
+            {'action': 'create', 'record': 'patient_colour', 'data': {'name': 'pink'}},
+            {'action': 'update', 'record': 'colour', 'id': green.pk,
+             'data': {'name': 'teal', 'consistency_token': green.consistency_token}},
+            {'action': 'delete', 'record': 'colour', 'id': red.pk, 'data': {}},
+        ])
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.data['applied'])
+        self.assertEqual([201, 201, 202, 202],
+                         [r['status'] for r in response.data['results']])
+        self.assertEqual(['blue', 'teal'],
+                         sorted(Colour.objects.values_list('name', flat=True)))
+        self.assertEqual(self.patient, PatientColour.objects.get(name='pink').patient)
+        self.assertEqual(response.data['episode'], self.episode.to_dict(self.user))
+
+    def test_single_revision(self):
+        import reversion
+        from reversion.models import Revision
+        if not reversion.is_registered(Colour):
+            reversion.register(Colour)
+            self.addCleanup(reversion.unregister, Colour)
+        self._post([
+            {'action': 'create', 'record': 'colour', 'data': {'name': 'blue'}},
+            {'action': 'create', 'record': 'colour', 'data': {'name': 'red'}},
+        ])
+        self.assertEqual(1, Revision.objects.count())
+        self.assertEqual(2, Revision.objects.get().version_set.count())
+
+    @patch('opal.core.api.glossolalia.change')
+    def test_pings_integration_once(self, change):
+        self._post([
+            {'action': 'create', 'record': 'colour', 'data': {'name': 'blue'}},
+            {'action': 'create', 'record': 'colour', 'data': {'name': 'red'}},
+        ])
+        self.assertEqual(1, change.call_count)
+
+    @patch('opal.core.api.glossolalia.change')
+    def test_item_changed_rolls_back(self, change):
+        green = Colour.objects.create(
+            name='green', episode=self.episode, consistency_token='frist')
+        response = self._post([
+            {'action': 'create', 'record': 'colour', 'data': {'name': 'blue'}},
+            {'action': 'update', 'record': 'colour', 'id': green.pk,
+             'data': {'name': 'teal', 'consistency_token': 'wat'}},
+        ])
+        self.assertEqual(409, response.status_code)
+        self.assertFalse(response.data['applied'])
+        self.assertEqual([201, 409], [r['status'] for r in response.data['results']])
+        self.assertEqual(['green'], list(Colour.objects.values_list('name', flat=True)))
+        self.assertEqual(0, change.call_count)
+
+    def test_unexpected_field(self):
+        response = self._post([
+            {'action': 'create', 'record': 'colour', 'data': {'name': 'blue', 'hue': 'on'}},
+        ])
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(0, Colour.objects.count())
+
+    def test_unknown_record(self):
+        response = self._post([{'action': 'create', 'record': 'notathing', 'data': {}}])
+        self.assertEqual(400, response.status_code)
+
+    def test_unknown_action(self):
+        response = self._post([{'action': 'frobnicate', 'record': 'colour', 'data': {}}])
+        self.assertEqual(400, response.status_code)
+
+    def test_item_from_another_episode(self):
+        other = models.Episode.objects.create(patient=self.patient)
+        colour = Colour.objects.create(name='green', episode=other)
+        response = self._post([{'action': 'delete', 'record': 'colour', 'id': colour.pk}])
+        self.assertEqual(404, response.status_code)
+        self.assertEqual(1, Colour.objects.count())
+
+    def test_nonexistant_episode(self):
+        self.mock_request.data = {'episode_id': 56785, 'items': []}
+        response = api.BatchViewSet().create(self.mock_request)
+        self.assertEqual(400, response.status_code)
+
+
 class ManyToManyTestSubrecordWithLookupListTest(TestCase):
 
     def setUp(self):
@@ -493,8 +624,58 @@ class EpisodeTestCase(TestCase):
     def test_list(self):
         response = api.EpisodeViewSet().list(self.mock_request)
         expected = [self.episode.to_dict(self.user)]
+        expected = json.loads(json.dumps(expected, cls=DjangoJSONEncoder))
         self.assertEqual(200, response.status_code)
-        self.assertEqual(expected, response.data)
+        self.assertEqual(expected, json.loads(''.join(response.streaming_content)))
+
+    def test_list_streams_in_chunks(self):
+        models.Episode.objects.create(patient=self.patient)
+        with patch('opal.managers.CHUNK_SIZE', new=1):
+            with patch.object(models.Episode.objects, 'serialised',
+                              wraps=models.Episode.objects.serialised) as serialised:
+                response = api.EpisodeViewSet().list(self.mock_request)
+                self.assertEqual(0, serialised.call_count)
+                data = json.loads(''.join(response.streaming_content))
+                self.assertEqual(2, serialised.call_count)
+        self.assertEqual(2, len(data))
+
+    def test_list_for_tag_streams_in_chunks(self):
+        self.mock_request.query_params = {'tag': 'micro'}
+        self.episode.set_tag_names(['micro'], self.user)
+        second = models.Episode.objects.create(patient=self.patient)
+        second.set_tag_names(['micro'], self.user)
+        with patch('opal.managers.CHUNK_SIZE', new=1):
+            with patch.object(models.Episode.objects, 'serialised',
+                              wraps=models.Episode.objects.serialised) as serialised:
+                response = api.EpisodeViewSet().list(self.mock_request)
+                self.assertEqual(0, serialised.call_count)
+                data = json.loads(''.join(response.streaming_content))
+                self.assertEqual(2, serialised.call_count)
+        self.assertEqual(2, len(data))
+
+    def test_list_paginated(self):
+        second = models.Episode.objects.create(patient=self.patient)
+        self.mock_request.query_params = {'page_size': '1'}
+        response = api.EpisodeViewSet().list(self.mock_request)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([self.episode.to_dict(self.user)], response.data['results'])
+
+        self.mock_request.query_params = {'page_size': '1', 'cursor': response.data['next']}
+        response = api.EpisodeViewSet().list(self.mock_request)
+        self.assertEqual([second.to_dict(self.user)], response.data['results'])
+        self.assertIsNone(response.data['next'])
+
+    def test_list_for_tag_paginated(self):
+        self.episode.set_tag_names(['micro'], self.user)
+        self.mock_request.query_params = {'tag': 'micro', 'page_size': '10'}
+        expected = models.Episode.objects.serialised(self.user, [self.episode])
+        response = api.EpisodeViewSet().list(self.mock_request)
+        self.assertEqual({'results': expected, 'next': None}, response.data)
+
+    def test_list_invalid_cursor(self):
+        self.mock_request.query_params = {'cursor': 'wat'}
+        response = api.EpisodeViewSet().list(self.mock_request)
+        self.assertEqual(400, response.status_code)
 
     def test_list_unauthenticated(self):
         pass #TODO TEST THIS
@@ -503,29 +684,31 @@ class EpisodeTestCase(TestCase):
         self.mock_request.query_params = {'tag': 'micro'}
         response = api.EpisodeViewSet().list(self.mock_request)
         self.assertEqual(200, response.status_code)
-        self.assertEqual([], response.data)
+        self.assertEqual([], json.loads(''.join(response.streaming_content)))
 
     def test_list_for_tag(self):
         self.mock_request.query_params = {'tag': 'micro'}
         self.episode.set_tag_names(['micro'], self.user)
         expected = models.Episode.objects.serialised(self.user, [self.episode])
+        expected = json.loads(json.dumps(expected, cls=DjangoJSONEncoder))
         response = api.EpisodeViewSet().list(self.mock_request)
         self.assertEqual(200, response.status_code)
-        self.assertEqual(expected, response.data)
+        self.assertEqual(expected, json.loads(''.join(response.streaming_content)))
 
     def test_list_for_subtag_empty(self):
         self.mock_request.query_params = {'tag': 'micro', 'subtag': 'micro_ortho'}
         response = api.EpisodeViewSet().list(self.mock_request)
         self.assertEqual(200, response.status_code)
-        self.assertEqual([], response.data)
+        self.assertEqual([], json.loads(''.join(response.streaming_content)))
 
     def test_list_for_subtag(self):
         self.mock_request.query_params = {'tag': 'micro', 'subtag': 'micro_ortho'}
         self.episode.set_tag_names(['micro_ortho'], self.user)
         expected = models.Episode.objects.serialised(self.user, [self.episode])
+        expected = json.loads(json.dumps(expected, cls=DjangoJSONEncoder))
         response = api.EpisodeViewSet().list(self.mock_request)
         self.assertEqual(200, response.status_code)
-        self.assertEqual(expected, response.data)
+        self.assertEqual(expected, json.loads(''.join(response.streaming_content)))
 
     def test_create_existing_patient(self):
         self.demographics.name = 'Aretha Franklin'
@@ -592,3 +775,20 @@ class PatientTestCase(TestCase):
     def test_retrieve_episode(self):
         response = api.PatientViewSet().retrieve(self.mock_request, pk=self.patient.pk)
         self.assertEqual(self.patient.to_dict(None), response.data)
+
+    def test_list(self):
+        response = api.PatientViewSet().list(self.mock_request)
+        expected = [self.patient.to_dict(self.mock_request.user)]
+        expected = json.loads(json.dumps(expected, cls=DjangoJSONEncoder))
+        self.assertEqual(expected, json.loads(''.join(response.streaming_content)))
+
+    def test_list_paginated(self):
+        second = models.Patient.objects.create()
+        self.mock_request.query_params = {'page_size': '1'}
+        response = api.PatientViewSet().list(self.mock_request)
+        self.assertEqual([self.patient.id], [p['id'] for p in response.data['results']])
+
+        self.mock_request.query_params = {'page_size': '1', 'cursor': response.data['next']}
+        response = api.PatientViewSet().list(self.mock_request)
+        self.assertEqual([second.id], [p['id'] for p in response.data['results']])
+        self.assertIsNone(response.data['next'])
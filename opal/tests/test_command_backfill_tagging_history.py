@@ -0,0 +1,42 @@
+"""
+Unittests for the backfill tagging history command
+"""
+from mock import patch
+import reversion
+
+from opal.core.test import OpalTestCase
+from opal.models import Patient, Tagging, TaggingHistory, Team
+
+from opal.management.commands import backfill_tagging_history
+
+class BackfillTaggingHistoryTestCase(OpalTestCase):
+    def setUp(self):
+        self.episode = Patient.objects.create().create_episode()
+        self.hiv = Team.objects.create(name='hiv', title='HIV')
+        with reversion.create_revision():
+            reversion.set_user(self.user)
+            self.tagging = self.episode.tagging_set.create(team=self.hiv)
+        with reversion.create_revision():
+            self.tagging.delete()
+
+    def handle(self):
+        with patch('sys.stdout'):
+            backfill_tagging_history.Command().handle()
+
+    def test_backfill(self):
+        self.handle()
+        history = TaggingHistory.objects.get()
+        self.assertEqual(self.episode, history.episode)
+        self.assertEqual(self.hiv, history.team)
+        self.assertEqual({self.episode.id: {'hiv': True}},
+                         Tagging.historic_tags_for_episodes([self.episode]))
+
+    def test_backfill_twice(self):
+        self.handle()
+        self.handle()
+        self.assertEqual(1, TaggingHistory.objects.count())
+
+    def test_skips_deleted_teams(self):
+        self.hiv.delete()
+        self.handle()
+        self.assertEqual(0, TaggingHistory.objects.count())
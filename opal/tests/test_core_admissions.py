@@ -0,0 +1,139 @@
+"""
+Unittests for opal.core.admissions
+"""
+import json
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from opal.core import admissions
+from opal.core.test import OpalTestCase
+from opal.models import Episode, Patient, Team
+from opal.tests.models import Demographics, EpisodeName, FamousLastWords
+
+
+def _ndjson(*admissions):
+    return [json.dumps(a) + '\n' for a in admissions]
+
+
+class ParseNDJSONTestCase(OpalTestCase):
+
+    def test_parse(self):
+        lines = ['{"hospital_number": "1"}\n', '\n', 'nope\n', '[1]\n']
+        self.assertEqual([
+            (1, {'hospital_number': '1'}, None),
+            (3, None, 'Invalid JSON'),
+            (4, None, 'Expected a JSON object'),
+        ], list(admissions.parse_ndjson(lines)))
+
+
+class AdmitTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.micro = Team.objects.create(name='micro', title='Micro')
+        self.ward = Team.objects.create(name='ward', title='Ward', parent=self.micro)
+
+    def _admit(self, *records, **kwargs):
+        return list(admissions.admit(
+            admissions.parse_ndjson(_ndjson(*records)), self.user, **kwargs))
+
+    def test_admit_new_patient(self):
+        results = self._admit({
+            'hospital_number': '555',
+            'demographics': {'name': 'Jane', 'date_of_birth': '1970-01-01'},
+            'episode': {'date_of_admission': '2015-11-01'},
+            'tags': ['ward']
+        })
+        self.assertEqual('created', results[0]['status'])
+        self.assertTrue(results[0]['patient_created'])
+
+        patient = Patient.objects.get()
+        self.assertEqual(results[0]['patient_id'], patient.id)
+        demographics = patient.demographics_set.get()
+        self.assertEqual('Jane', demographics.name)
+        self.assertEqual('555', demographics.hospital_number)
+        self.assertEqual(1, FamousLastWords.objects.filter(patient=patient).count())
+
+        episode = Episode.objects.get()
+        self.assertEqual(results[0]['episode_id'], episode.id)
+        self.assertEqual('2015-11-01', episode.date_of_admission.isoformat())
+        self.assertTrue(episode.active)
+        self.assertEqual(self.user, episode.created_by)
+        self.assertEqual(1, EpisodeName.objects.filter(episode=episode).count())
+        self.assertEqual(set(['micro', 'ward']), set(episode.get_tag_names(self.user)))
+
+    def test_admit_existing_patient(self):
+        patient = Patient.objects.create()
+        demographics = patient.demographics_set.get()
+        demographics.hospital_number = '555'
+        demographics.save()
+
+        results = self._admit(
+            {'hospital_number': '555', 'demographics': {'name': 'Janet'}})
+        self.assertFalse(results[0]['patient_created'])
+        self.assertEqual(patient.id, results[0]['patient_id'])
+        self.assertEqual(1, Patient.objects.count())
+        self.assertEqual('Janet', patient.demographics_set.get().name)
+        self.assertEqual(1, Episode.objects.filter(patient=patient).count())
+
+    def test_same_patient_twice_in_a_chunk(self):
+        results = self._admit(
+            {'hospital_number': '555', 'demographics': {'name': 'Jane'}},
+            {'hospital_number': '555', 'demographics': {'name': 'Janet'}},
+        )
+        self.assertEqual([True, False], [r['patient_created'] for r in results])
+        self.assertEqual(1, Patient.objects.count())
+        self.assertEqual(1, Demographics.objects.count())
+        self.assertEqual('Janet', Demographics.objects.get().name)
+        self.assertEqual(2, Episode.objects.count())
+
+    def test_per_record_errors(self):
+        lines = _ndjson(
+            {'hospital_number': '1'},
+            {'hospital_number': '2', 'episode': {'colour': 'red'}},
+            {'hospital_number': '3', 'tags': ['nope']},
+            {'hospital_number': '4', 'episode': {'date_of_admission': 'yesterday'}},
+            {'demographics': {}},
+            {'hospital_number': '6', 'wat': True},
+        ) + ['not json\n']
+        results = list(admissions.admit(admissions.parse_ndjson(lines), self.user))
+        self.assertEqual(
+            ['created', 'error', 'error', 'error', 'error', 'error', 'error'],
+            [r['status'] for r in results])
+        self.assertEqual(range(1, 8), [r['line'] for r in results])
+        self.assertEqual(1, Patient.objects.count())
+
+    def test_chunks(self):
+        records = [{'hospital_number': str(i)} for i in range(5)]
+        results = self._admit(*records, chunk_size=2)
+        self.assertEqual(5, len([r for r in results if r['status'] == 'created']))
+        self.assertEqual(5, Patient.objects.count())
+        self.assertEqual(5, Demographics.objects.count())
+
+    def test_queries_per_admission(self):
+        records = [{'hospital_number': str(i), 'tags': ['micro']} for i in range(20)]
+        with CaptureQueriesContext(connection) as queries:
+            self._admit(*records)
+        # One insert each for the patient and the episode, the rest in bulk
+        self.assertTrue(len(queries) < 20 * 2 + 15)
+
+
+class APIAdmitEpisodeViewTestCase(OpalTestCase):
+
+    def test_post(self):
+        self.assertTrue(
+            self.client.login(username=self.user.username, password=self.PASSWORD))
+        body = ''.join(_ndjson({'hospital_number': '555'}, {'hospital_number': ''}))
+        response = self.client.post(
+            '/api/v0.1/episode/admit', content_type='application/x-ndjson', data=body)
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content)
+        self.assertEqual(1, data['created'])
+        self.assertEqual(1, data['errors'])
+        self.assertEqual(['created', 'error'], [r['status'] for r in data['results']])
+
+    def test_requires_login(self):
+        response = self.client.post(
+            '/api/v0.1/episode/admit', content_type='application/x-ndjson', data='')
+        self.assertEqual(401, response.status_code)
+        self.assertIn('error', json.loads(response.content))
@@ -0,0 +1,147 @@
+"""
+Unittests for opal.core.deltas
+"""
+import json
+
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.test import TestCase
+
+from opal.core import deltas
+from opal.models import Patient, Team
+from opal.tests.models import Colour
+
+
+def _json(data):
+    return json.loads(json.dumps(data, cls=DjangoJSONEncoder))
+
+
+class DiffTestCase(TestCase):
+
+    def setUp(self):
+        self.pre = {
+            'id': 1,
+            'active': True,
+            'consistency_token': 'aaaa',
+            'colour': [
+                {'id': 1, 'name': 'red', 'consistency_token': '1111'},
+                {'id': 2, 'name': 'blue', 'consistency_token': '2222'},
+            ]
+        }
+
+    def test_no_change(self):
+        self.assertEqual({}, deltas.diff(self.pre, dict(self.pre)))
+
+    def test_field_changed(self):
+        post = dict(self.pre, active=False)
+        self.assertEqual({'fields': {'active': False}}, deltas.diff(self.pre, post))
+
+    def test_field_removed(self):
+        post = dict(self.pre)
+        del post['active']
+        self.assertEqual({'removed': ['active']}, deltas.diff(self.pre, post))
+
+    def test_record_updated(self):
+        post = dict(self.pre, colour=[
+            {'id': 1, 'name': 'red', 'consistency_token': '1111'},
+            {'id': 2, 'name': 'green', 'consistency_token': '3333'},
+        ])
+        expected = {'records': {'colour': {'updated': [{
+            'id': 2,
+            'consistency_token': '3333',
+            'previous_consistency_token': '2222',
+            'fields': {'name': 'green', 'consistency_token': '3333'}
+        }]}}}
+        self.assertEqual(expected, deltas.diff(self.pre, post))
+
+    def test_record_created_and_deleted(self):
+        created = {'id': 3, 'name': 'pink', 'consistency_token': '4444'}
+        post = dict(self.pre, colour=[self.pre['colour'][0], created])
+        expected = {'records': {'colour': {'created': [created], 'deleted': [2]}}}
+        self.assertEqual(expected, deltas.diff(self.pre, post))
+
+    def test_record_order(self):
+        post = dict(self.pre, colour=list(reversed(self.pre['colour'])))
+        delta = deltas.diff(self.pre, post)
+        self.assertEqual([2, 1], delta['records']['colour']['order'])
+        self.assertEqual(post, deltas.apply(self.pre, delta))
+
+    def test_tag_removed(self):
+        pre = {'id': 1, 'tagging': [{'id': 1, 'hiv': True, 'micro': True}]}
+        post = {'id': 1, 'tagging': [{'id': 1, 'micro': True}]}
+        delta = deltas.diff(pre, post)
+        update = delta['records']['tagging']['updated'][0]
+        self.assertEqual(['hiv'], update['removed'])
+        self.assertEqual({}, update['fields'])
+        self.assertEqual(post, deltas.apply(pre, delta))
+
+    def test_no_empty_record_changes(self):
+        pre = {'id': 1, 'colour': [{'id': 1, 'name': 'red'}]}
+        post = {'id': 1, 'colour': [{'name': 'red', 'id': 1}]}
+        self.assertNotIn(None, deltas.diff(pre, post).get('records', {}).values())
+
+    def test_nested(self):
+        pre = {'id': 1, 'episodes': {1: self.pre}}
+        post = {'id': 1, 'episodes': {1: dict(self.pre, active=False)}}
+        delta = deltas.diff(pre, post)
+        self.assertEqual({'fields': {'active': False}}, delta['nested']['episodes']['nested'][1])
+        self.assertEqual(post, deltas.apply(pre, delta))
+
+
+class ApplyTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='testuser')
+        self.patient = Patient.objects.create()
+        self.episode = self.patient.create_episode()
+
+    def test_rebuilds_serialised_episode(self):
+        red = Colour.objects.create(name='red', episode=self.episode)
+        Colour.objects.create(name='blue', episode=self.episode)
+        pre = _json(self.episode.to_dict(self.user))
+
+        red.update_from_dict(
+            {'name': 'crimson', 'consistency_token': red.consistency_token}, self.user)
+        Colour.objects.create(name='green', episode=self.episode)
+        Team.objects.create(name='micro', title='Micro')
+        self.episode.set_tag_names(['micro'], self.user)
+        post = _json(self.episode.to_dict(self.user))
+
+        delta = _json(deltas.diff(pre, post))
+        self.assertEqual(post, deltas.apply(pre, delta))
+
+    def test_stale_consistency_token(self):
+        pre = {'colour': [{'id': 1, 'name': 'red', 'consistency_token': '1111'}]}
+        post = {'colour': [{'id': 1, 'name': 'blue', 'consistency_token': '2222'}]}
+        delta = deltas.diff(pre, post)
+        stale = {'colour': [{'id': 1, 'name': 'red', 'consistency_token': '0000'}]}
+        with self.assertRaises(deltas.DeltaConflict):
+            deltas.apply(stale, delta)
+
+    def test_missing_record(self):
+        pre = {'colour': [{'id': 1, 'name': 'red'}]}
+        delta = deltas.diff(pre, {'colour': []})
+        with self.assertRaises(deltas.DeltaConflict):
+            deltas.apply({'colour': []}, delta)
+
+
+class StateConsumerTestCase(TestCase):
+
+    def test_rebuilds_state(self):
+        consumer = deltas.StateConsumer()
+        pre = {'id': 1, 'active': True}
+        post = {'id': 1, 'active': False}
+        consumer.receive('admit', {'record': 'episode:1', 'episode': pre})
+        state = consumer.receive('change', {
+            'record': 'episode:1', 'delta': deltas.diff(pre, post)})
+        self.assertEqual(post, state)
+
+    def test_delta_for_unknown_record(self):
+        consumer = deltas.StateConsumer()
+        self.assertIsNone(consumer.receive('change', {'record': 'episode:1', 'delta': {}}))
+
+    def test_full_change(self):
+        consumer = deltas.StateConsumer()
+        post = {'id': 1, 'active': False}
+        data = {'record': 'episode:1', 'pre': {}, 'post': post}
+        self.assertEqual(post, consumer.receive('change', data))
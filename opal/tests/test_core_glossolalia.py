@@ -1,12 +1,31 @@
 """
 Unittests for opal.core.glossolalia
 """
+import datetime
 import json 
 
 from django.test import TestCase
-from mock import patch
+from django.utils import timezone
+from mock import patch, MagicMock
+import requests
 
 from opal.core import glossolalia
+from opal.models import GlossolaliaMessage
+
+class SnapshotTestCase(TestCase):
+    def test_snapshot_not_integrating(self):
+        record = MagicMock(name='episode')
+        with patch('opal.core.glossolalia.INTEGRATING', new=False):
+            self.assertEqual(None, glossolalia.snapshot(record, None))
+            self.assertFalse(record.to_dict.called)
+
+    def test_snapshot_integrating(self):
+        record = MagicMock(name='episode')
+        record.to_dict.return_value = {'id': 1}
+        with patch('opal.core.glossolalia.INTEGRATING', new=True):
+            self.assertEqual({'id': 1}, glossolalia.snapshot(record, 'user'))
+            record.to_dict.assert_called_once_with('user')
+
 
 class AdmitTestCase(TestCase):
     @patch('opal.core.glossolalia._send_upstream_message')
@@ -70,3 +89,192 @@ class ChangeTestCase(TestCase):
             change = glossolalia.change({}, {'foo': 'bar'})
             self.assertEqual('change', sender.call_args[0][0])
             self.assertEqual('bar', json.loads(sender.call_args[0][1]['data'])['post']['foo'])
+
+
+class SpoolTestCase(TestCase):
+    def test_send_upstream_appends_to_spool(self):
+        glossolalia._send_upstream_message(
+            'change', {'data': '{}'}, ordering_key='episode:1')
+        message = GlossolaliaMessage.objects.get()
+        self.assertEqual('change', message.event)
+        self.assertEqual('episode:1', message.ordering_key)
+        self.assertEqual({'data': '{}'}, json.loads(message.payload))
+
+    def test_change_ordered_by_episode(self):
+        with patch('opal.core.glossolalia.INTEGRATING', new=True):
+            glossolalia.change({'id': 3}, {'id': 3})
+            glossolalia.change({'id': 3, 'episodes': {}}, {'id': 3, 'episodes': {}})
+        self.assertEqual(['episode:3', 'patient:3'],
+                         [m.ordering_key for m in GlossolaliaMessage.objects.all()])
+
+    @patch('opal.core.glossolalia._post_upstream_message')
+    def test_drain_sends_in_order(self, poster):
+        glossolalia._send_upstream_message('admit', {'data': '1'}, ordering_key='episode:1')
+        glossolalia._send_upstream_message('change', {'data': '2'}, ordering_key='episode:1')
+        self.assertEqual((2, 0), glossolalia.drain())
+        self.assertEqual(['admit', 'change'], [c[0][0] for c in poster.call_args_list])
+        self.assertEqual({'data': '1'}, poster.call_args_list[0][0][1])
+        self.assertEqual(0, GlossolaliaMessage.objects.count())
+
+    @patch('opal.core.glossolalia._post_upstream_message')
+    def test_drain_failure_blocks_episode(self, poster):
+        def post(event, payload):
+            if payload['data'] == 'fails':
+                raise requests.ConnectionError('Nope')
+        poster.side_effect = post
+        glossolalia._send_upstream_message('change', {'data': 'fails'}, ordering_key='episode:1')
+        glossolalia._send_upstream_message('change', {'data': 'waits'}, ordering_key='episode:1')
+        glossolalia._send_upstream_message('change', {'data': 'sent'}, ordering_key='episode:2')
+
+        self.assertEqual((1, 1), glossolalia.drain())
+        remaining = GlossolaliaMessage.objects.all()
+        self.assertEqual(['fails', 'waits'], [json.loads(m.payload)['data'] for m in remaining])
+        failed = remaining[0]
+        self.assertEqual(1, failed.attempts)
+        self.assertEqual('Nope', failed.last_error)
+        self.assertTrue(failed.next_attempt > timezone.now())
+
+        # Still backing off - nothing for episode 1 is sent
+        self.assertEqual((0, 0), glossolalia.drain())
+
+    def test_backoff(self):
+        with patch('opal.core.glossolalia.BACKOFF', new=5):
+            with patch('opal.core.glossolalia.MAX_BACKOFF', new=60):
+                self.assertEqual([5, 10, 20, 40, 60, 60],
+                                 [glossolalia._backoff(i) for i in range(1, 7)])
+
+    def test_queue_stats(self):
+        self.assertEqual({'depth': 0, 'retrying': 0, 'lag': 0}, glossolalia.queue_stats())
+        GlossolaliaMessage.objects.create(
+            event='change', payload='{}', attempts=2,
+            created=timezone.now() - datetime.timedelta(seconds=30))
+        GlossolaliaMessage.objects.create(event='change', payload='{}')
+        stats = glossolalia.queue_stats()
+        self.assertEqual(2, stats['depth'])
+        self.assertEqual(1, stats['retrying'])
+        self.assertTrue(stats['lag'] >= 30)
+
+
+class CircuitBreakerTestCase(TestCase):
+    def setUp(self):
+        self.breaker = glossolalia.CircuitBreaker(2, 30)
+
+    def test_opens_after_threshold(self):
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual('open', self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual('closed', self.breaker.state)
+
+    @patch('opal.core.glossolalia.time')
+    def test_probes_after_reset(self, mock_time):
+        mock_time.time.return_value = 100
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        mock_time.time.return_value = 131
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual('half open', self.breaker.state)
+        # Only one probe at a time
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual('closed', self.breaker.state)
+
+    @patch('opal.core.glossolalia.time')
+    def test_failed_probe_reopens(self, mock_time):
+        mock_time.time.return_value = 100
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        mock_time.time.return_value = 131
+        self.breaker.allow()
+        self.breaker.record_failure()
+        self.assertEqual('open', self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+
+
+class PostUpstreamMessageTestCase(TestCase):
+    def setUp(self):
+        self.breaker = glossolalia.CircuitBreaker(1, 30)
+        patcher = patch('opal.core.glossolalia.breaker', new=self.breaker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('opal.core.glossolalia.get_session')
+    def test_posts_with_timeouts(self, get_session):
+        glossolalia._post_upstream_message('change', {'data': '{}'})
+        kwargs = get_session.return_value.post.call_args[1]
+        self.assertEqual((glossolalia.CONNECT_TIMEOUT, glossolalia.READ_TIMEOUT),
+                         kwargs['timeout'])
+        self.assertEqual('change', kwargs['data']['event'])
+        self.assertTrue(glossolalia.send_stats()['latency']['change']['sent'] >= 1)
+
+    @patch('opal.core.glossolalia.get_session')
+    def test_failure_opens_breaker(self, get_session):
+        get_session.return_value.post.side_effect = requests.Timeout('Slow')
+        with self.assertRaises(requests.Timeout):
+            glossolalia._post_upstream_message('transfer', {'data': '{}'})
+        self.assertEqual('open', glossolalia.send_stats()['breaker']['state'])
+        with self.assertRaises(glossolalia.CircuitOpenError):
+            glossolalia._post_upstream_message('transfer', {'data': '{}'})
+        self.assertEqual(1, get_session.return_value.post.call_count)
+
+    @patch('opal.core.glossolalia.get_session')
+    def test_drain_stops_when_open(self, get_session):
+        get_session.return_value.post.side_effect = requests.ConnectionError('Down')
+        glossolalia._send_upstream_message('change', {'data': '1'}, ordering_key='episode:1')
+        glossolalia._send_upstream_message('change', {'data': '2'}, ordering_key='episode:2')
+        self.assertEqual((0, 1), glossolalia.drain())
+        untried = GlossolaliaMessage.objects.get(ordering_key='episode:2')
+        self.assertEqual(0, untried.attempts)
+
+    def test_session_is_shared(self):
+        self.assertIs(glossolalia.get_session(), glossolalia.get_session())
+
+    @patch('opal.core.glossolalia.get_session')
+    def test_publish_send_stats(self, get_session):
+        glossolalia.cache.delete(glossolalia.STATS_KEY)
+        self.assertEqual(None, glossolalia.published_send_stats())
+        glossolalia._post_upstream_message('change', {'data': '{}'})
+        glossolalia.publish_send_stats()
+        stats = glossolalia.published_send_stats()
+        self.assertEqual('closed', stats['breaker']['state'])
+        self.assertTrue(stats['latency']['change']['sent'] >= 1)
+
+    @patch('opal.core.glossolalia.get_session')
+    def test_worker_stats_command(self, get_session):
+        from opal.management.commands import glossolalia_worker
+
+        glossolalia.cache.delete(glossolalia.STATS_KEY)
+        with patch('sys.stdout') as stdout:
+            glossolalia_worker.Command().handle(once=True, interval=0, stats=False,
+                                                stats_interval=60)
+            glossolalia_worker.Command().handle(stats=True)
+        output = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        self.assertIn('circuit breaker: closed', output)
+
+
+class DeltaModeTestCase(TestCase):
+    @patch('opal.core.glossolalia._send_upstream_message')
+    def test_change_sends_delta(self, sender):
+        with patch('opal.core.glossolalia.INTEGRATING', new=True):
+            with patch('opal.core.glossolalia.DELTAS', new=True):
+                glossolalia.change({'id': 1, 'active': True}, {'id': 1, 'active': False})
+        data = json.loads(sender.call_args[0][1]['data'])
+        self.assertEqual({'fields': {'active': False}}, data['delta'])
+        self.assertEqual('episode:1', data['record'])
+        self.assertNotIn('pre', data)
+        self.assertNotIn('post', data)
+
+    @patch('opal.core.glossolalia._send_upstream_message')
+    def test_transfer_sends_delta(self, sender):
+        with patch('opal.core.glossolalia.INTEGRATING', new=True):
+            with patch('opal.core.glossolalia.DELTAS', new=True):
+                glossolalia.transfer({'id': 1, 'tagging': []}, {'id': 1, 'tagging': [{'id': 1}]})
+        data = json.loads(sender.call_args[0][1]['data'])
+        self.assertEqual([{'id': 1}], data['delta']['records']['tagging']['created'])
@@ -0,0 +1,86 @@
+"""
+Unittests for opal.core.lookuplists
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from opal.core.lookuplists import cache
+from opal.models import Synonym
+from opal.tests.models import Dog, Hat
+
+
+class LookupListCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.invalidate()
+        self.dog = Dog.objects.create(name='Terrier')
+
+    def test_name_for_id(self):
+        self.assertEqual('Terrier', cache.name_for_id(Dog, self.dog.id))
+        self.assertEqual(None, cache.name_for_id(Dog, self.dog.id + 100))
+
+    def test_resolve(self):
+        self.assertEqual(('Terrier', self.dog.id), cache.resolve(Dog, 'Terrier'))
+        self.assertEqual(('Wolf', None), cache.resolve(Dog, 'Wolf'))
+
+    def test_resolve_synonym(self):
+        Synonym.objects.create(
+            content_object=self.dog, name='Yappy',
+            content_type=ContentType.objects.get_for_model(Dog))
+        self.assertEqual(('Terrier', self.dog.id), cache.resolve(Dog, 'Yappy'))
+
+    def test_cached_between_calls(self):
+        cache.get(Dog)
+        with self.assertNumQueries(0):
+            cache.resolve(Dog, 'Terrier')
+            cache.name_for_id(Dog, self.dog.id)
+
+    def test_save_invalidates(self):
+        cache.get(Dog)
+        self.dog.name = 'Jack Russell'
+        self.dog.save()
+        self.assertEqual('Jack Russell', cache.name_for_id(Dog, self.dog.id))
+
+    def test_delete_invalidates(self):
+        cache.get(Dog)
+        self.dog.delete()
+        self.assertEqual(('Terrier', None), cache.resolve(Dog, 'Terrier'))
+
+    def test_synonym_save_invalidates_its_lookuplist(self):
+        cache.get(Dog)
+        cache.get(Hat)
+        Synonym.objects.create(
+            content_object=self.dog, name='Yappy',
+            content_type=ContentType.objects.get_for_model(Dog))
+        self.assertNotIn(Dog, cache._entries)
+        self.assertIn(Hat, cache._entries)
+
+    @override_settings(OPAL_LOOKUPLIST_CACHE_MAX_SIZE=1)
+    def test_too_large_to_cache(self):
+        Dog.objects.create(name='Collie')
+        self.assertEqual(None, cache.get(Dog))
+        with self.assertRaises(KeyError):
+            cache.resolve(Dog, 'Collie')
+        self.assertEqual(None, cache.name_for_id(Dog, self.dog.id))
+        # We remember that it is too large rather than loading it again
+        with self.assertNumQueries(0):
+            self.assertEqual(None, cache.get(Dog))
+            self.assertEqual(None, cache.name_for_id(Dog, self.dog.id))
+            with self.assertRaises(KeyError):
+                cache.resolve(Dog, 'Collie')
+
+    @override_settings(OPAL_LOOKUPLIST_CACHE_MAX_SIZE=2)
+    def test_too_large_with_synonyms(self):
+        Synonym.objects.create(
+            content_object=self.dog, name='Yappy',
+            content_type=ContentType.objects.get_for_model(Dog))
+        Synonym.objects.create(
+            content_object=self.dog, name='Scrappy',
+            content_type=ContentType.objects.get_for_model(Dog))
+        self.assertEqual(None, cache.get(Dog))
+        with self.assertNumQueries(0):
+            self.assertEqual(None, cache.get(Dog))
+        # Saving an entry still invalidates it
+        Dog.objects.create(name='Collie')
+        self.assertNotIn(Dog, cache._entries)
@@ -0,0 +1,68 @@
+"""
+Unittests for opal.core.pagination
+"""
+from django.test import TestCase
+
+from opal.core import exceptions, pagination
+from opal.models import Patient
+
+
+class CursorTestCase(TestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(34, pagination.decode_cursor(pagination.encode_cursor(34)))
+
+    def test_decode_garbage(self):
+        with self.assertRaises(exceptions.APIError):
+            pagination.decode_cursor('not a cursor')
+
+    def test_decode_non_integer(self):
+        cursor = pagination.encode_cursor('34')
+        with self.assertRaises(exceptions.APIError):
+            pagination.decode_cursor(cursor)
+
+
+class GetPageParamsTestCase(TestCase):
+
+    def test_not_paginating(self):
+        self.assertIsNone(pagination.get_page_params({}))
+
+    def test_page_size(self):
+        self.assertEqual((10, None), pagination.get_page_params({'page_size': '10'}))
+
+    def test_page_size_is_capped(self):
+        page_size, _ = pagination.get_page_params({'page_size': '100000'})
+        self.assertEqual(pagination.MAX_PAGE_SIZE, page_size)
+
+    def test_invalid_page_size(self):
+        for page_size in ['ten', '0', '-3']:
+            with self.assertRaises(exceptions.APIError):
+                pagination.get_page_params({'page_size': page_size})
+
+    def test_cursor(self):
+        cursor = pagination.encode_cursor(7)
+        params = {'page_size': '10', 'cursor': cursor}
+        self.assertEqual((10, 7), pagination.get_page_params(params))
+
+
+class PaginateTestCase(TestCase):
+
+    def setUp(self):
+        self.patients = [Patient.objects.create() for i in range(5)]
+
+    def test_walk_pages(self):
+        seen = []
+        cursor = None
+        while True:
+            page, next_cursor = pagination.paginate(
+                Patient.objects.all(), 2, pagination.decode_cursor(cursor) if cursor else None)
+            seen += page
+            if next_cursor is None:
+                break
+            cursor = next_cursor
+        self.assertEqual(self.patients, seen)
+
+    def test_last_page_has_no_next(self):
+        page, next_cursor = pagination.paginate(Patient.objects.all(), 5)
+        self.assertEqual(5, len(page))
+        self.assertIsNone(next_cursor)
@@ -0,0 +1,165 @@
+"""
+Unittests for opal.core.search.index
+"""
+from unittest import skipUnless
+
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
+from mock import patch
+
+from opal.core.test import OpalTestCase
+from opal.models import Patient
+
+from opal.core.search import index, queries
+from opal.management.commands import rebuild_search_index
+
+
+class SearchIndexTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.patient = Patient.objects.create()
+        self.episode = self.patient.create_episode()
+        self.demographics = self.patient.demographics_set.get()
+        self.demographics.name = 'Sally Stevens'
+        self.demographics.hospital_number = 'ABC123'
+        self.demographics.save()
+        self.count = index.rebuild()
+
+    def tearDown(self):
+        index.drop()
+        super(SearchIndexTestCase, self).tearDown()
+
+    def search(self, field, query, exact=False):
+        ids = index.patient_ids(field, query, exact=exact)
+        return [i['id'] for i in ids]
+
+    def test_rebuild(self):
+        self.assertEqual(1, self.count)
+        self.assertTrue(index.available())
+
+    def test_contains(self):
+        self.assertEqual([self.patient.id], self.search('name', 'steve'))
+        self.assertEqual([], self.search('name', 'jones'))
+
+    def test_exact(self):
+        self.assertEqual([self.patient.id],
+                         self.search('hospital_number', 'abc123', exact=True))
+        self.assertEqual([], self.search('hospital_number', 'abc', exact=True))
+
+    def test_wildcards_are_escaped(self):
+        self.assertEqual([], self.search('name', 'Sally_Stevens'))
+        self.assertEqual([], self.search('name', 'y%S'))
+        self.assertEqual([], self.search('name', '"ll'))
+
+    def test_short_queries_use_the_orm(self):
+        self.assertEqual(None, index.patient_ids('name', 'st'))
+
+    @skipUnless(connection.vendor == 'sqlite', 'FTS5 query plans')
+    def test_sqlite_uses_trigram_index(self):
+        for exact in (False, True):
+            sql, params = index.get_backend().condition('name', 'steve', exact)
+            cursor = connection.cursor()
+            cursor.execute(
+                'EXPLAIN QUERY PLAN SELECT rowid FROM {0} WHERE {1}'.format(
+                    index.TABLE, sql), params)
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+            # M is a MATCH constraint, answered by the index; a bare
+            # "INDEX 0:" is a full scan.
+            self.assertIn('VIRTUAL TABLE INDEX 0:M', plan)
+
+    @skipUnless(connection.vendor == 'sqlite', 'FTS5 query plans')
+    def test_search_query_uses_trigram_index(self):
+        sql, params = index.patient_ids('name', 'steve').query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('VIRTUAL TABLE INDEX 0:M', plan)
+
+    def test_dropped_by_another_process(self):
+        index.get_backend().drop(connection.cursor())
+        # We only notice when we next use it
+        self.assertTrue(index.available())
+        self.demographics.name = 'Sally Jones'
+        self.demographics.save()
+        self.assertFalse(index.available())
+        self.assertEqual(None, index.patient_ids('name', 'jones'))
+
+    def test_search_after_dropped_by_another_process(self):
+        index.get_backend().drop(connection.cursor())
+        criteria = [{
+            u'column': u'demographics', u'field': u'Name', u'combine': u'and',
+            u'query': u'steve', u'queryType': u'Contains'
+        }]
+        query = queries.DatabaseQuery(self.user, criteria)
+        self.assertEqual([self.episode], query.get_episodes())
+        self.assertFalse(index.available())
+
+    def test_other_errors_are_raised(self):
+        with patch.object(index.get_backend().__class__, 'upsert',
+                          side_effect=OperationalError('Locked')):
+            with self.assertRaises(OperationalError):
+                self.demographics.save()
+        self.assertTrue(index.available())
+
+    def test_save_does_not_check_for_the_index(self):
+        with CaptureQueriesContext(connection) as captured:
+            index.update_index(None, self.demographics)
+        for query in captured.captured_queries:
+            self.assertNotIn('sqlite_master', query['sql'])
+            self.assertNotIn('information_schema', query['sql'])
+
+    def test_unindexed_field(self):
+        self.assertEqual(None, index.patient_ids('ethnicity', 'x'))
+
+    def test_updated_on_save(self):
+        self.demographics.name = 'Sally Jones'
+        self.demographics.save()
+        self.assertEqual([self.patient.id], self.search('name', 'jones'))
+        self.assertEqual([], self.search('name', 'steve'))
+
+    def test_updated_on_delete(self):
+        self.demographics.delete()
+        self.assertEqual([], self.search('name', 'steve'))
+
+    def test_new_patient(self):
+        patient = Patient.objects.create()
+        demographics = patient.demographics_set.get()
+        demographics.name = 'Stevie Wonder'
+        demographics.save()
+        self.assertEqual(set([self.patient.id, patient.id]),
+                         set(self.search('name', 'stev')))
+
+    def test_database_query_uses_index(self):
+        criteria = [{
+            u'column': u'demographics', u'field': u'Name', u'combine': u'and',
+            u'query': u'steve', u'queryType': u'Contains'
+        }]
+        query = queries.DatabaseQuery(self.user, criteria)
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual([self.episode], query.get_episodes())
+        self.assertTrue(any(index.TABLE in q['sql'] for q in captured.captured_queries))
+
+    def test_fall_back_without_index(self):
+        index.drop()
+        self.assertFalse(index.available())
+        self.assertEqual(None, index.patient_ids('name', 'steve'))
+        criteria = [{
+            u'column': u'demographics', u'field': u'Name', u'combine': u'and',
+            u'query': u'steve', u'queryType': u'Contains'
+        }]
+        query = queries.DatabaseQuery(self.user, criteria)
+        self.assertEqual([self.episode], query.get_episodes())
+
+    def test_bulk_admissions_are_indexed(self):
+        from opal.core import admissions
+
+        lines = ['{"hospital_number": "XYZ987", "demographics": {"name": "Jane Doe"}}\n']
+        results = list(admissions.admit(admissions.parse_ndjson(lines), self.user))
+        self.assertEqual([results[0]['patient_id']], self.search('name', 'jane'))
+
+    def test_command_database_error(self):
+        with patch.object(index, 'rebuild', side_effect=OperationalError('no such tokenizer')):
+            with self.assertRaises(CommandError) as raised:
+                rebuild_search_index.Command().handle(drop=False)
+        self.assertIn('no such tokenizer', str(raised.exception))
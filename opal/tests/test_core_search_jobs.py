@@ -0,0 +1,282 @@
+"""
+Unittests for opal.core.search.jobs
+"""
+import datetime
+import json
+import os
+import sys
+import tempfile
+import zipfile
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.utils import timezone
+from mock import MagicMock, patch
+
+from opal.core import exceptions
+from opal.core.test import OpalTestCase
+from opal.models import ExtractJob, Patient
+from opal.tests.models import Colour
+
+from opal.core.search import jobs
+from opal.management.commands import clean_extracts
+
+CRITERIA = [{
+    "combine": "and",
+    "column": "demographics",
+    "field": "Name",
+    "queryType": "Contains",
+    "query": "Ali",
+    "lookup_list": [],
+}]
+
+
+class ExtractJobTestCase(OpalTestCase):
+
+    def setUp(self):
+        pool = patch.object(jobs, '_get_pool')
+        self.pool = pool.start()
+        self.addCleanup(pool.stop)
+
+    def make_job(self, **kwargs):
+        kwargs.setdefault('criteria', json.dumps(CRITERIA))
+        return ExtractJob.objects.create(user=self.user, **kwargs)
+
+    def make_archive(self):
+        archive = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+        archive.close()
+        self.addCleanup(
+            lambda: os.path.exists(archive.name) and os.remove(archive.name))
+        return archive.name
+
+
+class StartTestCase(ExtractJobTestCase):
+
+    def test_start(self):
+        job = jobs.start(self.user, CRITERIA)
+        self.assertEqual(ExtractJob.PENDING, job.state)
+        self.assertEqual(CRITERIA, json.loads(job.criteria))
+        self.pool.return_value.apply_async.assert_called_once_with(
+            jobs.run, (job.id,))
+
+    def test_start_with_celery(self):
+        tasks = MagicMock()
+        with self.settings(BROKER_URL='amqp://'):
+            with patch.dict(sys.modules, {'opal.core.search.tasks': tasks}):
+                with patch('opal.core.search.tasks', tasks, create=True):
+                    job = jobs.start(self.user, CRITERIA)
+        tasks.extract.delay.assert_called_once_with(job.id)
+        self.assertFalse(self.pool.called)
+
+    def test_user_limit(self):
+        with patch.object(jobs, 'USER_LIMIT', 1):
+            jobs.start(self.user, CRITERIA)
+            with self.assertRaises(exceptions.ExtractError):
+                jobs.start(self.user, CRITERIA)
+            other = User.objects.create(username='other')
+            jobs.start(other, CRITERIA)
+
+    def test_finished_jobs_do_not_count(self):
+        self.make_job(state=ExtractJob.SUCCESS)
+        with patch.object(jobs, 'USER_LIMIT', 1):
+            jobs.start(self.user, CRITERIA)
+
+
+class RunTestCase(ExtractJobTestCase):
+
+    def setUp(self):
+        super(RunTestCase, self).setUp()
+        patient = Patient.objects.create()
+        patient.demographics_set.update(name='Alice')
+        Colour.objects.create(episode=patient.create_episode(), name='blue')
+
+    def test_run(self):
+        job = self.make_job()
+        jobs.run(job.id)
+        job.refresh_from_db()
+        self.addCleanup(os.remove, job.file_path)
+        self.assertEqual(ExtractJob.SUCCESS, job.state)
+        self.assertEqual(100, job.progress)
+        self.assertTrue(job.rows_total > 0)
+        self.assertEqual(job.rows_total, job.rows_written)
+        self.assertIsNotNone(job.expires)
+        self.assertIsNone(zipfile.ZipFile(job.file_path).testzip())
+
+    def test_run_with_projection(self):
+        job = self.make_job(projection=json.dumps({'colour': ['name']}))
+        jobs.run(job.id)
+        job.refresh_from_db()
+        self.addCleanup(os.remove, job.file_path)
+        names = [n.split('/', 1)[1]
+                 for n in zipfile.ZipFile(job.file_path).namelist()]
+        self.assertEqual(['episodes.csv', 'colour.csv', 'filter.txt'], names)
+        self.assertEqual(job.rows_total, job.rows_written)
+
+    def test_run_with_extract_process_pool(self):
+        # Jobs run in daemonic pool processes, which can't start the
+        # process pool that OPAL_EXTRACT_POOL asks for.
+        from opal.core.search import extract
+        from opal.tests.test_search_extract import InlinePool
+
+        job = self.make_job()
+        daemon = MagicMock(daemon=True)
+        with patch.object(extract, 'EXTRACT_POOL', 'process'), \
+                patch.object(extract, 'EXTRACT_WORKERS', 2), \
+                patch.object(extract.multiprocessing, 'current_process',
+                             return_value=daemon), \
+                patch.object(extract.multiprocessing, 'Pool') as process_pool, \
+                patch.object(extract, 'ThreadPool', return_value=InlinePool()):
+            jobs.run(job.id)
+        job.refresh_from_db()
+        self.addCleanup(os.remove, job.file_path)
+        self.assertEqual(ExtractJob.SUCCESS, job.state)
+        self.assertFalse(process_pool.called)
+
+    def test_run_cancelled_before_start(self):
+        job = self.make_job(state=ExtractJob.CANCELLED)
+        with patch('opal.core.search.extract.zip_archive') as zip_archive:
+            jobs.run(job.id)
+        self.assertFalse(zip_archive.called)
+
+    def test_cancelled_while_running(self):
+        job = self.make_job()
+
+        def cancel_and_estimate(episodes, projection=None):
+            jobs.cancel(job)
+            return 10
+
+        written = []
+        real_remove = os.remove
+        with patch('opal.core.search.extract.estimate_rows',
+                   side_effect=cancel_and_estimate):
+            with patch('opal.core.search.extract.os.remove',
+                       side_effect=lambda p: written.append(p) or real_remove(p)):
+                jobs.run(job.id)
+        job.refresh_from_db()
+        self.assertEqual(ExtractJob.CANCELLED, job.state)
+        self.assertEqual('', job.file_path)
+        self.assertEqual(1, len(written))
+        self.assertFalse(os.path.exists(written[0]))
+
+    def test_failure(self):
+        criteria = [dict(CRITERIA[0], column='nonexistent')]
+        job = self.make_job(criteria=json.dumps(criteria))
+        with patch('logging.exception'):
+            jobs.run(job.id)
+        job.refresh_from_db()
+        self.assertEqual(ExtractJob.FAILURE, job.state)
+        self.assertIn('nonexistent', job.error)
+
+
+class CleanupTestCase(ExtractJobTestCase):
+
+    def test_expires_finished_jobs(self):
+        path = self.make_archive()
+        past = timezone.now() - datetime.timedelta(minutes=1)
+        job = self.make_job(state=ExtractJob.SUCCESS, file_path=path,
+                            expires=past)
+        self.assertEqual(1, jobs.cleanup())
+        job.refresh_from_db()
+        self.assertEqual(ExtractJob.EXPIRED, job.state)
+        self.assertEqual('', job.file_path)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(0, jobs.cleanup())
+
+    def test_keeps_current_jobs(self):
+        path = self.make_archive()
+        future = timezone.now() + datetime.timedelta(minutes=1)
+        self.make_job(state=ExtractJob.SUCCESS, file_path=path, expires=future)
+        self.assertEqual(0, jobs.cleanup())
+        self.assertTrue(os.path.exists(path))
+
+    def test_fails_stale_jobs(self):
+        created = timezone.now() - datetime.timedelta(hours=jobs.EXPIRY_HOURS + 1)
+        job = self.make_job(state=ExtractJob.STARTED, created=created)
+        jobs.cleanup()
+        job.refresh_from_db()
+        self.assertEqual(ExtractJob.FAILURE, job.state)
+
+    def test_command(self):
+        with patch('sys.stdout'):
+            clean_extracts.Command().handle()
+
+
+class ExtractJobViewsTestCase(ExtractJobTestCase):
+
+    def setUp(self):
+        super(ExtractJobViewsTestCase, self).setUp()
+        self.assertTrue(
+            self.client.login(username=self.user.username, password=self.PASSWORD))
+
+    def test_start(self):
+        with self.settings(EXTRACT_ASYNC=True):
+            response = self.client.post(
+                reverse('extract_download'),
+                json.dumps({'criteria': json.dumps(CRITERIA)}),
+                content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        job = ExtractJob.objects.get()
+        self.assertEqual(job.id, json.loads(response.content)['extract_id'])
+
+    def test_start_with_projection(self):
+        with self.settings(EXTRACT_ASYNC=True):
+            response = self.client.post(
+                reverse('extract_download'),
+                json.dumps({'criteria': json.dumps(CRITERIA),
+                            'projection': json.dumps({'colour': None})}),
+                content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        job = ExtractJob.objects.get()
+        self.assertEqual({'colour': None}, json.loads(job.projection))
+
+    def test_start_with_bad_projection(self):
+        with self.settings(EXTRACT_ASYNC=True):
+            response = self.client.post(
+                reverse('extract_download'),
+                json.dumps({'criteria': json.dumps(CRITERIA),
+                            'projection': json.dumps({'nonexistent': None})}),
+                content_type='application/json')
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(ExtractJob.objects.exists())
+
+    def test_start_over_limit(self):
+        with self.settings(EXTRACT_ASYNC=True):
+            with patch.object(jobs, 'USER_LIMIT', 0):
+                response = self.client.post(
+                    reverse('extract_download'),
+                    json.dumps({'criteria': json.dumps(CRITERIA)}),
+                    content_type='application/json')
+        self.assertEqual(429, response.status_code)
+
+    def test_result(self):
+        job = self.make_job(state=ExtractJob.STARTED, rows_written=5,
+                            rows_total=20)
+        response = self.client.get(reverse('extract_result', args=[job.id]))
+        data = json.loads(response.content)
+        self.assertEqual('STARTED', data['state'])
+        self.assertEqual(25, data['progress'])
+
+    def test_other_users_job(self):
+        other = User.objects.create(username='other')
+        job = ExtractJob.objects.create(user=other, criteria='[]')
+        response = self.client.get(reverse('extract_result', args=[job.id]))
+        self.assertEqual(404, response.status_code)
+
+    def test_cancel(self):
+        job = self.make_job()
+        response = self.client.post(reverse('extract_cancel', args=[job.id]))
+        self.assertEqual('CANCELLED', json.loads(response.content)['state'])
+
+    def test_file(self):
+        path = self.make_archive()
+        with open(path, 'wb') as archive:
+            archive.write('PK')
+        job = self.make_job(state=ExtractJob.SUCCESS, file_path=path)
+        response = self.client.get(reverse('extract_file', args=[job.id]))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('PK', ''.join(response.streaming_content))
+
+    def test_file_not_ready(self):
+        job = self.make_job(state=ExtractJob.STARTED)
+        response = self.client.get(reverse('extract_file', args=[job.id]))
+        self.assertEqual(400, response.status_code)
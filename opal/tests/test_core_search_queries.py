@@ -3,10 +3,11 @@ unittests for opal.core.search.queries
 """
 from mock import patch
 
-from opal.models import Patient, Team
+from opal.models import Gender, Patient, Team
 from opal.core.test import OpalTestCase
 from datetime import date
 
+from opal.core import lookuplists
 from opal.core.search import queries
 
 
@@ -97,3 +98,131 @@ class DatabaseQueryTestCase(OpalTestCase):
             'categories': [u'inpatient']
         }]
         self.assertEqual(expected, summaries)
+
+    def _criteria(self, column, field, query, queryType='Equals', combine='and'):
+        return {
+            u'column': column,
+            u'field': field,
+            u'combine': combine,
+            u'query': query,
+            u'queryType': queryType
+        }
+
+    def test_patient_subrecord_matches_all_episodes(self):
+        other = self.patient.create_episode()
+        query = queries.DatabaseQuery(self.user, self.name_criteria)
+        self.assertEqual([self.episode, other], query.get_episodes())
+
+    def test_contains(self):
+        criteria = [self._criteria(u'demographics', u'Name', u'steve', 'Contains')]
+        query = queries.DatabaseQuery(self.user, criteria)
+        self.assertEqual([self.episode], query.get_episodes())
+
+    def test_date_field(self):
+        criteria = [self._criteria(u'demographics', u'Date of birth', u'01/01/1980', 'Before')]
+        query = queries.DatabaseQuery(self.user, criteria)
+        self.assertEqual([self.episode], query.get_episodes())
+        criteria = [self._criteria(u'demographics', u'Date of birth', u'01/01/1980', 'After')]
+        query = queries.DatabaseQuery(self.user, criteria)
+        self.assertEqual([], query.get_episodes())
+
+    def test_many_to_many_field(self):
+        from opal.tests.models import Hat, HatWearer
+        bowler = Hat.objects.create(name='bowler')
+        wearer = HatWearer.objects.create(episode=self.episode, name='Jeeves')
+        wearer.hats.add(bowler)
+        criteria = [self._criteria(u'hat_wearer', u'Hats', u'bowler')]
+        query = queries.DatabaseQuery(self.user, criteria)
+        self.assertEqual([self.episode], query.get_episodes())
+
+    def test_tags(self):
+        self.episode.set_tag_names(['general'], self.user)
+        self.patient.create_episode()
+        criteria = [self._criteria(u'tags', u'general', u'true')]
+        query = queries.DatabaseQuery(self.user, criteria)
+        self.assertEqual([self.episode], query.get_episodes())
+
+    def test_combine(self):
+        other_patient = Patient.objects.create()
+        other_episode = other_patient.create_episode()
+        demographics = other_patient.demographics_set.get()
+        demographics.name = 'Stevie Wonder'
+        demographics.save()
+
+        sally = self._criteria(u'demographics', u'Name', u'Sally Stevens')
+        stevie = self._criteria(u'demographics', u'Name', u'Stevie Wonder')
+        stev = self._criteria(u'demographics', u'Name', u'Stev', 'Contains')
+
+        def episodes(*criteria):
+            return queries.DatabaseQuery(self.user, list(criteria)).get_episodes()
+
+        self.assertEqual([], episodes(sally, dict(stevie, combine='and')))
+        self.assertEqual([self.episode, other_episode],
+                         episodes(sally, dict(stevie, combine='or')))
+        # 'not' returns the criterion's matches that are not in the working set
+        self.assertEqual([other_episode], episodes(sally, dict(stev, combine='not')))
+
+    def test_episode_ids_in_one_query(self):
+        criteria = self.name_criteria + [
+            self._criteria(u'demographics', u'Gender', u'Female', combine='or'),
+            self._criteria(u'demographics', u'Name', u'Sally', 'Contains', combine='not'),
+        ]
+        Gender.objects.create(name='Female')
+        lookuplists.cache.get(Gender)
+        self.addCleanup(lookuplists.cache.invalidate, Gender)
+        query = queries.DatabaseQuery(self.user, criteria)
+        with self.assertNumQueries(1):
+            list(query._episode_ids_without_restrictions())
+
+    def test_no_criteria(self):
+        query = queries.DatabaseQuery(self.user, [])
+        self.assertEqual([], query.get_episodes())
+
+    def test_get_patient_summaries_aggregates_episodes(self):
+        admitted = date(2014, 12, 25)
+        discharged = date(2015, 3, 1)
+        self.patient.episode_set.create(
+            category='outpatient', date_of_admission=admitted,
+            discharge_date=discharged)
+        query = queries.DatabaseQuery(self.user, self.name_criteria)
+        summary = query.get_patient_summaries()[0]
+        self.assertEqual(2, summary['count'])
+        self.assertEqual(admitted, summary['start_date'])
+        self.assertEqual(discharged, summary['end_date'])
+        self.assertEqual(self.episode.id, summary['episode_id'])
+        self.assertEqual([u'inpatient', u'outpatient'], summary['categories'])
+
+    def test_get_patient_summaries_query_count(self):
+        query = queries.DatabaseQuery(self.user, self.name_criteria)
+        self.user.profile
+        with self.assertNumQueries(3):
+            self.assertEqual(1, len(query.get_patient_summaries()))
+        for i in range(3):
+            patient = Patient.objects.create()
+            patient.create_episode()
+            patient.demographics_set.update(name='Sally Stevens')
+        with self.assertNumQueries(3):
+            self.assertEqual(4, len(query.get_patient_summaries()))
+
+    def test_get_patient_summaries_limit_offset(self):
+        for i in range(4):
+            patient = Patient.objects.create()
+            patient.create_episode()
+            patient.demographics_set.update(name='Sally Stevens')
+        query = queries.DatabaseQuery(self.user, self.name_criteria)
+        ids = [s['id'] for s in query.get_patient_summaries()]
+        self.assertEqual(5, len(ids))
+        self.assertEqual(5, query.count_patients())
+        page = query.get_patient_summaries(limit=2, offset=2)
+        self.assertEqual(ids[2:4], [s['id'] for s in page])
+        page = query.get_patient_summaries(offset=3)
+        self.assertEqual(ids[3:], [s['id'] for s in page])
+
+    def test_tag_criteria_are_a_subquery(self):
+        self.episode.set_tag_names(['general'], self.user)
+        criteria = self.name_criteria + [
+            self._criteria(u'tags', u'general', u'true')]
+        query = queries.DatabaseQuery(self.user, criteria)
+        with self.assertNumQueries(1):
+            self.assertEqual([self.episode.id],
+                             list(query._episode_ids_without_restrictions()))
@@ -0,0 +1,50 @@
+"""
+Unittests for opal.core.search.registry
+"""
+from opal.core.exceptions import SearchError
+from opal.core.test import OpalTestCase
+from opal.models import Gender, Tagging
+from opal.tests.models import Demographics, HatWearer, Hat
+
+from opal.core.search import registry
+
+
+class RegistryTestCase(OpalTestCase):
+
+    def test_get_column(self):
+        column = registry.get_column('Demographics')
+        self.assertEqual(Demographics, column.model)
+
+    def test_get_column_with_underscores(self):
+        self.assertEqual(HatWearer, registry.get_column('hat_wearer').model)
+
+    def test_unknown_column(self):
+        with self.assertRaises(SearchError):
+            registry.get_column('spaceships')
+
+    def test_unknown_field(self):
+        with self.assertRaises(SearchError):
+            registry.get_field('demographics', 'Warp factor')
+
+    def test_field_kinds(self):
+        self.assertEqual(registry.TEXT,
+                         registry.get_field('demographics', 'Name').kind)
+        self.assertEqual(registry.DATE,
+                         registry.get_field('demographics', 'Date of birth').kind)
+        self.assertEqual(registry.MANY_TO_MANY,
+                         registry.get_field('hat_wearer', 'Hats').kind)
+
+    def test_fkorft_field(self):
+        field = registry.get_field('demographics', 'Gender')
+        self.assertEqual(registry.FKORFT, field.kind)
+        self.assertEqual(Gender, field.lookup_model)
+        self.assertEqual(Gender, field.content_type.model_class())
+
+    def test_content_type_without_lookup_list(self):
+        self.assertEqual(None, registry.get_field('demographics', 'Name').content_type)
+
+    def test_tags(self):
+        field = registry.get_field('tags', 'micro')
+        self.assertEqual(Tagging, field.model)
+        self.assertEqual(registry.TAG, field.kind)
+        self.assertEqual('micro', field.name)
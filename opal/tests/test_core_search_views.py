@@ -150,6 +150,65 @@ class SimpleSearchViewTestCase(BaseSearchTestCase):
         self.assertEqual(self.expected, data)
 
 
+class SearchPaginationTestCase(BaseSearchTestCase):
+
+    def setUp(self):
+        super(SearchPaginationTestCase, self).setUp()
+        for i in range(views.PAGINATION_AMOUNT + 2):
+            patient = models.Patient.objects.create()
+            patient.create_episode()
+            patient.demographics_set.update(name='Sean Connery')
+
+    def get_page(self, page_number):
+        request = self.rf.get(
+            '/search/simple/?name=Connery&page_number={0}'.format(page_number))
+        request.user = self.user
+        return json.loads(views.simple_search_view(request).content)
+
+    def test_first_page(self):
+        data = self.get_page(1)
+        self.assertEqual(views.PAGINATION_AMOUNT + 3, data['total_count'])
+        self.assertEqual(2, data['total_pages'])
+        self.assertEqual(views.PAGINATION_AMOUNT, len(data['object_list']))
+
+    def test_last_page(self):
+        data = self.get_page(2)
+        self.assertEqual(2, data['page_number'])
+        self.assertEqual(3, len(data['object_list']))
+        first = set(s['id'] for s in self.get_page(1)['object_list'])
+        self.assertFalse(first & set(s['id'] for s in data['object_list']))
+
+    def test_page_past_the_end(self):
+        self.assertEqual([], self.get_page(3)['object_list'])
+
+
+class ExtractSearchViewTestCase(BaseSearchTestCase):
+
+    def post(self, criteria):
+        request = self.rf.post('/search/extract/', json.dumps(criteria),
+                               content_type='application/json')
+        request.user = self.user
+        return views.ExtractSearchView.as_view()(request)
+
+    def test_search(self):
+        resp = self.post([{
+            u'column': u'demographics', u'field': u'Name', u'combine': u'and',
+            u'query': u'Sean Connery', u'queryType': u'Equals'
+        }])
+        self.assertEqual(200, resp.status_code)
+        data = json.loads(resp.content)
+        self.assertEqual(1, data['total_count'])
+
+    def test_unknown_column(self):
+        resp = self.post([{
+            u'column': u'spaceships', u'field': u'Name', u'combine': u'and',
+            u'query': u'Enterprise', u'queryType': u'Equals'
+        }])
+        self.assertEqual(400, resp.status_code)
+        data = json.loads(resp.content)
+        self.assertEqual('Unknown search column: spaceships', data['error'])
+
+
 class SearchTemplateTestCase(OpalTestCase):
 
     def test_search_template_view(self):
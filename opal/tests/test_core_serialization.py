@@ -0,0 +1,79 @@
+"""
+Unittests for opal.core.serialization
+"""
+from django.db import models as djangomodels
+from mock import patch
+
+from opal.core import serialization
+from opal.core.fields import ForeignKeyOrFreeText
+from opal.core.test import OpalTestCase
+from opal.models import Patient, Episode
+from opal.tests.models import DogOwner, HatWearer, Demographics
+
+
+class SerializationPlanTestCase(OpalTestCase):
+
+    def test_plan_is_compiled_once(self):
+        self.assertIs(DogOwner._get_serialization_plan(),
+                      DogOwner._get_serialization_plan())
+
+    def test_plans_compiled_when_app_ready(self):
+        self.assertIn(Episode, serialization._PLANS)
+        self.assertIn(DogOwner, serialization._PLANS)
+
+    def test_fieldnames(self):
+        plan = DogOwner._get_serialization_plan()
+        self.assertEqual(DogOwner._get_fieldnames_to_serialize(),
+                         list(plan.fieldnames))
+
+    def test_extract_fieldnames_strip_pid(self):
+        plan = Demographics._get_serialization_plan()
+        self.assertNotIn('name', plan.extract_fieldnames)
+        self.assertIn('name', plan.fieldnames)
+
+    def test_field_types(self):
+        plan = DogOwner._get_serialization_plan()
+        self.assertEqual(ForeignKeyOrFreeText, plan.field_types['dog'])
+        self.assertEqual(djangomodels.CharField, plan.field_types['name'])
+
+    def test_foreign_key_attnames(self):
+        self.assertEqual(djangomodels.ForeignKey,
+                         serialization.resolve_field_type(Demographics, 'patient_id'))
+        self.assertEqual(djangomodels.ForeignKey,
+                         serialization.resolve_field_type(HatWearer, 'episode_id'))
+        with self.assertRaises(Exception):
+            serialization.resolve_field_type(HatWearer, 'patient_id')
+
+    def test_fkft(self):
+        plan = DogOwner._get_serialization_plan()
+        self.assertEqual(['dog'], list(plan.fkft.keys()))
+        self.assertEqual(['dog_fk'], plan.fk_fields)
+
+    def test_many_to_many(self):
+        plan = HatWearer._get_serialization_plan()
+        self.assertEqual(('hats',), plan.many_to_many)
+
+    def test_update_fieldnames_skip_fkft_pairs(self):
+        plan = DogOwner._get_serialization_plan()
+        self.assertIn('dog', plan.update_fieldnames)
+        self.assertNotIn('dog_fk_id', plan.update_fieldnames)
+        self.assertNotIn('dog_ft', plan.update_fieldnames)
+        self.assertNotIn('consistency_token', plan.update_fieldnames)
+
+    def test_setters(self):
+        plan = DogOwner._get_serialization_plan()
+        self.assertEqual('set_created', plan.setters['created'])
+
+    def test_build_field_schema_returns_copies(self):
+        schema = DogOwner.build_field_schema()
+        schema[0]['name'] = 'wat'
+        self.assertNotEqual('wat', DogOwner.build_field_schema()[0]['name'])
+
+    def test_to_dict_does_not_walk_model_metadata(self):
+        patient = Patient.objects.create()
+        episode = patient.create_episode()
+        owner = DogOwner.objects.create(episode=episode, name='Jane')
+        with patch.object(DogOwner._meta, 'get_field_by_name') as getter:
+            as_dict = owner.to_dict(self.user)
+            self.assertFalse(getter.called)
+        self.assertEqual('Jane', as_dict['name'])
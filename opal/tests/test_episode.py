@@ -4,10 +4,13 @@ Unittests for Episodes
 import datetime
 
 from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mock import patch
 
 from opal.core.test import OpalTestCase
 from opal.tests.models import Hat, HatWearer, Dog, DogOwner
-from opal.models import Patient, Episode, Team
+from opal.models import Patient, Episode, Tagging, TaggingHistory, Team
 
 
 class EpisodeTest(OpalTestCase):
@@ -56,6 +59,40 @@ class EpisodeTest(OpalTestCase):
         self.episode.set_tag_names(['mine'], self.user)
         self.assertTrue(self.episode.active)
 
+    def test_removing_a_tag_records_history(self):
+        self.episode.set_tag_names(['hiv', 'microbiology'], self.user)
+        self.episode.set_tag_names(['microbiology'], self.user)
+        history = TaggingHistory.objects.get()
+        self.assertEqual(self.hiv, history.team)
+        self.assertEqual(self.user, history.removed_by)
+        self.assertEqual(set(['hiv', 'microbiology']),
+                         set(self.episode.get_tag_names(self.user, historic=True)))
+
+    def test_removing_a_tag_without_a_user(self):
+        self.episode.set_tag_names(['hiv', 'microbiology'], None)
+        self.episode.set_tag_names(['microbiology'], None)
+        history = TaggingHistory.objects.get()
+        self.assertEqual(self.hiv, history.team)
+        self.assertEqual(None, history.removed_by)
+        self.assertEqual(['microbiology'], self.episode.get_tag_names(None))
+
+    def test_historic_tags_for_episodes(self):
+        self.episode.set_tag_names(['hiv'], self.user)
+        self.episode.set_tag_names([], self.user)
+        self.episode.set_tag_names(['hiv'], self.user)
+        self.episode.set_tag_names([], self.user)
+        other = self.patient.create_episode()
+        with self.assertNumQueries(1):
+            historic = Tagging.historic_tags_for_episodes([self.episode, other])
+        self.assertEqual({self.episode.id: {'hiv': True}}, historic)
+
+    def test_historic_episodes_for_tag(self):
+        self.episode.set_tag_names(['hiv'], self.user)
+        self.episode.set_tag_names([], self.user)
+        self.assertEqual([self.episode],
+                         list(Tagging.historic_episodes_for_tag('hiv')))
+        self.assertEqual([], list(Tagging.historic_episodes_for_tag('microbiology')))
+
     def test_to_dict_fields(self):
         as_dict = self.episode.to_dict(self.user)
         expected = [
@@ -117,6 +154,57 @@ class EpisodeTest(OpalTestCase):
         serialised = prev.to_dict(self.user)
         self.assertEqual(serialised["hat_wearer"][0]["hats"], [u'bowler', u'top'])
 
+    def test_to_dict_tagging(self):
+        self.episode.set_tag_names(['hiv', 'mine'], self.user)
+        serialised = self.episode.to_dict(self.user)
+        expected = [{'hiv': True, 'mine': True, 'id': self.episode.id}]
+        self.assertEqual(expected, serialised['tagging'])
+        self.assertEqual(expected, self.episode.tagging_dict(self.user))
+
+    def test_to_dict_tagging_other_users_mine(self):
+        other_user = User.objects.create(username='seconduser')
+        self.episode.set_tag_names(['hiv', 'mine'], self.user)
+        serialised = self.episode.to_dict(other_user)
+        self.assertEqual([{'hiv': True, 'id': self.episode.id}],
+                         serialised['tagging'])
+
+    def test_to_dict_includes_empty_subrecords(self):
+        serialised = self.episode.to_dict(self.user)
+        self.assertEqual([], serialised['hat_wearer'])
+        self.assertEqual([], serialised['patient_colour'])
+
+    def _add_history(self):
+        hat, _ = Hat.objects.get_or_create(name='bowler')
+        episode = self.patient.create_episode()
+        episode.set_tag_names(['hiv'], self.user)
+        HatWearer.objects.create(episode=episode).hats.add(hat)
+        DogOwner.objects.create(episode=episode, dog='Spot')
+        return episode
+
+    def test_to_dict_query_count_is_constant(self):
+        self._add_history()
+        with CaptureQueriesContext(connection) as few:
+            self.episode.to_dict(self.user)
+
+        for i in range(5):
+            self._add_history()
+        with CaptureQueriesContext(connection) as many:
+            serialised = self.episode.to_dict(self.user)
+
+        self.assertEqual(7, len(serialised['episode_history']))
+        self.assertEqual(len(few), len(many))
+
+    def test_serialised_query_count_is_constant(self):
+        episodes = [self._add_history()]
+        with CaptureQueriesContext(connection) as few:
+            Episode.objects.serialised(self.user, episodes, episode_history=True)
+
+        episodes += [self._add_history() for i in range(5)]
+        with CaptureQueriesContext(connection) as many:
+            Episode.objects.serialised(self.user, episodes, episode_history=True)
+
+        self.assertEqual(len(few), len(many))
+
 
 class EpisodeManagerTestCase(OpalTestCase):
     def setUp(self):
@@ -152,3 +240,73 @@ class EpisodeManagerTestCase(OpalTestCase):
 
         self.assertEqual(dogs, {"Jemima", "Philip"})
         self.assertEqual(as_dict["hat_wearer"][0]["hats"], ["top"])
+
+
+class EpisodeVisibilityTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient = Patient.objects.create()
+        self.untagged = self.patient.create_episode()
+        self.general = self.patient.create_episode()
+        self.restricted = self.patient.create_episode()
+        general = Team.objects.create(name='general', title='General')
+        self.restricted_team = Team.objects.create(
+            name='restricted', title='Restricted', restricted=True)
+        self.general.tagging_set.create(team=general)
+        self.restricted.tagging_set.create(team=self.restricted_team)
+
+    def test_visible_to(self):
+        visible = Episode.objects.visible_to(self.user)
+        self.assertEqual(set([self.untagged, self.general]), set(visible))
+
+    def test_visible_to_with_restricted_team(self):
+        with patch.object(Team, 'restricted_teams') as restricted_teams:
+            restricted_teams.return_value = [self.restricted_team]
+            visible = Episode.objects.visible_to(self.user)
+            self.assertEqual(3, visible.count())
+
+    def test_visible_to_composes(self):
+        visible = Episode.objects.filter(id=self.general.id).visible_to(self.user)
+        self.assertEqual([self.general], list(visible))
+
+    def test_visible_to_is_one_query(self):
+        user = self.user
+        with self.assertNumQueries(1):
+            list(Episode.objects.visible_to(user))
+
+    def test_restricted_to(self):
+        self.assertEqual(0, Episode.objects.restricted_to(self.user).count())
+        with patch.object(Team, 'restricted_teams') as restricted_teams:
+            restricted_teams.return_value = [self.restricted_team]
+            restricted = Episode.objects.restricted_to(self.user)
+            self.assertEqual([self.restricted], list(restricted))
+
+
+class EverTaggedTestCase(OpalTestCase):
+    def setUp(self):
+        self.patient = Patient.objects.create()
+        self.episode = self.patient.create_episode()
+        self.other = self.patient.create_episode()
+        Team.objects.create(name='infectious_diseases', title='ID')
+        Team.objects.create(name='hiv', title='HIV')
+
+    def test_current_and_historic(self):
+        self.other.set_tag_names(['infectious_diseases'], self.user)
+        self.other.set_tag_names([], self.user)
+        self.episode.set_tag_names(['infectious_diseases'], self.user)
+        ever = Episode.objects.ever_tagged('Infectious Diseases')
+        self.assertEqual(set([self.episode, self.other]), set(ever))
+
+    def test_no_duplicates(self):
+        for i in range(2):
+            self.episode.set_tag_names(['infectious_diseases'], self.user)
+            self.episode.set_tag_names([], self.user)
+        self.episode.set_tag_names(['infectious_diseases'], self.user)
+        ever = Episode.objects.ever_tagged('infectious_diseases')
+        self.assertEqual([self.episode], list(ever))
+
+    def test_composes(self):
+        self.episode.set_tag_names(['hiv'], self.user)
+        self.other.set_tag_names(['hiv'], self.user)
+        ever = Episode.objects.filter(id=self.other.id).ever_tagged('hiv')
+        with self.assertNumQueries(1):
+            self.assertEqual([self.other], list(ever))
@@ -2,9 +2,12 @@
 Unittests for Patients
 """
 from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from opal.models import Patient, Team, Episode
+from opal.tests.models import Colour, PatientColour
 
 class PatientTest(TestCase):
 
@@ -33,3 +36,49 @@ class PatientTest(TestCase):
         self.patient.create_episode()
         self.assertIsNone(self.patient.get_active_episode())
 
+    def test_to_dict(self):
+        episode = self.patient.create_episode()
+        PatientColour.objects.create(patient=self.patient, name='blue')
+        as_dict = self.patient.to_dict(None)
+        self.assertEqual(self.patient.id, as_dict['id'])
+        self.assertEqual([episode.id], as_dict['episodes'].keys())
+        self.assertEqual('blue', as_dict['patient_colour'][0]['name'])
+        self.assertEqual(as_dict['patient_colour'],
+                         as_dict['episodes'][episode.id]['patient_colour'])
+        self.assertIsNone(as_dict['active_episode_id'])
+
+    def test_to_dict_active_episode_id(self):
+        self.patient.create_episode()
+        episode = self.patient.create_episode()
+        episode.set_tag_names(['microbiology'], None)
+        as_dict = self.patient.to_dict(None)
+        self.assertEqual(episode.id, as_dict['active_episode_id'])
+
+    def test_to_dict_episodes_match_episode_to_dict(self):
+        episode = self.patient.create_episode()
+        Colour.objects.create(episode=episode, name='red')
+        as_dict = self.patient.to_dict(None)
+        self.assertEqual(episode.to_dict(None), as_dict['episodes'][episode.id])
+
+
+class PatientManagerTest(TestCase):
+
+    def make_patients(self, count):
+        for i in range(count):
+            patient = Patient.objects.create()
+            PatientColour.objects.create(patient=patient, name='blue')
+            for j in range(2):
+                episode = patient.create_episode()
+                Colour.objects.create(episode=episode, name='red')
+
+    def test_serialised_query_count_is_constant(self):
+        self.make_patients(1)
+        with CaptureQueriesContext(connection) as few:
+            Patient.objects.serialised(None, Patient.objects.all())
+
+        self.make_patients(5)
+        with CaptureQueriesContext(connection) as many:
+            serialised = Patient.objects.serialised(None, Patient.objects.all())
+
+        self.assertEqual(6, len(serialised))
+        self.assertEqual(len(few), len(many))
@@ -1,16 +1,26 @@
 """
 Unittests for opal.core.search.extract
 """
+from cStringIO import StringIO
 import datetime
 import json
+import multiprocessing
+import os
+import tempfile
+from unittest import skipIf
+import zipfile
 from mock import mock_open, Mock, patch
 
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
+from opal.core import exceptions
 from opal.core.test import OpalTestCase
 from opal import models
-from opal.tests.models import Colour,  Demographics
+from opal.tests.models import (Colour, Demographics, Dog, DogOwner, Hat,
+                               HatWearer)
 
 from opal.core.search import extract
 
@@ -40,6 +50,75 @@ class TestViewGet(OpalTestCase):
         response = self.client.post(url, post_data)
 
         self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        archive = zipfile.ZipFile(StringIO(''.join(response.streaming_content)))
+        self.assertIsNone(archive.testzip())
+        names = [n.split('/', 1)[1] for n in archive.namelist()]
+        self.assertIn('episodes.csv', names)
+        self.assertIn('demographics.csv', names)
+        self.assertIn('filter.txt', names)
+
+
+    def test_projection(self):
+        self.assertTrue(
+            self.client.login(username=self.user.username, password=self.PASSWORD)
+        )
+        post_data = {
+            "criteria": json.dumps([]),
+            "projection": json.dumps({"colour": ["name"]}),
+        }
+        response = self.client.post(reverse("extract_download"), post_data)
+        archive = zipfile.ZipFile(StringIO(''.join(response.streaming_content)))
+        names = [n.split('/', 1)[1] for n in archive.namelist()]
+        self.assertEqual(['episodes.csv', 'colour.csv', 'filter.txt'], names)
+
+    def test_bad_projection(self):
+        self.assertTrue(
+            self.client.login(username=self.user.username, password=self.PASSWORD)
+        )
+        post_data = {
+            "criteria": json.dumps([]),
+            "projection": json.dumps({"colour": ["nonexistent"]}),
+        }
+        response = self.client.post(reverse("extract_download"), post_data)
+        self.assertEqual(400, response.status_code)
+
+
+    def test_malformed_projection(self):
+        self.assertTrue(
+            self.client.login(username=self.user.username, password=self.PASSWORD)
+        )
+        post_data = {
+            "criteria": json.dumps([]),
+            "projection": '{"colour": [',
+        }
+        response = self.client.post(reverse("extract_download"), post_data)
+        self.assertEqual(400, response.status_code)
+
+
+class ZipStreamTestCase(OpalTestCase):
+    def test_archive(self):
+        stream = extract.ZipStream()
+        data = ''.join(stream.member('a/one.csv', ['x,y\r\n', '1,2\r\n']))
+        data += ''.join(stream.member(u'a/tw\xf6.txt', []))
+        data += stream.close()
+
+        archive = zipfile.ZipFile(StringIO(data))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual('x,y\r\n1,2\r\n', archive.read('a/one.csv'))
+        self.assertEqual('', archive.read(u'a/tw\xf6.txt'))
+
+    def test_zip_archive_writes_one_file(self):
+        patient = models.Patient.objects.create()
+        episode = patient.create_episode()
+        fname = extract.zip_archive([episode], 'Everything', self.user)
+        try:
+            archive = zipfile.ZipFile(fname)
+            self.assertIsNone(archive.testzip())
+            filter_name = [n for n in archive.namelist() if n.endswith('filter.txt')][0]
+            self.assertEqual('Everything', archive.read(filter_name))
+        finally:
+            os.remove(fname)
 
 
 class PatientEpisodeTestCase(OpalTestCase):
@@ -143,3 +222,311 @@ class PatientSubrecordCSVTestCase(PatientEpisodeTestCase):
         ]
         self.assertEqual(headers, expected_headers)
         self.assertEqual(row, expected_row)
+
+
+class ChunkedRowsTestCase(PatientEpisodeTestCase):
+
+    def rows(self, generator, *args):
+        rows = list(generator(*args))
+        return [dict(zip(rows[0], row)) for row in rows[1:]]
+
+    def test_fkorft_names(self):
+        Dog.objects.create(name='Jemima')
+        DogOwner.objects.create(episode=self.episode, dog='Jemima')
+        DogOwner.objects.create(episode=self.episode, dog='Philip')
+        episodes = models.Episode.objects.all()
+        dogs = [r['dog'] for r in self.rows(extract.subrecord_rows, episodes, DogOwner)]
+        self.assertEqual(['Jemima', 'Philip'], dogs)
+
+    def test_many_to_many(self):
+        wearer = HatWearer.objects.create(episode=self.episode, name='Jeeves')
+        wearer.hats.add(Hat.objects.create(name='top'), Hat.objects.create(name='bowler'))
+        HatWearer.objects.create(episode=self.episode, name='Wooster')
+        episodes = models.Episode.objects.all()
+        hats = [r['hats'] for r in self.rows(extract.subrecord_rows, episodes, HatWearer)]
+        self.assertEqual(['bowler;top', ''], hats)
+
+    def test_episode_tagging(self):
+        models.Team.objects.create(name='hiv', title='HIV')
+        models.Team.objects.create(name='micro', title='Micro')
+        self.episode.set_tag_names(['hiv'], self.user)
+        self.episode.set_tag_names(['micro'], self.user)
+        rows = self.rows(extract.episode_rows, [self.episode], self.user)
+        self.assertEqual('hiv;micro', rows[0]['tagging'])
+
+    def test_patient_subrecord_uses_latest_episode(self):
+        later = self.patient.create_episode()
+        rows = self.rows(extract.patient_subrecord_rows,
+                         models.Episode.objects.all(), Demographics)
+        self.assertEqual([later.id], [r['episode_id'] for r in rows])
+
+    def test_query_count_is_constant(self):
+        user = self.user
+
+        def count_queries():
+            episodes = models.Episode.objects.all()
+            with CaptureQueriesContext(connection) as captured:
+                list(extract.episode_rows(episodes, user))
+                list(extract.subrecord_rows(episodes, DogOwner))
+                list(extract.patient_subrecord_rows(episodes, Demographics))
+            return len(captured)
+
+        DogOwner.objects.create(episode=self.episode, dog='Rover')
+        few = count_queries()
+        for i in range(5):
+            patient = models.Patient.objects.create()
+            episode = patient.create_episode()
+            DogOwner.objects.create(episode=episode, dog='Fido')
+        self.assertEqual(few, count_queries())
+
+    def test_chunks(self):
+        for i in range(5):
+            self.patient.create_episode()
+        with patch.object(extract, 'CHUNK_SIZE', 2):
+            rows = self.rows(extract.episode_rows,
+                             models.Episode.objects.all(), self.user)
+        self.assertEqual(6, len(rows))
+        self.assertEqual(6, len(set(r['id'] for r in rows)))
+
+
+def _pool_kind():
+    pool = extract._get_pool(2)
+    try:
+        return type(pool).__name__
+    finally:
+        pool.terminate()
+
+
+class InlinePool(object):
+    """
+    A stand in for a pool that runs each task in this thread (and so
+    with the test database), completing them in reverse order.
+    """
+    def imap_unordered(self, func, iterable):
+        return reversed([func(i) for i in iterable])
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class ParallelExtractTestCase(OpalTestCase):
+
+    def setUp(self):
+        self.patient = models.Patient.objects.create()
+        self.episode = self.patient.create_episode()
+        Colour.objects.create(episode=self.episode, name='blue')
+        pool = patch.object(extract, '_get_pool', return_value=InlinePool())
+        pool.start()
+        self.addCleanup(pool.stop)
+
+    def archive(self, episodes, timings=None, progress=None):
+        data = ''.join(extract.zip_archive_stream(
+            episodes, 'Everything', self.user, timings, progress))
+        archive = zipfile.ZipFile(StringIO(data))
+        self.assertIsNone(archive.testzip())
+        return dict((n.split('/', 1)[1], archive.read(n))
+                    for n in archive.namelist())
+
+    def test_parallel_matches_serial(self):
+        episodes = models.Episode.objects.all()
+        serial = self.archive(episodes)
+        with patch.object(extract, 'EXTRACT_WORKERS', 3):
+            parallel = self.archive(episodes)
+        self.assertEqual(serial, parallel)
+        self.assertIn('blue', parallel['colour.csv'])
+
+    def test_episode_list(self):
+        with patch.object(extract, 'EXTRACT_WORKERS', 2):
+            members = self.archive([self.episode])
+        self.assertIn('blue', members['colour.csv'])
+
+    def test_timings(self):
+        for workers in (1, 2):
+            timings = []
+            with patch.object(extract, 'EXTRACT_WORKERS', workers):
+                members = self.archive(models.Episode.objects.all(), timings)
+            self.assertEqual(
+                sorted(members.keys()),
+                sorted([name for name, seconds in timings] + ['filter.txt']))
+
+    def test_progress(self):
+        episodes = models.Episode.objects.all()
+        for workers in (1, 2):
+            written = []
+            with patch.object(extract, 'EXTRACT_WORKERS', workers):
+                with patch.object(extract, 'CHUNK_SIZE', 1):
+                    self.archive(episodes, progress=written.append)
+            self.assertEqual(extract.estimate_rows(episodes), sum(written))
+
+    def test_removes_parts(self):
+        with patch.object(extract, 'EXTRACT_WORKERS', 2):
+            with patch.object(extract.os, 'remove',
+                              side_effect=os.remove) as remove:
+                self.archive(models.Episode.objects.all())
+        self.assertEqual(len(extract._parts()), remove.call_count)
+        for call in remove.call_args_list:
+            self.assertFalse(os.path.exists(call[0][0]))
+
+    def workdirs(self):
+        made = []
+        real_mkdtemp = tempfile.mkdtemp
+
+        def mkdtemp(**kwargs):
+            made.append(real_mkdtemp(**kwargs))
+            return made[-1]
+        return made, patch.object(extract.tempfile, 'mkdtemp', side_effect=mkdtemp)
+
+    def test_failed_part_leaves_no_files(self):
+        made, mkdtemp = self.workdirs()
+        real_rows = extract._rows
+
+        def rows(episodes, user, kind, api_name, fields):
+            if api_name == 'colour':
+                raise ValueError('Broken')
+            return real_rows(episodes, user, kind, api_name, fields)
+
+        with patch.object(extract, 'EXTRACT_WORKERS', 2):
+            with mkdtemp, patch.object(extract, '_rows', side_effect=rows):
+                with self.assertRaises(ValueError):
+                    self.archive(models.Episode.objects.all())
+        self.assertFalse(os.path.exists(made[0]))
+
+    def test_build_part_removes_its_file_on_failure(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, workdir)
+        part = ('colour.csv', 'subrecord', 'colour', None,
+                models.Episode.objects.all().query, self.user, workdir)
+        with patch.object(extract, '_rows', side_effect=ValueError('Broken')):
+            with self.assertRaises(ValueError):
+                extract._build_part(part)
+        self.assertEqual([], os.listdir(workdir))
+
+    def test_abandoned_archive_leaves_no_files(self):
+        made, mkdtemp = self.workdirs()
+        with patch.object(extract, 'EXTRACT_WORKERS', 2), mkdtemp:
+            stream = extract.zip_archive_stream(
+                models.Episode.objects.all(), 'Everything', self.user)
+            next(stream)
+            self.assertTrue(os.listdir(made[0]))
+            stream.close()
+        self.assertFalse(os.path.exists(made[0]))
+
+    def test_members_in_completion_order(self):
+        with patch.object(extract, 'EXTRACT_WORKERS', 2):
+            data = ''.join(extract.zip_archive_stream(
+                models.Episode.objects.all(), 'Everything', self.user))
+        names = [n.split('/', 1)[1]
+                 for n in zipfile.ZipFile(StringIO(data)).namelist()]
+        expected = [part[0] for part in extract._parts()]
+        self.assertEqual(list(reversed(expected)) + ['filter.txt'], names)
+
+
+class GetPoolTestCase(OpalTestCase):
+
+    @skipIf(connection.vendor == 'sqlite' and
+            not connection.features.can_share_in_memory_db,
+            'Pool threads cannot see an unshared in memory test database')
+    def test_thread_pool(self):
+        episode = models.Patient.objects.create().create_episode()
+        Colour.objects.create(episode=episode, name='blue')
+        with patch.object(extract, 'EXTRACT_WORKERS', 3):
+            data = ''.join(extract.zip_archive_stream(
+                models.Episode.objects.all(), 'Everything', self.user))
+        archive = zipfile.ZipFile(StringIO(data))
+        self.assertIsNone(archive.testzip())
+
+    def test_unknown_pool(self):
+        with patch.object(extract, 'EXTRACT_POOL', 'fibres'):
+            with self.assertRaises(ValueError):
+                extract._get_pool(2)
+
+    def test_process_pool_in_daemon_uses_threads(self):
+        # As when an extract job runs in the jobs pool with
+        # OPAL_EXTRACT_POOL = 'process' and several extract workers
+        with patch.object(extract, 'EXTRACT_POOL', 'process'):
+            jobs_pool = multiprocessing.Pool(1)
+            try:
+                kind = jobs_pool.apply(_pool_kind)
+            finally:
+                jobs_pool.terminate()
+                jobs_pool.join()
+        self.assertEqual('ThreadPool', kind)
+
+    def test_process_pool(self):
+        with patch.object(extract, 'EXTRACT_POOL', 'process'):
+            with patch.object(extract.multiprocessing, 'Pool') as pool:
+                extract._get_pool(4)
+        pool.assert_called_once_with(
+            4, initializer=extract._forget_connections)
+
+
+class ProjectionTestCase(PatientEpisodeTestCase):
+
+    def setUp(self):
+        super(ProjectionTestCase, self).setUp()
+        Colour.objects.create(episode=self.episode, name='blue')
+        DogOwner.objects.create(episode=self.episode, name='Ann', dog='Fido')
+
+    def members(self, projection):
+        data = ''.join(extract.zip_archive_stream(
+            models.Episode.objects.all(), 'Everything', self.user,
+            projection=projection))
+        archive = zipfile.ZipFile(StringIO(data))
+        return dict((n.split('/', 1)[1], archive.read(n))
+                    for n in archive.namelist())
+
+    def test_validate(self):
+        projection = {'colour': ['name'], 'demographics': None, 'tagging': []}
+        self.assertEqual(projection, extract.validate_projection(projection))
+
+    def test_validate_rejects(self):
+        for projection in [
+                ['colour'],
+                {'nonexistent': None},
+                {'colour': ['nonexistent']},
+                {'colour': 'name'}]:
+            with self.assertRaises(exceptions.SearchError):
+                extract.validate_projection(projection)
+
+    def test_selected_subrecords(self):
+        members = self.members({'colour': None, 'demographics': None})
+        self.assertEqual(
+            ['colour.csv', 'demographics.csv', 'episodes.csv', 'filter.txt'],
+            sorted(members))
+        self.assertNotIn('tagging', members['episodes.csv'].splitlines()[0])
+
+    def test_selected_fields(self):
+        members = self.members({'dog_owner': ['dog'], 'demographics': ['name']})
+        self.assertEqual('episode_id,dog\r\n{0},Fido\r\n'.format(self.episode.id),
+                         members['dog_owner.csv'])
+        # name is PID so we never extract it
+        self.assertEqual('episode_id\r\n{0}\r\n'.format(self.episode.id),
+                         members['demographics.csv'])
+
+    def test_unselected_tables_are_not_queried(self):
+        self.user  # OpalTestCase creates it lazily - not in the captured queries
+        with CaptureQueriesContext(connection) as captured:
+            self.members({'colour': None})
+        tables = ' '.join(q['sql'] for q in captured)
+        self.assertIn('tests_colour', tables)
+        self.assertNotIn('tests_dogowner', tables)
+        self.assertNotIn('tests_demographics', tables)
+        self.assertNotIn('opal_tagging', tables)
+
+    def test_tagging_teams(self):
+        models.Team.objects.create(name='hiv', title='HIV')
+        models.Team.objects.create(name='micro', title='Micro')
+        self.episode.set_tag_names(['hiv', 'micro'], self.user)
+        rows = list(extract.episode_rows([self.episode], self.user, ['micro']))
+        self.assertEqual('micro', rows[1][-1])
+
+    def test_estimate_rows(self):
+        episodes = models.Episode.objects.all()
+        self.assertEqual(
+            2, extract.estimate_rows(episodes, {'colour': None}))
@@ -2,6 +2,8 @@
 Test util fields
 """
 from django.test import TestCase
+
+from opal.core import lookuplists
 from opal.tests.models import DogOwner, Dog
 
 
@@ -18,3 +20,52 @@ class FKorFTTest(TestCase):
         instance.dog = None
 
         self.assertEqual('', instance.dog)
+
+    def test_set_lookuplist_value(self):
+        dog = self.ll.objects.create(name='Spaniel')
+        instance = self.Model()
+        instance.dog = 'Spaniel'
+        self.assertEqual(dog.id, instance.dog_fk_id)
+        self.assertEqual('', instance.dog_ft)
+        self.assertEqual('Spaniel', instance.dog)
+
+    def test_set_synonym(self):
+        from django.contrib.contenttypes.models import ContentType
+        from opal.models import Synonym
+        dog = self.ll.objects.create(name='Dalmation')
+        Synonym.objects.create(
+            content_object=dog, name='Spotty',
+            content_type=ContentType.objects.get_for_model(self.ll))
+        instance = self.Model()
+        instance.dog = 'Spotty'
+        self.assertEqual(dog.id, instance.dog_fk_id)
+        self.assertEqual('Dalmation', instance.dog)
+
+    def test_set_free_text(self):
+        instance = self.Model()
+        instance.dog = 'Wolf'
+        self.assertEqual(None, instance.dog_fk_id)
+        self.assertEqual('Wolf', instance.dog)
+
+    def test_set_and_get_from_cache_without_queries(self):
+        dog = self.ll.objects.create(name='Poodle')
+        self.Model().dog = 'Poodle'
+        with self.assertNumQueries(0):
+            owner = self.Model(dog_fk_id=dog.id)
+            self.assertEqual('Poodle', owner.dog)
+            other = self.Model()
+            other.dog = 'Poodle'
+
+    def test_cache_miss_checks_database(self):
+        # Added by another process, so the cache wasn't invalidated
+        self.Model().dog = 'Poodle'
+        self.ll.objects.bulk_create([self.ll(name='Wolf')])
+        self.addCleanup(lookuplists.cache.invalidate, self.ll)
+        dog = self.ll.objects.get(name='Wolf')
+        instance = self.Model()
+        instance.dog = 'Wolf'
+        self.assertEqual(dog.id, instance.dog_fk_id)
+        self.assertEqual('', instance.dog_ft)
+        # The cache has been refreshed
+        with self.assertNumQueries(0):
+            self.Model().dog = 'Wolf'
@@ -1,9 +1,26 @@
 """
 Unittests for opal.views
 """
+import json
+
 from django.test import TestCase
 
-from opal import views
+from opal import models, views
+from opal.core.test import OpalTestCase
 
 class ColumnContextTestCase(TestCase):
     pass
+
+
+class EpisodeListAndCreateViewTestCase(OpalTestCase):
+
+    def test_get_streams_active_episodes(self):
+        patient = models.Patient.objects.create()
+        active = patient.create_episode(active=True)
+        patient.create_episode(active=False)
+        request = self.rf.get('/episode/')
+        request.user = self.user
+        response = views.episode_list_and_create_view(request)
+        self.assertTrue(response.streaming)
+        data = json.loads(''.join(response.streaming_content))
+        self.assertEqual([active.id], [e['id'] for e in data])
@@ -11,9 +11,10 @@ from django.views.generic import TemplateView, View
 from django.views.decorators.http import require_http_methods
 
 from opal import models
-from opal.core import application, exceptions, glossolalia
+from opal.core import application, exceptions, glossolalia, pagination
 from opal.core.subrecords import episode_subrecords, subrecords
-from opal.core.views import LoginRequiredMixin, _get_request_data, _build_json_response
+from opal.core.views import (LoginRequiredMixin, _get_request_data,
+                             _build_json_response, _build_json_streaming_response)
 from opal.core.schemas import get_all_list_schema_classes
 from opal.utils import camelcase_to_underscore, stringport
 from opal.utils.banned_passwords import banned
@@ -156,9 +157,9 @@ def episode_detail_view(request, pk):
     data = _get_request_data(request)
 
     try:
-        pre = episode.to_dict(request.user)
+        pre = glossolalia.snapshot(episode, request.user)
         episode.update_from_dict(data, request.user)
-        post = episode.to_dict(request.user)
+        post = glossolalia.snapshot(episode, request.user)
         glossolalia.change(pre, post)
         return _build_json_response(episode.to_dict(request.user, shallow=True))
     except exceptions.ConsistencyError:
@@ -168,8 +169,8 @@ def episode_detail_view(request, pk):
 @require_http_methods(['GET', 'POST'])
 def episode_list_and_create_view(request):
     if request.method == 'GET':
-        serialised = models.Episode.objects.serialised_active(request.user)
-        return _build_json_response(serialised)
+        serialised = models.Episode.objects.serialised_active_iterator(request.user)
+        return _build_json_streaming_response(serialised)
 
     elif request.method == 'POST':
         data = _get_request_data(request)
@@ -183,7 +184,7 @@ def episode_list_and_create_view(request):
         patient.update_from_demographics_dict(data['demographics'], request.user)
         try:
             episode = patient.create_episode()
-            episode_fields = models.Episode._get_fieldnames_to_serialize()
+            episode_fields = models.Episode._get_serialization_plan().fieldnames
             episode_data = {}
             for fname in episode_fields:
                 if fname in data:
@@ -219,9 +220,21 @@ class EpisodeListView(View):
         # Probably the wrong place to do this, but mine needs specialcasing.
         if tag == 'mine':
             filter_kwargs['tagging__user'] = self.request.user
-        serialised = models.Episode.objects.serialised_active(
+
+        try:
+            page_params = pagination.get_page_params(self.request.GET)
+        except exceptions.APIError as e:
+            return _build_json_response({'error': str(e)}, 400)
+
+        if page_params:
+            episodes = models.Episode.objects.filter(active=True, **filter_kwargs)
+            page, next_cursor = pagination.paginate(episodes, *page_params)
+            serialised = models.Episode.objects.serialised(self.request.user, page)
+            return _build_json_response({'results': serialised, 'next': next_cursor})
+
+        serialised = models.Episode.objects.serialised_active_iterator(
             self.request.user, **filter_kwargs)
-        return _build_json_response(serialised)
+        return _build_json_streaming_response(serialised)
 
 
 
@@ -38,6 +38,7 @@ settings.configure(DEBUG=True,
                                    'django.contrib.sessions',
                                    'django.contrib.admin',
                                    'compressor',
+                                   'reversion',
                                    'opal',
                                    'opal.core.search',
                                    'opal.tests'